@@ -60,9 +60,13 @@ class MyRequestHandler(http.Request):
                 resp+= '<IRETURNVALUE>'
             output = StringIO()
             output.write(resp)
-            fn(tt, output)
+            # The pull operations return output parameters that follow
+            # the IRETURNVALUE
+            trailer = fn(tt, output)
             if method == 'IMETHODCALL':
                 resp = '</IRETURNVALUE>'
+                if trailer:
+                    resp+= trailer
             else:
                 resp = ''
             resp+= """</%s>
@@ -20,15 +20,150 @@
 
 import os, pywbem, apsw
 import cPickle as pickle
+import hashlib
+import heapq
+import marshal
 import operator
+import struct
+import sys
+import threading
+import time
 import zlib
+from collections import OrderedDict
 
 _REPDIR = './repository'
 
+# Version of the namespace database layout, kept in PRAGMA user_version
+_SCHEMA_VERSION = 12
+
+# Maximum number of idle connections kept open per namespace
+_POOLSIZE = 8
+
+# Upper bound, in pickled bytes, of the resolved class cache
+_CLASSCACHE_SIZE = 16 * 1024 * 1024
+
+# Number of instances CreateInstances stores per transaction
+_BULK_BATCHSIZE = 1000
+
+# Namespace databases use write-ahead logging, so that readers work from a
+# snapshot and neither block writers nor are blocked by them. The
+# synchronous and wal_autocheckpoint settings apply to each connection and
+# can be changed with SetJournalOptions.
+_JOURNAL_MODE = 'wal'
+_SYNCHRONOUS = 'normal'
+_WAL_AUTOCHECKPOINT = 1000
+# Incremented whenever the connection settings change
+_journal_generation = 0
+
+# Milliseconds a connection waits for a lock held by another connection
+_BUSY_TIMEOUT = 10000
+
+# Group commit (see SetGroupCommit): whether it is on, the longest time in
+# seconds a write waits for others to share its transaction, and the
+# largest number of writes committed together
+_GROUPCOMMIT = False
+_GROUPCOMMIT_LATENCY = 0.005
+_GROUPCOMMIT_BATCH = 256
+
+# Change log retention (see SetChangeLogRetention): the number of changes
+# kept and their greatest age in seconds, 0 for no limit, and the number
+# of changes between two trims of the log
+_CHANGELOG_MAXCHANGES = 100000
+_CHANGELOG_MAXAGE = 0
+_CHANGELOG_TRIM_INTERVAL = 1000
+
+# The references of every association instance, indexed by the hash of the
+# instance they refer to (see _target_key)
+_REFINDEX_SCHEMA = (
+        'CREATE TABLE RefIndex('
+            'targethash INTEGER NOT NULL,'
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'strkey TEXT NOT NULL,'
+            'role TEXT NOT NULL COLLATE NOCASE,'
+            'target BLOB NOT NULL,'
+            'PRIMARY KEY(classname COLLATE NOCASE, strkey, '
+                'role COLLATE NOCASE));'
+        'CREATE INDEX RefTargetNDX on RefIndex(targethash);')
+
+# Declared property indexes (see CreatePropertyIndex) and their entries:
+# one row per value of the property in every instance of the class and
+# its subclasses
+_PROPINDEX_SCHEMA = (
+        'CREATE TABLE PropIndexes('
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'propname TEXT NOT NULL COLLATE NOCASE,'
+            'state TEXT NOT NULL,'
+            'PRIMARY KEY(classname COLLATE NOCASE, propname COLLATE NOCASE));'
+        'CREATE TABLE PropIndexData('
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'propname TEXT NOT NULL COLLATE NOCASE,'
+            'value NOT NULL,'
+            'instclass TEXT NOT NULL COLLATE NOCASE,'
+            'strkey TEXT NOT NULL,'
+            'PRIMARY KEY(classname COLLATE NOCASE, propname COLLATE NOCASE, '
+                'value, instclass COLLATE NOCASE, strkey));'
+        'CREATE INDEX PropIndexInstNDX on '
+            'PropIndexData(instclass COLLATE NOCASE, strkey);')
+
+# The number of instances of every class that has had any, their total size
+# in bytes (instance blobs and split layout property rows), and the change
+# sequence number of their last write. ChangeSequence holds the last change
+# sequence number handed out in the namespace.
+_STATS_SCHEMA = (
+        'CREATE TABLE ClassStats('
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'ninstances INTEGER NOT NULL,'
+            'nbytes INTEGER NOT NULL,'
+            'lastseq INTEGER NOT NULL,'
+            'PRIMARY KEY(classname COLLATE NOCASE));'
+        'CREATE TABLE ChangeSequence(seq INTEGER NOT NULL);'
+        'INSERT INTO ChangeSequence VALUES(0);')
+
+# The change log: one row per change, numbered by the change sequence (see
+# ReadChanges). The changes up to ChangeLogHorizon were trimmed.
+_CHANGELOG_SCHEMA = (
+        'CREATE TABLE ChangeLog('
+            'seq INTEGER PRIMARY KEY,'
+            'time REAL NOT NULL,'
+            'kind TEXT NOT NULL,'
+            'op TEXT NOT NULL,'
+            'name TEXT NOT NULL,'
+            'strkey TEXT,'
+            'path BLOB);'
+        'CREATE TABLE ChangeLogHorizon(seq INTEGER NOT NULL);'
+        'INSERT INTO ChangeLogHorizon VALUES(0);')
+
+# The changes to anything but instances, which are all SyncCaches reads
+_CHANGELOG_META_SCHEMA = (
+        'CREATE INDEX ChangeLogMetaNDX on ChangeLog(seq) '
+            "WHERE kind!='instance';")
+
+# A shard database of a class (see ShardClass): the instance tables of a
+# namespace database, holding a share of the instances of one class
+_SHARD_SCHEMA = (
+        'CREATE TABLE Instances('
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'strkey TEXT NOT NULL,'
+            'data BLOB NOT NULL,'
+            'keyhash INTEGER NOT NULL DEFAULT 0,'
+            'path BLOB,'
+            'PRIMARY KEY(classname COLLATE NOCASE, strkey));'
+        'CREATE INDEX InstKeyHashNDX on Instances(keyhash);'
+        'CREATE INDEX InstPathNDX on Instances(classname COLLATE NOCASE, path);'
+        'CREATE TABLE InstanceProperties('
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'strkey TEXT NOT NULL,'
+            'name TEXT NOT NULL COLLATE NOCASE,'
+            'data BLOB NOT NULL,'
+            'PRIMARY KEY(classname COLLATE NOCASE, strkey, '
+                'name COLLATE NOCASE));')
+
 ##############################################################################
 def _createdb(dbname):
     conn = apsw.Connection(dbname)
     cursor = conn.cursor()
+    # Lets CompactNamespace free pages without rebuilding the database
+    cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
     cursor.execute(
         'CREATE TABLE QualifierTypes('
             'name TEXT NOT NULL COLLATE NOCASE,'
@@ -51,196 +186,2145 @@ def _createdb(dbname):
             'classname TEXT NOT NULL COLLATE NOCASE,'
             'strkey TEXT NOT NULL,'
             'data BLOB NOT NULL,'
+            'keyhash INTEGER NOT NULL DEFAULT 0,'
+            'path BLOB,'
             'PRIMARY KEY(classname COLLATE NOCASE, strkey));'
+        'CREATE INDEX InstKeyHashNDX on Instances(keyhash);'
+        'CREATE INDEX InstPathNDX on Instances(classname COLLATE NOCASE, path);'
         'CREATE TABLE RefInfo('
             'assoccid INTEGER NOT NULL,'
             'refpropcid INTEGER NOT NULL,'
             'refpropname TEXT NOT NULL COLLATE NOCASE,'
-            'PRIMARY KEY(assoccid, refpropcid, refpropname));')
+            'PRIMARY KEY(assoccid, refpropcid, refpropname));'
+        'CREATE TABLE ClassDicts('
+            'dictid INTEGER PRIMARY KEY AUTOINCREMENT,'
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'data BLOB NOT NULL,'
+            'ninstances INTEGER NOT NULL);'
+        'CREATE INDEX ClassDictsNDX on ClassDicts(classname);'
+        'CREATE TABLE ClassStorage('
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'layout TEXT NOT NULL,'
+            'shards INTEGER NOT NULL DEFAULT 0,'
+            'PRIMARY KEY(classname COLLATE NOCASE));'
+        'CREATE TABLE InstanceProperties('
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'strkey TEXT NOT NULL,'
+            'name TEXT NOT NULL COLLATE NOCASE,'
+            'data BLOB NOT NULL,'
+            'PRIMARY KEY(classname COLLATE NOCASE, strkey, '
+                'name COLLATE NOCASE));'
+        'CREATE TABLE ResolvedClasses('
+            'cid INTEGER PRIMARY KEY,'
+            'data BLOB NOT NULL);'
+        + _REFINDEX_SCHEMA + _PROPINDEX_SCHEMA + _STATS_SCHEMA
+        + _CHANGELOG_SCHEMA + _CHANGELOG_META_SCHEMA)
+    cursor.execute('PRAGMA user_version=%d' % _SCHEMA_VERSION)
+    _configure_connection(conn)
     return conn
 
+##############################################################################
+def _configure_connection(conn):
+    conn.setbusytimeout(_BUSY_TIMEOUT)
+    cursor = conn.cursor()
+    # The journal mode is stored in the database. Setting it converts
+    # databases that were created with a rollback journal.
+    cursor.execute('PRAGMA journal_mode=%s' % _JOURNAL_MODE).next()
+    cursor.execute('PRAGMA synchronous=%s' % _SYNCHRONOUS)
+    cursor.execute('PRAGMA wal_autocheckpoint=%d' % _WAL_AUTOCHECKPOINT)
+    cursor.close(True)
+
+##############################################################################
+def _upgradedb(conn):
+    """Bring a namespace database created by an older version of this
+    module up to _SCHEMA_VERSION."""
+    cursor = conn.cursor()
+    version, = cursor.execute('PRAGMA user_version').next()
+    if version >= _SCHEMA_VERSION:
+        return
+    cursor.execute('BEGIN EXCLUSIVE')
+    try:
+        # Another process may have upgraded the database in the meantime
+        (version,), = cursor.execute('PRAGMA user_version').fetchall()
+        for upgrade in _UPGRADES[version:_SCHEMA_VERSION]:
+            upgrade(conn)
+        cursor.execute('PRAGMA user_version=%d' % _SCHEMA_VERSION)
+        cursor.execute('COMMIT')
+    except:
+        cursor.execute('ROLLBACK')
+        raise
+
+
+##############################################################################
+# Compact encoding of CIM objects.
+#
+# CIMInstance, CIMInstanceName and CIMClass objects are flattened into
+# tuples of plain values and written with marshal. Unlike a pickle the
+# result does not name the module and class of every nested object, and
+# reading it back does not go through the generic unpickler. Property,
+# qualifier and parameter values are stored untyped and rebuilt from their
+# declared CIM type; key binding values, which have no declared type,
+# carry their own.
+
+class _NotCompact(Exception):
+    pass
+
+_CIMTYPES = {
+    'uint8': pywbem.Uint8, 'sint8': pywbem.Sint8,
+    'uint16': pywbem.Uint16, 'sint16': pywbem.Sint16,
+    'uint32': pywbem.Uint32, 'sint32': pywbem.Sint32,
+    'uint64': pywbem.Uint64, 'sint64': pywbem.Sint64,
+    'real32': pywbem.Real32, 'real64': pywbem.Real64,
+}
+
+def _pack_scalar(cimtype, value):
+    if value is None or type(value) in (bool, unicode, str):
+        return value
+    if isinstance(value, basestring):
+        return unicode(value)
+    if isinstance(value, (int, long)):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, pywbem.CIMInstanceName):
+        return _pack_name(value)
+    if isinstance(value, pywbem.CIMDateTime):
+        return unicode(value)
+    if isinstance(value, (pywbem.CIMInstance, pywbem.CIMClass)):
+        # Embedded object
+        return _pack_object(value)
+    raise _NotCompact(type(value))
+
+def _unpack_scalar(cimtype, value):
+    if value is None:
+        return None
+    if isinstance(value, tuple):
+        return _unpack_object(value)
+    if cimtype == 'datetime':
+        return pywbem.CIMDateTime(value)
+    cimclass = _CIMTYPES.get(cimtype)
+    if cimclass is not None:
+        return cimclass(value)
+    return value
+
+def _pack_value(cimtype, value):
+    if isinstance(value, list):
+        return [_pack_scalar(cimtype, x) for x in value]
+    return _pack_scalar(cimtype, value)
+
+def _unpack_value(cimtype, value):
+    if isinstance(value, list):
+        return [_unpack_scalar(cimtype, x) for x in value]
+    return _unpack_scalar(cimtype, value)
+
+def _pack_key(value):
+    if isinstance(value, pywbem.CIMInstanceName):
+        return ('reference', _pack_name(value))
+    if isinstance(value, pywbem.CIMDateTime):
+        return ('datetime', unicode(value))
+    if isinstance(value, bool) or type(value) in (int, long, float, str,
+            unicode):
+        return value
+    cimtype = getattr(value, 'cimtype', None)
+    if cimtype in _CIMTYPES:
+        return (cimtype, _pack_scalar(cimtype, value))
+    raise _NotCompact(type(value))
+
+def _unpack_key(value):
+    if not isinstance(value, tuple):
+        return value
+    cimtype, value = value
+    if cimtype == 'reference':
+        return _unpack_name(value)
+    return _unpack_scalar(cimtype, value)
+
+def _pack_name(iname):
+    return ('n', iname.classname, iname.namespace, iname.host,
+        [(k, _pack_key(v)) for k, v in iname.keybindings.iteritems()])
+
+def _unpack_name(t):
+    iname = pywbem.CIMInstanceName(t[1], host=t[3], namespace=t[2])
+    iname.keybindings = _nocasedict([(k, _unpack_key(v)) for k, v in t[4]])
+    return iname
+
+def _nocasedict(items):
+    # Build a NocaseDict from (name, value) pairs without going through
+    # its constructor, the way unpickling one does
+    d = pywbem.NocaseDict.__new__(pywbem.NocaseDict)
+    d.data = dict([(k.lower(), (k, v)) for k, v in items])
+    return d
+
+def _pack_qualifiers(quals):
+    return [(q.name, q.type, _pack_value(q.type, q.value), q.propagated,
+            q.overridable, q.tosubclass, q.toinstance, q.translatable)
+        for q in quals.itervalues()]
+
+def _unpack_qualifiers(t):
+    return _nocasedict([(name, pywbem.CIMQualifier(name,
+                _unpack_value(cimtype, value), type=cimtype,
+                propagated=propagated, overridable=overridable,
+                tosubclass=tosubclass, toinstance=toinstance,
+                translatable=translatable))
+        for (name, cimtype, value, propagated, overridable, tosubclass,
+            toinstance, translatable) in t])
+
+def _pack_property(p):
+    return (p.name, p.type, p.is_array, _pack_value(p.type, p.value),
+            p.reference_class, getattr(p, 'embedded_object', None),
+            p.class_origin, p.propagated, p.array_size,
+            _pack_qualifiers(p.qualifiers))
+
+def _pack_properties(props):
+    return [_pack_property(p) for p in props.itervalues()]
+
+def _unpack_property(name, cimtype, is_array, value, reference_class,
+        embedded_object, class_origin, propagated, array_size, quals):
+    # The values were taken from a valid CIMProperty, so skip the type
+    # checks and guessing of its constructor and just restore the
+    # attributes, as unpickling would
+    prop = pywbem.CIMProperty.__new__(pywbem.CIMProperty)
+    prop.name = name
+    prop.value = _unpack_value(cimtype, value)
+    prop.type = cimtype
+    prop.class_origin = class_origin
+    prop.array_size = array_size
+    prop.propagated = propagated
+    prop.qualifiers = _unpack_qualifiers(quals)
+    prop.is_array = is_array
+    prop.reference_class = reference_class
+    prop.embedded_object = embedded_object
+    return (name, prop)
+
+def _unpack_properties(t):
+    return _nocasedict([_unpack_property(*x) for x in t])
+
+def _pack_methods(meths):
+    return [(m.name, m.return_type,
+            [(pa.name, pa.type, pa.reference_class, pa.is_array,
+                pa.array_size, _pack_qualifiers(pa.qualifiers))
+                for pa in m.parameters.itervalues()],
+            m.class_origin, m.propagated, _pack_qualifiers(m.qualifiers))
+        for m in meths.itervalues()]
+
+def _unpack_methods(t):
+    meths = []
+    for name, return_type, params, class_origin, propagated, quals in t:
+        parameters = _nocasedict([(pname, pywbem.CIMParameter(pname, cimtype,
+                reference_class=reference_class, is_array=is_array,
+                array_size=array_size,
+                qualifiers=_unpack_qualifiers(pquals)))
+            for pname, cimtype, reference_class, is_array, array_size,
+                pquals in params])
+        meths.append((name, pywbem.CIMMethod(name, return_type=return_type,
+            parameters=parameters, class_origin=class_origin,
+            propagated=propagated, qualifiers=_unpack_qualifiers(quals))))
+    return _nocasedict(meths)
+
+def _pack_object(obj):
+    if isinstance(obj, pywbem.CIMInstance):
+        return ('i', obj.classname,
+            obj.path is not None and _pack_name(obj.path) or None,
+            _pack_properties(obj.properties),
+            _pack_qualifiers(obj.qualifiers))
+    if isinstance(obj, pywbem.CIMClass):
+        return ('c', obj.classname, obj.superclass,
+            _pack_properties(obj.properties), _pack_methods(obj.methods),
+            _pack_qualifiers(obj.qualifiers))
+    if isinstance(obj, pywbem.CIMInstanceName):
+        return _pack_name(obj)
+    if isinstance(obj, pywbem.CIMProperty):
+        return ('p', _pack_property(obj))
+    raise _NotCompact(type(obj))
+
+def _unpack_object(t):
+    kind = t[0]
+    if kind == 'i':
+        inst = pywbem.CIMInstance(t[1])
+        if t[2] is not None:
+            inst.path = _unpack_name(t[2])
+        inst.properties = _unpack_properties(t[3])
+        inst.qualifiers = _unpack_qualifiers(t[4])
+        return inst
+    if kind == 'c':
+        cc = pywbem.CIMClass(t[1], superclass=t[2])
+        cc.properties = _unpack_properties(t[3])
+        cc.methods = _unpack_methods(t[4])
+        cc.qualifiers = _unpack_qualifiers(t[5])
+        return cc
+    if kind == 'p':
+        return _unpack_property(*t[1])[1]
+    return _unpack_name(t)
+
+def _compact_dumps(obj):
+    """Return the compact encoding of obj, or None if obj (or something
+    inside it) cannot be encoded that way."""
+    try:
+        return marshal.dumps(_pack_object(obj), 2)
+    except (_NotCompact, ValueError):
+        return None
+
+def _compact_loads(data):
+    return _unpack_object(marshal.loads(data))
+
+##############################################################################
+# Blob codecs.
+#
+# Every blob starts with a one character tag naming how it was encoded, so
+# a repository can hold blobs written with different codecs. Blobs written
+# before codecs existed are untagged zlib streams, which always start
+# with 'x'.
+
+_TAG_PICKLE = 'P'
+_TAG_ZPICKLE = 'Z'
+_TAG_COMPACT = 'C'
+_TAG_ZCOMPACT = 'K'
+_TAG_ZDICT = 'D'
+
+_ZTAGS = {_TAG_PICKLE: _TAG_ZPICKLE, _TAG_COMPACT: _TAG_ZCOMPACT}
+
+_DECODERS = {
+    'x': lambda data: pickle.loads(zlib.decompress(data)),
+    _TAG_PICKLE: lambda data: pickle.loads(str(buffer(data, 1))),
+    _TAG_ZPICKLE: lambda data: pickle.loads(zlib.decompress(buffer(data, 1))),
+    _TAG_COMPACT: lambda data: _compact_loads(str(buffer(data, 1))),
+    _TAG_ZCOMPACT: lambda data: _compact_loads(
+                                    zlib.decompress(buffer(data, 1))),
+}
+
+class Codec(object):
+    """Encodes repository objects into tagged blobs.
+
+    serializer is 'pickle' or 'compact'. Objects the compact encoding
+    does not handle (qualifier declarations for instance) are always
+    pickled. The serialized data is zlib compressed at the given level
+    when it is at least threshold bytes long; a level of None disables
+    compression. With zdict, instances are compressed with a dictionary
+    trained on earlier instances of their class, once there are enough
+    of them (see ZDictCache).
+    """
+    def __init__(self, serializer='pickle',
+            level=zlib.Z_DEFAULT_COMPRESSION, threshold=0, zdict=False):
+        if serializer not in ('pickle', 'compact'):
+            raise ValueError('Unknown serializer %s' % serializer)
+        self.serializer = serializer
+        self.level = level
+        self.threshold = threshold
+        self.zdict = zdict
+
+    def __repr__(self):
+        return 'Codec(%r, level=%r, threshold=%r, zdict=%r)' % (
+            self.serializer, self.level, self.threshold, self.zdict)
+
+    def serialize(self, obj):
+        """Return (tag, data) for the uncompressed encoding of obj."""
+        if self.serializer == 'compact':
+            data = _compact_dumps(obj)
+            if data is not None:
+                return (_TAG_COMPACT, data)
+        return (_TAG_PICKLE, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def encode(self, obj, zdict=None):
+        tag, data = self.serialize(obj)
+        if zdict is not None:
+            return buffer(_TAG_ZDICT + struct.pack('>I', zdict.dictid) +
+                tag + zdict.compress(data))
+        if self.level is not None and len(data) >= self.threshold:
+            return buffer(_ZTAGS[tag] + zlib.compress(data, self.level))
+        return buffer(tag + data)
+
+# The codecs SetCodec knows by name. 'zlib' is what the repository has
+# always used.
+CODECS = {
+    'pickle': Codec('pickle', level=None),
+    'zlib': Codec('pickle'),
+    'compact': Codec('compact', level=None),
+    'zcompact': Codec('compact'),
+    'zdict': Codec('compact', zdict=True),
+}
+
+_codec = CODECS['zlib']
+
+##############################################################################
+def SetCodec(codec):
+    """Set the codec used to encode new blobs. codec is a Codec or the
+    name of one in CODECS. Existing blobs are left as they are."""
+    global _codec
+    if isinstance(codec, basestring):
+        codec = CODECS[codec]
+    _codec = codec
+
+##############################################################################
+def _encode(x):
+    return _codec.encode(x)
+
+##############################################################################
+def _decode(data, conn=None):
+    """Decode a blob. Dictionary compressed instance blobs can only be
+    decoded with a connection to the namespace they were read from."""
+    tag = data[0]
+    if tag == _TAG_ZDICT:
+        dictid, = struct.unpack('>I', str(buffer(data, 1, 4)))
+        data = data[5] + _zdicts.get(conn, dictid).decompress(buffer(data, 6))
+        tag = data[0]
+    try:
+        decoder = _DECODERS[tag]
+    except KeyError:
+        raise pywbem.CIMError(pywbem.CIM_ERR_FAILED,
+            'Unknown repository blob encoding %r' % tag)
+    return decoder(data)
+
+##############################################################################
+# Dictionary compression of instance blobs.
+#
+# Instances of a class share most of their encoding: property names and
+# types, and the layout of the serialized objects. Compressed one by one
+# with plain zlib, small instances hardly shrink at all. Instead the
+# instances of a class are compressed with a preset dictionary built from
+# sample instances of that class and kept in the ClassDicts table.
+#
+# zlib's preset dictionary support (zdict) is not available in Python 2,
+# so _ZDict gets the same effect by feeding the dictionary through a
+# compressor and decompressor once and then compressing and decompressing
+# every blob with a copy of their state. Only the data after the
+# dictionary is stored.
+
+# Maximum size of a trained dictionary. zlib can only refer back 32KB.
+_ZDICT_SIZE = 16 * 1024
+# Number of instances a class needs before a dictionary is trained for it
+_ZDICT_MINSAMPLES = 32
+# Number of instances sampled to train a dictionary
+_ZDICT_SAMPLES = 64
+# Number of writes to a class between checks whether to (re)train
+_ZDICT_CHECK = 256
+
+class _ZDict(object):
+    def __init__(self, dictid, data, ninstances=0,
+            level=zlib.Z_DEFAULT_COMPRESSION):
+        self.dictid = dictid
+        self.ninstances = ninstances
+        data = str(data)
+        compressor = zlib.compressobj(level)
+        prefix = compressor.compress(data) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.compressor = compressor
+        decompressor = zlib.decompressobj()
+        decompressor.decompress(prefix)
+        self.decompressor = decompressor
+
+    def compress(self, data):
+        c = self.compressor.copy()
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data):
+        d = self.decompressor.copy()
+        return d.decompress(data) + d.flush()
+
+##############################################################################
+def _train_zdict(samples):
+    """Build a preset dictionary from a list of serialized objects.
+
+    The samples are concatenated, skipping duplicates, and the last
+    _ZDICT_SIZE bytes are used. zlib encodes matches that are closer
+    to the data more cheaply, so the best sample should come last.
+    """
+    seen = set()
+    parts = []
+    for sample in samples:
+        if sample not in seen:
+            seen.add(sample)
+            parts.append(sample)
+    return ''.join(parts)[-_ZDICT_SIZE:]
+
+class ZDictCache(object):
+    """The compression dictionaries of each namespace, by dictid and by
+    class. The dictionary of a class is (re)trained by written() when the
+    class has at least _ZDICT_MINSAMPLES instances and twice as many as
+    when its current dictionary was trained. Older dictionaries are kept
+    for the blobs that were compressed with them."""
+    def __init__(self):
+        self.byid = {}
+        self.byclass = {}
+        self.writes = {}
+        self.lock = threading.Lock()
+
+    def get(self, conn, dictid):
+        key = (conn.dbname, dictid)
+        zd = self.byid.get(key)
+        if zd is None:
+            cursor = conn.cursor()
+            try:
+                data, ninstances = cursor.execute('select data,ninstances '
+                    'from ClassDicts where dictid=?', (dictid,)).next()
+            except StopIteration:
+                raise pywbem.CIMError(pywbem.CIM_ERR_FAILED,
+                    'Compression dictionary %d does not exist' % dictid)
+            zd = _ZDict(dictid, data, ninstances)
+            self.byid[key] = zd
+        return zd
+
+    def current(self, conn, classname):
+        key = (conn.dbname, classname.lower())
+        try:
+            return self.byclass[key]
+        except KeyError:
+            pass
+        cursor = conn.cursor()
+        zd = None
+        for dictid, in cursor.execute('select max(dictid) from ClassDicts '
+                'where classname=?', (classname,)):
+            if dictid is not None:
+                zd = self.get(conn, dictid)
+        self.byclass[key] = zd
+        return zd
+
+    def written(self, conn, classname, codec):
+        key = (conn.dbname, classname.lower())
+        self.lock.acquire()
+        try:
+            n = self.writes.get(key, 0) + 1
+            self.writes[key] = n
+        finally:
+            self.lock.release()
+        if n == _ZDICT_MINSAMPLES or n % _ZDICT_CHECK == 0:
+            self.train(conn, classname, codec)
+
+    def train(self, conn, classname, codec):
+        cursor = conn.cursor()
+        dbs = _class_dbs(conn, classname)
+        count = sum([cursor.execute('select count(*) from %s.Instances '
+            'where classname=?' % db, (classname,)).next()[0] for db in dbs])
+        # Another process may have trained a newer dictionary
+        self.byclass.pop((conn.dbname, classname.lower()), None)
+        zd = self.current(conn, classname)
+        if count < _ZDICT_MINSAMPLES or \
+                (zd is not None and count < 2 * zd.ninstances):
+            return
+        samples = [codec.serialize(_decode(data, conn))[1]
+            for data, in cursor.execute('select data from %s.Instances '
+                'where classname=? order by random() limit ?' % dbs[0],
+                (classname, _ZDICT_SAMPLES))]
+        data = _train_zdict(samples)
+        cursor.execute('insert into ClassDicts values(NULL,?,?,?)',
+            (classname, buffer(data), count))
+        dictid = conn.last_insert_rowid()
+        level = codec.level
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        zd = _ZDict(dictid, data, count, level)
+        self.byid[(conn.dbname, dictid)] = zd
+        self.byclass[(conn.dbname, classname.lower())] = zd
+
+    def invalidate(self, dbname, classnames=None):
+        self.lock.acquire()
+        try:
+            if classnames is None:
+                for d in (self.byid, self.byclass, self.writes):
+                    for k in [k for k in d.iterkeys() if k[0] == dbname]:
+                        del d[k]
+            else:
+                for cname in classnames:
+                    self.byclass.pop((dbname, cname.lower()), None)
+                    self.writes.pop((dbname, cname.lower()), None)
+        finally:
+            self.lock.release()
+
+_zdicts = ZDictCache()
 
 ##############################################################################
-_decode = lambda x: (pickle.loads(zlib.decompress(x)))
-_encode = lambda x: buffer(zlib.compress(pickle.dumps(x, pickle.HIGHEST_PROTOCOL)))
+def _encode_instance(conn, instance):
+    codec = _codec
+    if not codec.zdict:
+        return codec.encode(instance)
+    return codec.encode(instance, _zdicts.current(conn, instance.classname))
+
+##############################################################################
+def _encode_path(iname):
+    # Instance paths are stored apart from the instance, always in the
+    # compact encoding and uncompressed, so that EnumerateInstanceNames
+    # can be served from the InstPathNDX index alone
+    return CODECS['compact'].encode(iname)
+
+##############################################################################
+def _instance_written(conn, classname):
+    # Called after an instance blob has been stored
+    if _codec.zdict:
+        _zdicts.written(conn, classname, _codec)
 
 ##############################################################################
 def _makedbname(namespace):
     int_ns = '~'.join([x for x in namespace.split('/') if x]) + '.db'
     return _REPDIR + '/' + int_ns
 
+##############################################################################
+def _dbnamespace(dbname):
+    # The inverse of _makedbname
+    return os.path.basename(dbname)[:-3].replace('~', '/')
+
 ##############################################################################
 def _namespace_exists(namespace):
     return os.path.exists(_makedbname(namespace))
 
 ##############################################################################
-def _getdbconnection(namespace):
-    if not namespace or not _namespace_exists(namespace):
-        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE,
-            'Namespace %s does not exist' % namespace)
-    dbname = _makedbname(namespace)
-    return apsw.Connection(dbname)
+class PooledConnection(object):
+    """An apsw connection checked out of a namespace's ConnectionPool.
 
-##############################################################################
-class GeneratorConnection(object):
-    def __init__(self, connection):
+    Everything is delegated to the underlying apsw.Connection, except
+    close(), which hands the connection back to the pool. That lets all
+    the existing conn.close(True) call sites stay as they are. shards is
+    the shard map of the namespace (see ShardClass) that the connection's
+    attached databases match.
+    """
+    conn = None
+    def __init__(self, pool, connection, generation, write=False,
+            shards=None):
+        self.pool = pool
+        self.dbname = pool.dbname
         self.conn = connection
+        self.generation = generation
+        self.write = write
+        self.shards = shards or {}
         self.cursors = []
     def __del__(self):
         self.close()
-    def close(self):
-        if self.cursors:
-            for c in self.cursors:
-                c.close(True)
-            operator.delslice(self.cursors, 0, len(self.cursors))
-        self.conn.close(True)
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
     def cursor(self):
         c = self.conn.cursor()
         self.cursors.append(c)
         return c
+    def attach_shards(self):
+        # Outside of a transaction only
+        self.generation, self.shards = self.pool.attach_shards(self.conn,
+            self.generation)
+    def close(self, force=False):
+        conn = self.conn
+        if conn is None:
+            return
+        self.conn = None
+        for c in self.cursors:
+            try:
+                c.close(True)
+            except apsw.Error:
+                pass
+        operator.delslice(self.cursors, 0, len(self.cursors))
+        self.pool.checkin(conn, self.generation, self.write)
 
 ##############################################################################
-def _get_generator_connection(namespace):
-    conn = _getdbconnection(namespace)
-    return GeneratorConnection(conn)
+class ConnectionPool(object):
+    """Connections to a single namespace database.
 
-##############################################################################
-def DeleteNamespace(namespace):
-    if not _namespace_exists(namespace):
-        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE)
-    os.remove(_makedbname(namespace))
-        
-##############################################################################
-def CreateNamespace(namespace):
-    if _namespace_exists(namespace):
-        raise pywbem.CIMError(pywbem.CIM_ERR_ALREADY_EXISTS)
-    # Create db for namespace
-    conn = _createdb(_makedbname(namespace))
-    conn.close(True)
+    Up to 'size' idle connections (and with them their prepared
+    statement caches) are kept open between requests. checkout() never
+    blocks: when no idle connection is available a new one is opened, and
+    connections returned to a full pool are closed. Idle connections are
+    reconfigured on checkout after SetJournalOptions, and get the shard
+    databases of the namespace attached after they change. Every checkout
+    first brings the caches of the namespace up to date with the changes
+    made by other processes (see SyncCaches).
+    """
+    # Whether other processes may write to the database
+    syncs = True
 
-##############################################################################
-def Namespaces():
-    for fname in os.listdir(_REPDIR):
-        if fname.endswith('.db'):
-            fname = fname[0:-3]
-            name = '/'.join(fname.split('~'))
-            if _namespace_exists(name):
-                yield name
+    def __init__(self, dbname, size=None):
+        self.dbname = dbname
+        if size is None:
+            size = _POOLSIZE
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.closed = False
+        # The shard map and shard databases of the namespace, and the
+        # number of times they were reset
+        self.shards = None
+        self.shardgen = 0
 
-##############################################################################
-def GetQualifier(QualifierName, namespace, Connection=None):
-    conn = Connection or _getdbconnection(namespace)
-    cqt = None
-    try:
-        cursor = conn.cursor()
-        cursor.execute('select data from QualifierTypes where name=?',
-                (QualifierName,))
-        try:
-            data, = cursor.next()
-        except StopIteration:
-            raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
-        cursor.close(True)
-        cqt = _decode(data)
-        Connection or conn.close(True)
-    except:
-        Connection or conn.close(True)
-        raise
-    return cqt
+    def _connect(self):
+        conn = apsw.Connection(self.dbname)
+        _configure_connection(conn)
+        return conn
 
-##############################################################################
-def SetQualifier(QualifierDeclaration, namespace):
-    conn = _getdbconnection(namespace)
-    try:
-        cursor = conn.cursor()
-        pargq = _encode(QualifierDeclaration)
+    def checkout(self, write=False):
+        conn = None
+        self.lock.acquire()
         try:
-            cqt = GetQualifier(QualifierDeclaration.name, namespace, conn)
-        except pywbem.CIMError: 
-            cqt = None
+            if self.closed:
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE,
+                    'Namespace database %s has been closed' % self.dbname)
+            if self.idle:
+                conn, generation = self.idle.pop()
+        finally:
+            self.lock.release()
+        if conn is None:
+            conn = self._connect()
+            generation = (_journal_generation, -1, ())
+        elif generation[0] != _journal_generation:
+            _configure_connection(conn)
+        try:
+            if self.syncs:
+                _sync_caches(conn, self.dbname)
+            generation, shards = self.attach_shards(conn, generation)
+        except:
+            conn.close(True)
+            raise
+        return PooledConnection(self, conn, generation, write, shards)
 
-        if cqt:
-            cursor.execute('update QualifierTypes set data=? where name=?',
-                (pargq, QualifierDeclaration.name))
-        else:
-            cursor.execute('insert into QualifierTypes values(?,?)',
-                (QualifierDeclaration.name, pargq))
-        conn.close(True)
-    except:
-        conn.close(True)
-        raise
+    def attach_shards(self, conn, generation):
+        """Attach the shard databases of the namespace to conn in place of
+        those it has, if they changed since its generation, and return its
+        new generation and the shard map."""
+        shardgen = self.shardgen
+        shards, names = self.shard_map(conn)
+        if generation[1] != shardgen or \
+                generation[0] != _journal_generation:
+            attached = _attach_shards(conn, generation[2], names)
+            generation = (_journal_generation, shardgen, attached)
+        return generation, shards
 
-##############################################################################
-def DeleteQualifier(QualifierName, namespace):
-    conn = _getdbconnection(namespace)
-    try:
-        cursor = conn.cursor()
-        if not GetQualifier(QualifierName, namespace, conn):
-            raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
-        cursor.execute(
-            'delete from QualifierTypes where name=?', (QualifierName,))
-        conn.close(True)
-    except:
+    def shard_map(self, conn):
+        """Return the shard map of the namespace and the (schema name, file
+        name) of its shard databases, read through conn if need be."""
+        shards = self.shards
+        if shards is None:
+            shardgen = self.shardgen
+            shards = _load_shards(conn)
+            shards = (shards, _shard_names(self.dbname, shards))
+            if shardgen == self.shardgen:
+                self.shards = shards
+        return shards
+
+    def reset_shards(self):
+        self.shards = None
+        self.shardgen += 1
+
+    def checkin(self, conn, generation, write=False):
+        try:
+            # Never hand out a connection with a transaction still open
+            if not conn.getautocommit():
+                conn.cursor().execute('ROLLBACK')
+        except apsw.Error:
+            conn.close(True)
+            return
+        self.lock.acquire()
+        try:
+            if not self.closed and len(self.idle) < self.size:
+                self.idle.append((conn, generation))
+                return
+        finally:
+            self.lock.release()
         conn.close(True)
-        raise
 
-##############################################################################
-def EnumerateQualifiers(namespace):
-    conn = _get_generator_connection(namespace)
-    try:
-        cursor = conn.cursor()
-        for data, in cursor.execute('select data from QualifierTypes'):
-            yield _decode(data)
-        conn.close()
-    except:
-        conn.close()
-        raise
+    def resize(self, size):
+        self.lock.acquire()
+        try:
+            self.size = size
+            extra = self.idle[size:]
+            operator.delslice(self.idle, size, len(self.idle))
+        finally:
+            self.lock.release()
+        for conn, generation in extra:
+            conn.close(True)
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+        finally:
+            self.lock.release()
+        for conn, generation in idle:
+            conn.close(True)
 
 ##############################################################################
-def _valid_qualifier(conn, qualname):
-    cc = None
+def _copydb(source, dest):
+    backup = dest.backup('main', source, 'main')
     try:
-        cc = GetQualifier(qualname, None, Connection=conn)
-    except pywbem.CIMError:
-        pass
-    return cc
+        while not backup.done:
+            backup.step(-1)
+    finally:
+        backup.finish()
 
 ##############################################################################
-def _verify_qualifier_set(conn, qualset):
-    for qualname,qual in qualset.iteritems():
+class SharedLock(object):
+    """A lock that can be held shared by any number of threads or
+    exclusively by one. Both sides are reentrant, and a thread that holds
+    the lock shared may also take it exclusively once no other thread
+    holds it. Waiting exclusive holders keep new shared holders out."""
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = {}
+        self.writer = None
+        self.writes = 0
+        self.waiting = 0
+
+    def acquire_shared(self):
+        me = threading.currentThread()
+        self.cond.acquire()
         try:
-            qt = GetQualifier(qualname, None, Connection=conn)
-        except pywbem.CIMError:
-            raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
-                'Qualifier %s is invalid' % qualname)
-        # Set flavors to defaults if not specified
-        if qual.overridable is None:
-            qual.overridable = qt.overridable
-        if qual.tosubclass is None:
-            qual.tosubclass = qt.tosubclass
-        if qual.translatable is None:
-            qual.translatable = qt.translatable
-        if qual.toinstance is None:
-            qual.toinstance = qt.toinstance
+            if self.writer is not me and me not in self.readers:
+                while self.writer is not None or self.waiting:
+                    self.cond.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+        finally:
+            self.cond.release()
 
-##############################################################################
-def _verify_qualifiers(conn, theclass):
-    # Verify class qualifiers
-    _verify_qualifier_set(conn, theclass.qualifiers)
+    def release_shared(self):
+        me = threading.currentThread()
+        self.cond.acquire()
+        try:
+            self.readers[me] -= 1
+            if not self.readers[me]:
+                del self.readers[me]
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
-    # Verify property qualifiers
-    for prop in theclass.properties.itervalues():
-        _verify_qualifier_set(conn, prop.qualifiers)
+    def acquire(self, timeout=None):
+        """Take the lock exclusively. Returns False if that took longer
+        than timeout seconds."""
+        me = threading.currentThread()
+        self.cond.acquire()
+        try:
+            if self.writer is not me:
+                if timeout is not None:
+                    deadline = time.time() + timeout
+                self.waiting += 1
+                try:
+                    while self.writer is not None or \
+                            [t for t in self.readers if t is not me]:
+                        if timeout is None:
+                            self.cond.wait()
+                            continue
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                        self.cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                    if not self.waiting:
+                        # Shared holders may have queued up behind us
+                        self.cond.notifyAll()
+                self.writer = me
+            self.writes += 1
+            return True
+        finally:
+            self.cond.release()
 
-    # Verify method qualifiers
-    for meth in theclass.methods.itervalues():
-        _verify_qualifier_set(conn, meth.qualifiers)
+    def release(self):
+        self.cond.acquire()
+        try:
+            self.writes -= 1
+            if not self.writes:
+                self.writer = None
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
 ##############################################################################
-def _adjust_root_class(theclass):
-    for qual in theclass.qualifiers.itervalues():
-        qual.propagated = False
-    for prop in theclass.properties.itervalues():
-        prop.propagated = False
+class MemoryConnectionPool(ConnectionPool):
+    """Connections to an in-memory copy of a namespace database.
+
+    The copy is a shared cache memory database, loaded from disk with the
+    backup API and kept alive by the pool's anchor connection. Shared
+    cache connections cannot wait for each other's table locks, so
+    instead a connection checked out to read holds rwlock shared until it
+    is checked in, and one checked out to write holds it exclusively.
+    Readers, including open enumerations, thus never see a write that is
+    in progress, and do not take table locks (read_uncommitted), so that
+    a thread can write while it iterates over an enumeration. Changes are
+    copied back to disk after every write, or every flushinterval seconds
+    if that is set.
+    """
+    # The memory database is this process's own
+    syncs = False
+
+    def __init__(self, dbname, flushinterval=None, size=None):
+        ConnectionPool.__init__(self, dbname, size)
+        self.uri = 'file:cimdb-%x?mode=memory&cache=shared' % id(self)
+        self.flushinterval = flushinterval
+        self.rwlock = SharedLock()
+        self.dirty = False
+        self.anchor = self._connect()
+        self.stopping = threading.Event()
+        self.flusher = None
+
+    def _connect(self):
+        conn = apsw.Connection(self.uri, flags=apsw.SQLITE_OPEN_READWRITE |
+            apsw.SQLITE_OPEN_CREATE | apsw.SQLITE_OPEN_URI)
+        conn.setbusytimeout(_BUSY_TIMEOUT)
+        conn.cursor().execute('PRAGMA read_uncommitted=1')
+        return conn
+
+    def load(self, disk):
+        """Fill the memory database from a connection to the disk one."""
+        _copydb(disk, self.anchor)
+        if self.flushinterval and self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush_loop,
+                name='cimdb flusher %s' % self.dbname)
+            self.flusher.setDaemon(True)
+            self.flusher.start()
+
+    def checkout(self, write=False):
+        if not write:
+            self.rwlock.acquire_shared()
+        elif not self.rwlock.acquire(_BUSY_TIMEOUT / 1000.0):
+            # Other threads keep enumerations open, or are themselves
+            # waiting for this one
+            raise pywbem.CIMError(pywbem.CIM_ERR_FAILED,
+                'Timed out waiting for readers of %s' % self.dbname)
+        try:
+            return ConnectionPool.checkout(self, write)
+        except:
+            self._release(write)
+            raise
+
+    def checkin(self, conn, generation, write=False):
+        try:
+            ConnectionPool.checkin(self, conn, generation)
+            if write:
+                self.dirty = True
+                if not self.flushinterval:
+                    self.flush()
+        finally:
+            self._release(write)
+
+    def _release(self, write):
+        if write:
+            self.rwlock.release()
+        else:
+            self.rwlock.release_shared()
+
+    def flush(self):
+        """Copy the memory database to disk if it has changed."""
+        self.rwlock.acquire()
+        try:
+            if not self.dirty or self.closed:
+                return False
+            disk = apsw.Connection(self.dbname)
+            try:
+                _configure_connection(disk)
+                _copydb(self.anchor, disk)
+            finally:
+                disk.close(True)
+            self.dirty = False
+            return True
+        finally:
+            self.rwlock.release()
+
+    def _flush_loop(self):
+        while not self.stopping.wait(self.flushinterval):
+            try:
+                self.flush()
+            except apsw.Error:
+                pass
+
+    def close(self):
+        self.stopping.set()
+        ConnectionPool.close(self)
+        self.anchor.close(True)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# {dbname: flush interval} of the namespaces served from memory
+_memory_namespaces = {}
+
+##############################################################################
+def _getpool(namespace):
+    dbname = _makedbname(namespace)
+    pool = _pools.get(dbname)
+    if pool is not None:
+        return pool
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(dbname)
+        if pool is None:
+            if not os.path.exists(dbname):
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE,
+                    'Namespace %s does not exist' % namespace)
+            pool = ConnectionPool(dbname)
+            generation = (_journal_generation, -1, ())
+            conn = pool._connect()
+            try:
+                _upgradedb(conn)
+                if dbname in _memory_namespaces:
+                    if _load_shards(conn):
+                        raise pywbem.CIMError(pywbem.CIM_ERR_NOT_SUPPORTED,
+                            'Namespace %s has sharded classes and cannot '
+                            'be served from memory' % namespace)
+                    pool = MemoryConnectionPool(dbname,
+                        _memory_namespaces[dbname])
+                    try:
+                        pool.load(conn)
+                    except:
+                        pool.close()
+                        raise
+            except:
+                conn.close(True)
+                raise
+            if isinstance(pool, MemoryConnectionPool):
+                conn.close(True)
+            else:
+                pool.checkin(conn, generation)
+            _pools[dbname] = pool
+    finally:
+        _pools_lock.release()
+    return pool
+
+##############################################################################
+def _closepool(namespace):
+    _stopwriter(_makedbname(namespace))
+    _pools_lock.acquire()
+    try:
+        pool = _pools.pop(_makedbname(namespace), None)
+    finally:
+        _pools_lock.release()
+    if pool is not None:
+        pool.close()
+
+##############################################################################
+def SetConnectionPoolSize(size, namespace=None):
+    """Set the number of idle connections kept open per namespace.
+
+    With a namespace only that namespace's pool is resized, otherwise the
+    default for all pools is changed.
+    """
+    global _POOLSIZE
+    if namespace:
+        _getpool(namespace).resize(size)
+        return
+    _POOLSIZE = size
+    for pool in _pools.values():
+        pool.resize(size)
+
+##############################################################################
+def SetNamespaceMemory(namespace, enable=True, flushinterval=None):
+    """Serve a namespace from an in-memory copy of its database.
+
+    The copy is loaded when the namespace is next used. Every write is
+    copied back to disk before it returns, unless flushinterval is set, in
+    which case changes are written to disk every flushinterval seconds and
+    by FlushNamespace. Changes that have not been flushed are lost when
+    the process ends. Turning the option off flushes the namespace.
+    """
+    dbname = _makedbname(namespace)
+    if enable and not _namespace_exists(namespace):
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE,
+            'Namespace %s does not exist' % namespace)
+    if not enable and dbname not in _memory_namespaces:
+        return
+    _stopwriter(dbname)
+    pool = _pools.get(dbname)
+    if isinstance(pool, MemoryConnectionPool):
+        # No write may slip in between the flush and the switch
+        pool.rwlock.acquire()
+    try:
+        if isinstance(pool, MemoryConnectionPool):
+            pool.flush()
+        if enable:
+            _memory_namespaces[dbname] = flushinterval
+        else:
+            del _memory_namespaces[dbname]
+        _closepool(namespace)
+    finally:
+        if isinstance(pool, MemoryConnectionPool):
+            pool.rwlock.release()
+
+##############################################################################
+def FlushNamespace(namespace):
+    """Write the changes to an in-memory namespace to disk. Returns True
+    if there were any."""
+    pool = _pools.get(_makedbname(namespace))
+    if isinstance(pool, MemoryConnectionPool):
+        return pool.flush()
+    return False
+
+##############################################################################
+def ReloadNamespace(namespace):
+    """Discard the in-memory copy of a namespace, including changes that
+    were not flushed, and load it again from disk."""
+    if _makedbname(namespace) not in _memory_namespaces:
+        return
+    _closepool(namespace)
+    _invalidate_classes(namespace)
+    _qualcache.invalidate(_makedbname(namespace))
+    _zdicts.invalidate(_makedbname(namespace))
+    _layouts.pop(_makedbname(namespace), None)
+    _propindexes.pop(_makedbname(namespace), None)
+    _getpool(namespace)
+
+##############################################################################
+def SetJournalOptions(synchronous=None, autocheckpoint=None):
+    """Set the durability of the namespace databases.
+
+    synchronous is the SQLite synchronous setting: 'off', 'normal' (the
+    default, durable up to the last checkpoint after a power failure) or
+    'full'. autocheckpoint is the number of WAL pages after which a commit
+    checkpoints the log; 0 leaves checkpoints to CheckpointNamespace.
+    """
+    global _SYNCHRONOUS, _WAL_AUTOCHECKPOINT, _journal_generation
+    if synchronous is not None:
+        if synchronous.lower() not in ('off', 'normal', 'full'):
+            raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                'Invalid synchronous setting %s' % synchronous)
+        _SYNCHRONOUS = synchronous.lower()
+    if autocheckpoint is not None:
+        _WAL_AUTOCHECKPOINT = int(autocheckpoint)
+    _journal_generation += 1
+
+##############################################################################
+def CheckpointNamespace(namespace, mode='passive'):
+    """Copy the write-ahead log of a namespace into its database. mode is
+    'passive', 'full', 'restart' or 'truncate', as for SQLite's
+    wal_checkpoint. Returns the number of frames in the log and the number
+    of them that were checkpointed."""
+    try:
+        mode = getattr(apsw, 'SQLITE_CHECKPOINT_' + mode.upper())
+    except AttributeError:
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+            'Invalid checkpoint mode %s' % mode)
+    conn = _getdbconnection(namespace)
+    try:
+        return conn.wal_checkpoint(mode=mode)
+    finally:
+        conn.close(True)
+
+##############################################################################
+# Maintenance.
+#
+# BackupNamespace copies a namespace to a file with the backup API while it
+# stays in use, and CompactNamespace hands the free pages left by deletes
+# back to the file system with incremental vacuum. Both work a few pages at
+# a time and pause in between, so that readers and writers are never held
+# up for long.
+
+# Pages copied or freed per step, and seconds to pause between steps
+_MAINTENANCE_STEP = 256
+_MAINTENANCE_PAUSE = 0.01
+
+_AUTO_VACUUM_MODES = ['none', 'full', 'incremental']
+
+##############################################################################
+def _pragma(conn, name):
+    cursor = conn.cursor()
+    return [x for x, in cursor.execute('PRAGMA %s' % name)][0]
+
+##############################################################################
+def BackupNamespace(namespace, Destination, PagesPerStep=None, Pause=None):
+    """Copy a namespace database to the file Destination, replacing it,
+    and its shard databases to files named after Destination.
+
+    The copy is a consistent snapshot of the namespace as of the start of
+    the backup. Writes made meanwhile go on and are not included. The
+    copy is made PagesPerStep pages at a time, with a pause of Pause
+    seconds between steps. Returns the number of pages copied."""
+    if PagesPerStep is None:
+        PagesPerStep = _MAINTENANCE_STEP
+    if Pause is None:
+        Pause = _MAINTENANCE_PAUSE
+    pool = _getpool(namespace)
+    memory = isinstance(pool, MemoryConnectionPool)
+    # A memory database is pinned by the checkout itself, which keeps
+    # writers out until it is checked in
+    conn = _getdbconnection(namespace)
+    try:
+        cursor = conn.cursor()
+        copies = [('main', Destination)] + \
+            _shard_names(Destination, conn.shards)
+        if not memory:
+            # Holding a read transaction pins the snapshot being copied
+            cursor.execute('BEGIN')
+            for db, fname in copies:
+                cursor.execute('select count(*) from %s.sqlite_master' %
+                    db).next()
+        pages = 0
+        for db, fname in copies:
+            dest = apsw.Connection(fname + '.tmp')
+            try:
+                backup = dest.backup('main', conn.conn, db)
+                try:
+                    while not backup.done:
+                        backup.step(PagesPerStep)
+                        if not backup.done and Pause and not memory:
+                            time.sleep(Pause)
+                    pages += backup.pagecount
+                finally:
+                    backup.finish()
+            finally:
+                dest.close(True)
+        if not memory:
+            cursor.execute('COMMIT')
+    finally:
+        conn.close(True)
+    for db, fname in copies:
+        os.rename(fname + '.tmp', fname)
+    return pages
+
+##############################################################################
+def _compact(namespace, Full, PagesPerStep, Pause):
+    dbname = _makedbname(namespace)
+    conn = _getdbconnection(namespace, write=True)
+    try:
+        before = sum([_pragma(conn, '%s.page_count' % db)
+            for db in _all_dbs(conn)])
+        if Full or _pragma(conn, 'auto_vacuum') != 2:
+            # Databases created before incremental vacuum was turned on
+            # need to be rebuilt once to use it
+            cursor = conn.cursor()
+            cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            cursor.execute('VACUUM')
+    finally:
+        conn.close(True)
+    while True:
+        conn = _getdbconnection(namespace, write=True)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                # Shard databases are always created for incremental
+                # vacuum
+                for db in _all_dbs(conn):
+                    for x in cursor.execute('PRAGMA %s.incremental_vacuum(%d)'
+                            % (db, PagesPerStep)):
+                        pass
+                cursor.execute('COMMIT')
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+            left = sum([_pragma(conn, '%s.freelist_count' % db)
+                for db in _all_dbs(conn)])
+            after = sum([_pragma(conn, '%s.page_count' % db)
+                for db in _all_dbs(conn)])
+        finally:
+            conn.close(True)
+        if not left:
+            break
+        if Pause:
+            time.sleep(Pause)
+    if dbname not in _memory_namespaces:
+        # The file shrinks when the log is copied into it
+        CheckpointNamespace(namespace)
+    return before - after
+
+##############################################################################
+def CompactNamespace(namespace, Full=False, Background=False,
+        PagesPerStep=None, Pause=None):
+    """Return the free pages of a namespace database to the file system,
+    PagesPerStep pages per transaction with a pause of Pause seconds in
+    between, and return how many there were. Reads go on meanwhile, and
+    writes between steps.
+
+    With Full, or the first time for a database created by an older
+    version, the database is first rebuilt with VACUUM, which also puts
+    the pages of every table back in order but holds up writers until it
+    is done. With Background the work is done by a thread of its own and
+    this returns None at once."""
+    if not _namespace_exists(namespace):
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE)
+    if PagesPerStep is None:
+        PagesPerStep = _MAINTENANCE_STEP
+    if Pause is None:
+        Pause = _MAINTENANCE_PAUSE
+    if not Background:
+        return _compact(namespace, Full, PagesPerStep, Pause)
+    t = threading.Thread(target=_compact,
+        args=(namespace, Full, PagesPerStep, Pause),
+        name='cimdb compact %s' % namespace)
+    t.setDaemon(True)
+    t.start()
+
+##############################################################################
+def GetNamespaceStatistics(namespace):
+    """Return the storage statistics of a namespace database: a dictionary
+    with its PageSize, PageCount and FreePages, Fragmentation, the share
+    of its pages that are free, its AutoVacuum mode ('none', 'full' or
+    'incremental'), and the FileBytes and WalBytes of its files on
+    disk. The pages and bytes include those of its Shards shard
+    databases."""
+    dbname = _makedbname(namespace)
+    conn = _getdbconnection(namespace)
+    try:
+        dbs = _all_dbs(conn)
+        files = [dbname] + [fname for db, fname in
+            _shard_names(dbname, conn.shards)]
+        stats = {'PageSize': _pragma(conn, 'page_size'),
+            'PageCount': sum([_pragma(conn, '%s.page_count' % db)
+                for db in dbs]),
+            'FreePages': sum([_pragma(conn, '%s.freelist_count' % db)
+                for db in dbs]),
+            'AutoVacuum': _AUTO_VACUUM_MODES[_pragma(conn, 'auto_vacuum')],
+            'Shards': len(dbs) - 1}
+    finally:
+        conn.close(True)
+    stats['Fragmentation'] = 0.0
+    if stats['PageCount']:
+        stats['Fragmentation'] = \
+            float(stats['FreePages']) / stats['PageCount']
+    stats['FileBytes'] = 0
+    stats['WalBytes'] = 0
+    for fname in files:
+        stats['FileBytes'] += os.path.getsize(fname)
+        if os.path.exists(fname + '-wal'):
+            stats['WalBytes'] += os.path.getsize(fname + '-wal')
+    return stats
+
+##############################################################################
+def _getdbconnection(namespace, write=False):
+    if not namespace:
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE,
+            'Namespace %s does not exist' % namespace)
+    pool = _getpool(namespace)
+    return pool.checkout(write)
+
+##############################################################################
+class _WriteRequest(object):
+    def __init__(self, fn):
+        self.fn = fn
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+##############################################################################
+class GroupCommitWriter(object):
+    """Applies the writes to a namespace on a single connection, committing
+    all the writes that are queued at the same time in one transaction.
+
+    Each write runs in a savepoint of its own, so that a failing write
+    is rolled back alone and only its caller sees the error. A batch is
+    committed once it has maxbatch writes, or maxlatency seconds after its
+    first write was queued, whichever comes first. Writes queued while a
+    batch commits go into the next one.
+    """
+    def __init__(self, pool, maxlatency, maxbatch):
+        self.pool = pool
+        self.maxlatency = maxlatency
+        self.maxbatch = maxbatch
+        self.queue = []
+        self.cond = threading.Condition(threading.Lock())
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run,
+            name='cimdb writer %s' % pool.dbname)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def submit(self, fn):
+        """Run fn(conn) in the next batch and return its result once the
+        batch is committed."""
+        req = _WriteRequest(fn)
+        self.cond.acquire()
+        try:
+            stopped = self.stopped
+            if not stopped:
+                self.queue.append(req)
+                self.cond.notify()
+        finally:
+            self.cond.release()
+        if stopped:
+            # Group commit was just turned off
+            conn = self.pool.checkout(write=True)
+            try:
+                return _write_transaction(conn, fn)
+            finally:
+                conn.close(True)
+        req.done.wait()
+        if req.exc_info is not None:
+            raise req.exc_info[0], req.exc_info[1], req.exc_info[2]
+        return req.result
+
+    def stop(self):
+        """Commit the writes that are already queued and end the writer
+        thread."""
+        self.cond.acquire()
+        try:
+            self.stopped = True
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        if threading.currentThread() is not self.thread:
+            self.thread.join()
+
+    def _next_batch(self):
+        self.cond.acquire()
+        try:
+            while not self.queue and not self.stopped:
+                self.cond.wait()
+            deadline = time.time() + self.maxlatency
+            while len(self.queue) < self.maxbatch and not self.stopped:
+                left = deadline - time.time()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            batch = self.queue[:self.maxbatch]
+            operator.delslice(self.queue, 0, len(batch))
+            return batch
+        finally:
+            self.cond.release()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            self._apply(batch)
+
+    def _apply(self, batch):
+        try:
+            conn = self.pool.checkout(write=True)
+        except:
+            exc_info = sys.exc_info()
+            for req in batch:
+                req.exc_info = exc_info
+                req.done.set()
+            return
+        cursor = conn.cursor()
+        try:
+            _begin_write(conn)
+            failed = False
+            for req in batch:
+                cursor.execute('SAVEPOINT groupcommit')
+                try:
+                    req.result = req.fn(conn)
+                except:
+                    req.exc_info = sys.exc_info()
+                    cursor.execute('ROLLBACK TO groupcommit')
+                    failed = True
+                cursor.execute('RELEASE groupcommit')
+            cursor.execute('COMMIT')
+        except:
+            exc_info = sys.exc_info()
+            failed = True
+            for req in batch:
+                if req.exc_info is None:
+                    req.exc_info = exc_info
+        try:
+            conn.close(True)
+            if failed:
+                # Forget what was cached from rolled back writes
+                _zdicts.invalidate(self.pool.dbname)
+                _qualcache.invalidate(self.pool.dbname)
+        finally:
+            for req in batch:
+                req.done.set()
+
+_writers = {}
+
+##############################################################################
+def SetGroupCommit(enable, maxlatency=None, maxbatch=None):
+    """Turn group commit on or off for all namespaces.
+
+    With group commit, CreateInstance, ModifyInstance, DeleteInstance and
+    SetQualifier calls made concurrently share transactions, and so
+    journal syncs. A call returns once its transaction has committed,
+    which takes at most about maxlatency seconds longer than a call of its
+    own would.
+    """
+    global _GROUPCOMMIT, _GROUPCOMMIT_LATENCY, _GROUPCOMMIT_BATCH
+    if maxlatency is not None:
+        _GROUPCOMMIT_LATENCY = maxlatency
+    if maxbatch is not None:
+        _GROUPCOMMIT_BATCH = max(1, maxbatch)
+    _GROUPCOMMIT = enable
+    _pools_lock.acquire()
+    try:
+        writers = _writers.values()
+        _writers.clear()
+    finally:
+        _pools_lock.release()
+    for writer in writers:
+        writer.stop()
+
+##############################################################################
+def _stopwriter(dbname):
+    _pools_lock.acquire()
+    try:
+        writer = _writers.pop(dbname, None)
+    finally:
+        _pools_lock.release()
+    if writer is not None:
+        writer.stop()
+
+##############################################################################
+def _run_write(namespace, fn):
+    """Call fn(conn) with a connection to namespace and return its result.
+    fn runs in a transaction of its own, or with group commit on, in the
+    namespace's writer thread, sharing its transaction with other
+    writes."""
+    if _GROUPCOMMIT:
+        pool = _getpool(namespace)
+        writer = _writers.get(pool.dbname)
+        if writer is None:
+            _pools_lock.acquire()
+            try:
+                writer = _writers.get(pool.dbname)
+                if writer is None:
+                    writer = GroupCommitWriter(pool, _GROUPCOMMIT_LATENCY,
+                        _GROUPCOMMIT_BATCH)
+                    _writers[pool.dbname] = writer
+            finally:
+                _pools_lock.release()
+        return writer.submit(fn)
+    conn = _getdbconnection(namespace, write=True)
+    try:
+        return _write_transaction(conn, fn)
+    finally:
+        conn.close(True)
+
+##############################################################################
+def _begin_write(conn):
+    """Begin a write transaction, and bring the caches up to date with the
+    changes other processes committed before it, so that the write goes
+    by the class storage that is current. If the shard databases changed,
+    the transaction is begun again once the connection has them
+    attached."""
+    cursor = conn.cursor()
+    while True:
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.pool.syncs:
+                _sync_caches(conn, conn.dbname)
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        if conn.generation[1] == conn.pool.shardgen:
+            return
+        cursor.execute('ROLLBACK')
+        conn.attach_shards()
+
+##############################################################################
+def _write_transaction(conn, fn):
+    """Call fn(conn) in a transaction of its own."""
+    cursor = conn.cursor()
+    _begin_write(conn)
+    try:
+        result = fn(conn)
+        cursor.execute('COMMIT')
+        return result
+    except:
+        cursor.execute('ROLLBACK')
+        # Forget what was cached from the rolled back write
+        _zdicts.invalidate(conn.dbname)
+        _qualcache.invalidate(conn.dbname)
+        raise
+
+##############################################################################
+class ClassCache(object):
+    """LRU cache of resolved classes, bounded by their pickled size.
+
+    Entries are keyed by (dbname, lower case class name, LocalOnly) and
+    are kept pickled, so every get() returns a private copy the caller is
+    free to filter or modify. Each namespace has a generation number that
+    invalidate() bumps; put() drops entries that were read from the
+    database under an older generation, so a reader racing with a schema
+    change cannot put a stale class back into the cache.
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def generation(self, dbname):
+        return self.generations.get(dbname, 0)
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            # Re-insert to mark as most recently used
+            self.entries[key] = entry
+        finally:
+            self.lock.release()
+        cid, data = entry
+        return (cid, pickle.loads(data))
+
+    def put(self, key, cid, theclass, generation):
+        if not self.maxbytes:
+            return
+        data = pickle.dumps(theclass, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.maxbytes:
+            return
+        self.lock.acquire()
+        try:
+            if generation != self.generations.get(key[0], 0):
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old[1])
+            self.entries[key] = (cid, data)
+            self.nbytes += len(data)
+            while self.nbytes > self.maxbytes:
+                k, (c, d) = self.entries.popitem(last=False)
+                self.nbytes -= len(d)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, dbname, classnames=None):
+        """Drop the given classes of a namespace, or all of its classes
+        if classnames is None."""
+        self.lock.acquire()
+        try:
+            self.generations[dbname] = self.generations.get(dbname, 0) + 1
+            if classnames is None:
+                keys = [k for k in self.entries.iterkeys() if k[0] == dbname]
+            else:
+                keys = []
+                for cname in classnames:
+                    cname = cname.lower()
+                    keys.append((dbname, cname, False))
+                    keys.append((dbname, cname, True))
+            for k in keys:
+                entry = self.entries.pop(k, None)
+                if entry is not None:
+                    self.nbytes -= len(entry[1])
+        finally:
+            self.lock.release()
+
+    def resize(self, maxbytes):
+        self.lock.acquire()
+        try:
+            self.maxbytes = maxbytes
+            while self.entries and self.nbytes > self.maxbytes:
+                k, (c, d) = self.entries.popitem(last=False)
+                self.nbytes -= len(d)
+        finally:
+            self.lock.release()
+
+_classcache = ClassCache(_CLASSCACHE_SIZE)
+
+##############################################################################
+def SetClassCacheSize(maxbytes):
+    """Set the maximum size, in pickled bytes, of the resolved class
+    cache. 0 disables the cache."""
+    _classcache.resize(maxbytes)
+
+##############################################################################
+def _invalidate_classes(namespace, classnames=None):
+    _classcache.invalidate(_makedbname(namespace), classnames)
+
+##############################################################################
+class GeneratorConnection(object):
+    """A connection held by a generator for its whole lifetime. Everything
+    read through it comes from a single snapshot of the database, taken
+    when it is created and released when it is closed."""
+    def __init__(self, connection):
+        self.conn = connection
+        self.dbname = connection.dbname
+        self.shards = connection.shards
+        self.cursors = []
+        cursor = self.cursor()
+        cursor.execute('BEGIN')
+        # The snapshot of each database starts with its first read
+        for db in _all_dbs(self):
+            cursor.execute('select count(*) from %s.sqlite_master' %
+                db).next()
+    def __del__(self):
+        self.close()
+    def close(self):
+        if self.cursors:
+            for c in self.cursors:
+                c.close(True)
+            operator.delslice(self.cursors, 0, len(self.cursors))
+        self.conn.close(True)
+    def cursor(self):
+        c = self.conn.cursor()
+        self.cursors.append(c)
+        return c
+
+##############################################################################
+def _get_generator_connection(namespace):
+    conn = _getdbconnection(namespace)
+    return GeneratorConnection(conn)
+
+##############################################################################
+def DeleteNamespace(namespace):
+    if not _namespace_exists(namespace):
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE)
+    _closepool(namespace)
+    dbname = _makedbname(namespace)
+    _memory_namespaces.pop(dbname, None)
+    os.remove(dbname)
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(dbname + suffix):
+            os.remove(dbname + suffix)
+    prefix = os.path.basename(os.path.splitext(dbname)[0]) + '@'
+    for fname in os.listdir(os.path.dirname(dbname)):
+        if fname.startswith(prefix) and '.shard' in fname:
+            os.remove(os.path.join(os.path.dirname(dbname), fname))
+    _invalidate_classes(namespace)
+    _qualcache.invalidate(_makedbname(namespace))
+    _zdicts.invalidate(_makedbname(namespace))
+    _layouts.pop(_makedbname(namespace), None)
+    _propindexes.pop(_makedbname(namespace), None)
+    _synced.pop(dbname, None)
+        
+##############################################################################
+def CreateNamespace(namespace):
+    if _namespace_exists(namespace):
+        raise pywbem.CIMError(pywbem.CIM_ERR_ALREADY_EXISTS)
+    # Create db for namespace
+    conn = _createdb(_makedbname(namespace))
+    conn.close(True)
+
+##############################################################################
+def Namespaces():
+    for fname in os.listdir(_REPDIR):
+        if fname.endswith('.db'):
+            fname = fname[0:-3]
+            name = '/'.join(fname.split('~'))
+            if _namespace_exists(name):
+                yield name
+
+##############################################################################
+# Change log.
+#
+# Every write appends rows to the ChangeLog of its namespace, in its own
+# transaction, numbered by the namespace's change sequence. Someone who
+# remembers the last sequence number they have seen can ask ReadChanges what
+# changed since: every connection checkout does that, through the
+# ChangeLogMetaNDX index of the changes other than to instances, to drop
+# what the caches of this process hold about classes, qualifiers and
+# storage that other processes changed. Rows older than the retention set
+# by SetChangeLogRetention are trimmed as the log grows, and
+# CompactChangeLog can also drop the rows superseded by a later change of
+# the same object.
+
+# What changed: a class, a qualifier declaration, an instance, the storage
+# layout of a class, or the property indexes of a class
+CHANGE_CLASS = 'class'
+CHANGE_QUALIFIER = 'qualifier'
+CHANGE_INSTANCE = 'instance'
+CHANGE_LAYOUT = 'layout'
+CHANGE_INDEX = 'index'
+
+CHANGE_CREATE = 'create'
+CHANGE_MODIFY = 'modify'
+CHANGE_DELETE = 'delete'
+
+# {dbname: last change sequence number seen by SyncCaches}
+_synced = {}
+
+##############################################################################
+def _next_change(conn, count=1):
+    """Hand out count change sequence numbers, within the caller's write
+    transaction, and return the last one."""
+    cursor = conn.cursor()
+    cursor.execute('update ChangeSequence set seq=seq+?', (count,))
+    return [x for x, in cursor.execute('select seq from ChangeSequence')][0]
+
+##############################################################################
+def _log_changes(conn, changes):
+    """Append (kind, op, name, key string, encoded path) changes to the
+    change log and return the sequence number of the last one."""
+    seq = _next_change(conn, len(changes))
+    first = seq - len(changes) + 1
+    now = time.time()
+    cursor = conn.cursor()
+    cursor.executemany('insert into ChangeLog values(?,?,?,?,?,?,?)',
+        [(first + i, now) + change for i, change in enumerate(changes)])
+    if seq // _CHANGELOG_TRIM_INTERVAL != \
+            (first - 1) // _CHANGELOG_TRIM_INTERVAL:
+        _trim_changes(conn, seq, now)
+    return seq
+
+##############################################################################
+def _log_change(conn, kind, op, name, strkey=None, path=None):
+    return _log_changes(conn, [(kind, op, name, strkey, path)])
+
+##############################################################################
+def _trim_changes(conn, seq, now):
+    """Drop the changes that are past the retention limits."""
+    cursor = conn.cursor()
+    horizon = 0
+    if _CHANGELOG_MAXCHANGES:
+        horizon = seq - _CHANGELOG_MAXCHANGES
+    if _CHANGELOG_MAXAGE:
+        kept = [x for x, in cursor.execute('select seq from ChangeLog where '
+            'time>=? order by seq limit 1', (now - _CHANGELOG_MAXAGE,))]
+        horizon = max(horizon, (kept or [seq + 1])[0] - 1)
+    if horizon > 0:
+        cursor.execute('delete from ChangeLog where seq<=?', (horizon,))
+        cursor.execute('update ChangeLogHorizon set seq=max(seq,?)',
+            (horizon,))
+
+##############################################################################
+def SetChangeLogRetention(MaxChanges=None, MaxAge=None):
+    """Set how many of the latest changes the change log of a namespace
+    keeps, and for how many seconds, 0 meaning no limit. Older changes are
+    dropped from time to time as changes are made, or by
+    CompactChangeLog."""
+    global _CHANGELOG_MAXCHANGES, _CHANGELOG_MAXAGE
+    if MaxChanges is not None:
+        _CHANGELOG_MAXCHANGES = MaxChanges
+    if MaxAge is not None:
+        _CHANGELOG_MAXAGE = MaxAge
+
+##############################################################################
+def GetChangeSequence(namespace):
+    """Return the sequence number of the last change made to a
+    namespace."""
+    conn = _getdbconnection(namespace)
+    try:
+        cursor = conn.cursor()
+        return [x for x, in cursor.execute('select seq from '
+            'ChangeSequence')][0]
+    finally:
+        conn.close(True)
+
+##############################################################################
+def ReadChanges(namespace, Since=0, MaxCount=None):
+    """Return the changes made to a namespace after the change sequence
+    number Since, oldest first and at most MaxCount of them, as (sequence
+    number, time, kind, operation, name, instance name) tuples. kind is
+    one of the CHANGE_ kinds and operation one of CHANGE_CREATE,
+    CHANGE_MODIFY and CHANGE_DELETE. name is the name of the class or
+    qualifier declaration, and the instance name is None except for
+    instance changes. Deleting a class changes it and its subclasses, and
+    deletes their instances; modifying a class changes its subclasses.
+
+    Returns None if changes made after Since were dropped from the change
+    log, in which case everything may have changed."""
+    conn = _getdbconnection(namespace)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        try:
+            horizon = [x for x, in cursor.execute('select seq from '
+                'ChangeLogHorizon')][0]
+            if Since < horizon:
+                return None
+            sql = 'select seq,time,kind,op,name,path from ChangeLog where ' \
+                'seq>? order by seq'
+            args = [Since]
+            if MaxCount is not None:
+                sql += ' limit ?'
+                args.append(MaxCount)
+            rows = [x for x in cursor.execute(sql, args)]
+        finally:
+            cursor.execute('COMMIT')
+        return [(seq, t, kind, op, name, path and _decode(path) or None)
+            for seq, t, kind, op, name, path in rows]
+    finally:
+        conn.close(True)
+
+##############################################################################
+def CompactChangeLog(namespace, Coalesce=False):
+    """Drop the changes of a namespace that are past the retention limits,
+    and with Coalesce, every change followed by a later change of the same
+    object. A coalesced log still tells what changed since any point, but
+    not every change that was made."""
+    conn = _getdbconnection(namespace, write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            seq = [x for x, in cursor.execute('select seq from '
+                'ChangeSequence')][0]
+            _trim_changes(conn, seq, time.time())
+            if Coalesce:
+                seen = set()
+                stale = []
+                for seq, kind, name, strkey in cursor.execute('select seq,'
+                        'kind,name,strkey from ChangeLog order by seq desc'):
+                    key = (kind, name.lower(), strkey)
+                    if kind == CHANGE_INSTANCE:
+                        key = (kind, strkey)
+                    if key in seen:
+                        stale.append((seq,))
+                    else:
+                        seen.add(key)
+                cursor.executemany('delete from ChangeLog where seq=?', stale)
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close(True)
+
+##############################################################################
+def _drop_caches(dbname, classnames=None):
+    """Forget what is cached about the classes of a namespace, or about
+    everything in it if classnames is None."""
+    _classcache.invalidate(dbname, classnames)
+    _zdicts.invalidate(dbname, classnames)
+    _layouts.pop(dbname, None)
+    _propindexes.pop(dbname, None)
+    _reset_shards(dbname)
+    if classnames is None:
+        _qualcache.invalidate(dbname)
+
+##############################################################################
+def SyncCaches(namespace):
+    """Bring the caches of this process up to date with the changes made to
+    a namespace by other processes, and return the sequence number of the
+    last change taken into account. This is done on every connection
+    checkout, so there is no need to call it."""
+    conn = _getdbconnection(namespace)
+    try:
+        return _sync_caches(conn, conn.dbname)
+    finally:
+        conn.close(True)
+
+##############################################################################
+def _sync_caches(conn, dbname):
+    # The partial index ChangeLogMetaNDX has the changes that are not to
+    # instances, so neither finding out that nothing changed nor reading
+    # what did depends on the number of instance changes
+    since = _synced.get(dbname)
+    cursor = conn.cursor()
+    autocommit = conn.getautocommit()
+    if autocommit:
+        cursor.execute('BEGIN')
+    try:
+        seq, horizon, last = cursor.execute('select (select seq from '
+            'ChangeSequence),(select seq from ChangeLogHorizon),'
+            '(select max(seq) from ChangeLog INDEXED BY ChangeLogMetaNDX '
+            "where kind!='instance')").next()
+        if since is None or since < horizon or since > seq:
+            # The caches may hold anything, or the database was replaced
+            _drop_caches(dbname)
+        elif last is not None and last > since:
+            classnames = set()
+            for kind, name in cursor.execute('select kind,name from '
+                    'ChangeLog INDEXED BY ChangeLogMetaNDX where '
+                    "kind!='instance' and seq>? order by seq", (since,)):
+                if kind == CHANGE_QUALIFIER:
+                    _qualcache.invalidate(dbname)
+                elif kind == CHANGE_LAYOUT:
+                    _layouts.pop(dbname, None)
+                    _reset_shards(dbname)
+                elif kind == CHANGE_INDEX:
+                    _propindexes.pop(dbname, None)
+                elif kind == CHANGE_CLASS:
+                    classnames.add(name)
+            if classnames:
+                _drop_caches(dbname, list(classnames))
+    finally:
+        if autocommit:
+            cursor.execute('COMMIT')
+        cursor.close(True)
+    _synced[dbname] = max(_synced.get(dbname, 0), seq)
+    return seq
+
+##############################################################################
+class QualifierCache(object):
+    """In-memory copy of the QualifierTypes table of each namespace.
+
+    A namespace's table is loaded in one query the first time it is
+    needed and then kept in sync by SetQualifier and DeleteQualifier.
+    Tables are replaced rather than modified, so a reader iterating over
+    one is never disturbed by a concurrent update.
+    """
+    def __init__(self):
+        self.tables = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, dbname):
+        return self.tables.get(dbname)
+
+    def load(self, conn, dbname):
+        generation = self.generations.get(dbname, 0)
+        table = {}
+        cursor = conn.cursor()
+        for name, data in cursor.execute(
+                'select name,data from QualifierTypes'):
+            table[name.lower()] = _decode(data)
+        self.lock.acquire()
+        try:
+            if generation == self.generations.get(dbname, 0):
+                self.tables[dbname] = table
+        finally:
+            self.lock.release()
+        return table
+
+    def _update(self, dbname, fn):
+        self.lock.acquire()
+        try:
+            self.generations[dbname] = self.generations.get(dbname, 0) + 1
+            table = self.tables.get(dbname)
+            if table is not None:
+                table = dict(table)
+                fn(table)
+                self.tables[dbname] = table
+        finally:
+            self.lock.release()
+
+    def set(self, dbname, qualdecl):
+        def _set(table):
+            table[qualdecl.name.lower()] = qualdecl
+        self._update(dbname, _set)
+
+    def delete(self, dbname, qualname):
+        def _delete(table):
+            table.pop(qualname.lower(), None)
+        self._update(dbname, _delete)
+
+    def invalidate(self, dbname):
+        self.lock.acquire()
+        try:
+            self.generations[dbname] = self.generations.get(dbname, 0) + 1
+            self.tables.pop(dbname, None)
+        finally:
+            self.lock.release()
+
+_qualcache = QualifierCache()
+
+##############################################################################
+class TableCache(object):
+    """A table read from a namespace database and kept per namespace.
+
+    As in QualifierCache, every pop() bumps the namespace's generation,
+    and put() drops a table that was read under an older one, so a reader
+    racing with SyncCaches cannot put back what it dropped.
+    """
+    def __init__(self):
+        self.tables = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def generation(self, dbname):
+        return self.generations.get(dbname, 0)
+
+    def get(self, dbname):
+        return self.tables.get(dbname)
+
+    def put(self, dbname, generation, table):
+        self.lock.acquire()
+        try:
+            if generation == self.generations.get(dbname, 0):
+                self.tables[dbname] = table
+        finally:
+            self.lock.release()
+
+    def pop(self, dbname, default=None):
+        self.lock.acquire()
+        try:
+            self.generations[dbname] = self.generations.get(dbname, 0) + 1
+            return self.tables.pop(dbname, default)
+        finally:
+            self.lock.release()
+
+##############################################################################
+def _qualifier_types(namespace, Connection=None):
+    """Return the cached {lower case name: CIMQualifierDeclaration} table
+    of a namespace. The returned table and declarations must not be
+    modified."""
+    if not namespace:
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE,
+            'Namespace %s does not exist' % namespace)
+    dbname = _makedbname(namespace)
+    # Checking a connection out brings the cache up to date
+    conn = Connection or _getdbconnection(namespace)
+    try:
+        table = _qualcache.get(dbname)
+        if table is None:
+            table = _qualcache.load(conn, dbname)
+    finally:
+        Connection or conn.close(True)
+    return table
+
+##############################################################################
+def GetQualifier(QualifierName, namespace, Connection=None):
+    qualtypes = _qualifier_types(namespace, Connection)
+    try:
+        cqt = qualtypes[QualifierName.lower()]
+    except KeyError:
+        raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
+    return cqt.copy()
+
+##############################################################################
+def SetQualifier(QualifierDeclaration, namespace):
+    def set_qualifier(conn):
+        cursor = conn.cursor()
+        pargq = _encode(QualifierDeclaration)
+        qualtypes = _qualifier_types(namespace, conn)
+        if QualifierDeclaration.name.lower() in qualtypes:
+            cursor.execute('update QualifierTypes set data=? where name=?',
+                (pargq, QualifierDeclaration.name))
+            op = CHANGE_MODIFY
+        else:
+            cursor.execute('insert into QualifierTypes values(?,?)',
+                (QualifierDeclaration.name, pargq))
+            op = CHANGE_CREATE
+        _log_change(conn, CHANGE_QUALIFIER, op, QualifierDeclaration.name)
+    _run_write(namespace, set_qualifier)
+    _qualcache.set(_makedbname(namespace), QualifierDeclaration.copy())
+
+##############################################################################
+def DeleteQualifier(QualifierName, namespace):
+    conn = _getdbconnection(namespace, write=True)
+    try:
+        cursor = conn.cursor()
+        if QualifierName.lower() not in _qualifier_types(namespace, conn):
+            raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute(
+                'delete from QualifierTypes where name=?', (QualifierName,))
+            _log_change(conn, CHANGE_QUALIFIER, CHANGE_DELETE, QualifierName)
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        conn.close(True)
+        _qualcache.delete(_makedbname(namespace), QualifierName)
+    except:
+        conn.close(True)
+        raise
+
+##############################################################################
+def EnumerateQualifiers(namespace):
+    for qt in _qualifier_types(namespace).itervalues():
+        yield qt.copy()
+
+##############################################################################
+def _valid_qualifier(conn, qualname, namespace):
+    return _qualifier_types(namespace, conn).get(qualname.lower())
+
+##############################################################################
+def _verify_qualifier_set(qualtypes, qualset):
+    for qualname,qual in qualset.iteritems():
+        try:
+            qt = qualtypes[qualname.lower()]
+        except KeyError:
+            raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                'Qualifier %s is invalid' % qualname)
+        # Set flavors to defaults if not specified
+        if qual.overridable is None:
+            qual.overridable = qt.overridable
+        if qual.tosubclass is None:
+            qual.tosubclass = qt.tosubclass
+        if qual.translatable is None:
+            qual.translatable = qt.translatable
+        if qual.toinstance is None:
+            qual.toinstance = qt.toinstance
+
+##############################################################################
+def _verify_qualifiers(conn, theclass, namespace):
+    _verify_class_qualifiers(_qualifier_types(namespace, conn), theclass)
+
+##############################################################################
+def _verify_class_qualifiers(qualtypes, theclass):
+    # Verify class qualifiers
+    _verify_qualifier_set(qualtypes, theclass.qualifiers)
+
+    # Verify property qualifiers
+    for prop in theclass.properties.itervalues():
+        _verify_qualifier_set(qualtypes, prop.qualifiers)
+
+    # Verify method qualifiers
+    for meth in theclass.methods.itervalues():
+        _verify_qualifier_set(qualtypes, meth.qualifiers)
+
+##############################################################################
+def _adjust_root_class(theclass):
+    for qual in theclass.qualifiers.itervalues():
+        qual.propagated = False
+    for prop in theclass.properties.itervalues():
+        prop.propagated = False
         prop.class_origin = theclass.classname
     for meth in theclass.methods.itervalues():
         meth.propagated = False
@@ -248,164 +2332,709 @@ def _adjust_root_class(theclass):
     return theclass
 
 ##############################################################################
-# Assumption: parent_class has already been resolved
-def _adjust_child_class(child_class, parent_class):
-    # Sync quals
-    quals = pywbem.NocaseDict()
+# Assumption: parent_class has already been resolved
+def _adjust_child_class(child_class, parent_class):
+    # Sync quals
+    quals = pywbem.NocaseDict()
+
+    # Make sure 
+    if 'association' in child_class.qualifiers and \
+            'association' not in parent_class.qualifiers:
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+            'Association class %s is derived from not Association class %s' % \
+                (child_class.classname, parent_class.classname))
+    is_association = 'association' in parent_class.qualifiers
+
+    for child_qual_name, child_qual in child_class.qualifiers.iteritems():
+        # Is the child qualifier in the parent class
+        if child_qual_name in parent_class.qualifiers:
+            parent_qual = parent_class.qualifiers[child_qual_name]
+            # If the value of the qual is not the same, we save it if the
+            # qual is overridable
+            if parent_qual.value != child_qual.value or \
+                    parent_qual.tosubclass is False:
+                if parent_qual.overridable is False: # None means True
+                    # Child can change this qualifier because it is not
+                    # overridable by subclasses
+                    raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                        'Parent class qualifier %s does not have OVERRIDABLE '
+                        'flavor. Child cannot override it' % child_qual_name)
+                quals[child_qual_name] = child_qual
+        else:
+            quals[child_qual_name] = child_qual
+    child_class.qualifiers = quals
+
+    # Sync properties
+    parent_has_keys = None
+    props = pywbem.NocaseDict()
+    for child_prop_name, child_prop in child_class.properties.iteritems():
+        if child_prop_name not in parent_class.properties:
+            # This property was introduced by the child class.
+
+            # If ref and this is not an association, raise and exception
+            if not is_association and child_prop.type == 'reference':
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                    'Reference property an only be defined in an Association '
+                    'class')
+
+            # If it is a key property, make sure no keys have been defined
+            # in any superclass
+            if 'key' in child_prop.qualifiers:
+                if parent_has_keys is None:
+                    parent_has_keys = False
+                    for p in parent_class.properties.itervalues():
+                        if 'key' in p.qualifiers:
+                            parent_has_keys = True
+                            break
+                if parent_has_keys:
+                    raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                        'Parent class has keys. Child cannot define '
+                        'additional key properties. Child class: %s '
+                        'property name: %s' % \
+                        (child_class.classname, child_prop.name))
+            child_prop.class_origin = child_class.classname
+            child_prop.propagated = False
+            props[child_prop_name] = child_prop
+            continue
+
+        # This property is in the parent and child class
+        parent_prop = parent_class.properties[child_prop_name]
+
+        # If child did not override this property, then don't
+        # save it unless it has a different default value
+        if 'override' not in child_prop.qualifiers:
+            if child_prop.value:
+                if parent_prop.value and child_prop.value != parent_prop.value:
+                    child_prop.propagated = True
+                    child_prop.class_origin = parent_prop.class_origin
+                    props[child_prop_name] = parent_prop.copy()
+                    props[child_prop_name].value = child_prop.value
+            continue
+
+        # Child as specified 'override' on this property
+
+        # Turn off 'tosubclass' for the override qual so children of
+        # this class don't automatically get it (They have to
+        # explicitly specify 'override'
+        child_prop.qualifiers['override'].tosubclass = False
+        if not child_prop.class_origin:
+            child_prop.class_origin = child_class.classname
+            child_prop.propagated = False
+        else:
+            child_prop.class_origin = parent_class.classname
+            child_prop.propagated = True
+
+        # Make sure the quals are set on the overridden property
+        for parent_prop_qual_name, parent_prop_qual in \
+                parent_prop.qualifiers.iteritems():
+            if not parent_prop_qual.overridable:
+                if parent_prop_qual_name not in child_prop.qualifiers:
+                    child_prop.qualifiers[parent_prop_qual_name] = \
+                        parent_prop_qual
+                else:
+                    # Qual is not overridable but it is on the child
+                    # property. Probably need to tell the caller that
+                    # this condition exists, but we're going to
+                    # silently set it to the parent's qual
+                    child_prop.qualifiers[parent_prop_qual_name] = \
+                        parent_prop_qual
+            # Parent does allow override of qualifier.
+            # If the qual has tosubclass (not restricted), then only
+            # propagate it down if it's not overridden in the subclass
+            elif parent_prop_qual.tosubclass:
+                if parent_prop_qual_name not in child_prop.qualifiers:
+                    child_prop.qualifiers[parent_prop_qual_name] = \
+                        parent_prop_qual
+
+        props[child_prop_name] = child_prop
+    child_class.properties = props
+
+    # properties now sync'ed. Now sync methods
+    # TODO. Should do more validation here
+    meths = pywbem.NocaseDict()
+    for child_meth_name, child_method in child_class.methods.iteritems():
+        if child_meth_name not in parent_class.methods:
+            child_method.propagated = False
+            child_method.class_origin = child_class.classname
+            meths[child_meth_name] = child_method
+            continue
+        if child_method.qualifiers.has_key('override'):
+            child_method.propagated = True
+            child_method.class_origin = parent_class.classname
+    child_class.methods = meths
+    return child_class
+
+##############################################################################
+def CreateClass(NewClass, namespace):
+    conn = _getdbconnection(namespace, write=True)
+    try: 
+        cursor = conn.cursor()
+        # Make sure the class doesn't already exist
+        cursor.execute('select cid from Classes where name=?',
+            (NewClass.classname,))
+        try:
+            cursor.next()
+            cursor.close(True)
+            conn.close(True)
+            raise pywbem.CIMError(pywbem.CIM_ERR_ALREADY_EXISTS)
+        except StopIteration:
+            pass
+
+        # Validate all quals in class
+        _verify_qualifiers(conn, NewClass, namespace)
+
+        # If there is a super class then synchronize the class
+        # with the super class
+        if NewClass.superclass:
+            try:
+                scid, scc = _get_class(conn, NewClass.superclass, namespace,
+                    LocalOnly=False, IncludeQualifiers=True,
+                    IncludeClassOrigin=True)
+            except pywbem.CIMError, ce:
+                if ce.args[0] == pywbem.CIM_ERR_NOT_FOUND:
+                    raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_SUPERCLASS,
+                            NewClass.superclass)
+                raise
+            NewClass = _adjust_child_class(NewClass, scc)
+            resolved = _merge_classes(NewClass, scc)
+        else:
+            # There is no super class
+            NewClass = _adjust_root_class(NewClass)
+            resolved = NewClass
+
+        pcc = _encode(NewClass)
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('insert into Classes values(NULL,?,?)',
+                (NewClass.classname, pcc))
+        cid = conn.last_insert_rowid()
+        cursor.execute('insert into ResolvedClasses values(?,?)',
+                (cid, _encode(resolved)))
+        _store_refinfo(conn, cid, resolved)
+        if NewClass.superclass:
+            # create a single SuperClasses row for this class and its immediate
+            # parent class
+            cursor.execute('insert into SuperClasses values(?,?,1);',
+                    (cid, scid))
+            # Now create all the SuperClasses rows for any super classes of the
+            # given class's super class
+            cursor.execute('insert into SuperClasses select ?,supercid,'
+                    'depth+1 from SuperClasses where subcid=?', (cid, scid))
+        _log_change(conn, CHANGE_CLASS, CHANGE_CREATE, NewClass.classname)
+        cursor.execute('COMMIT')
+        conn.close(True)
+        _invalidate_classes(namespace, [NewClass.classname])
+    except:
+        conn.close(True)
+        raise
+
+##############################################################################
+def ModifyClass(ModifiedClass, namespace):
+    conn = _getdbconnection(namespace, write=True)
+    try: 
+        # Ensure the class exists
+        try:
+            oldcid, oldcc = _get_bare_class(conn, thename=ModifiedClass.classname)
+        except TypeError:
+            raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
+
+        # Make sure all the quals are valid
+        _verify_qualifiers(conn, ModifiedClass, namespace)
+
+        if ModifiedClass.superclass:
+            if ModifiedClass.superclass.lower() != oldcc.superclass.lower():
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                    'Cannot change superclass when modifying class %s' \
+                    % (ModifiedClass.superclass))
+            try:
+                scid, scc = _get_class(conn, ModifiedClass.superclass, namespace,
+                    LocalOnly=False, IncludeQualifiers=True,
+                    IncludeClassOrigin=True)
+            except pywbem.CIMError:
+                # This shouldn't happen
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                    'Invalid super class %s' % (ModifiedClass.superclass))
+            ModifiedClass = _adjust_child_class(ModifiedClass, scc)
+        else:
+            ModifiedClass = _adjust_root_class(ModifiedClass)
+
+        cursor = conn.cursor()
+        pcc = _encode(ModifiedClass)
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('update Classes set data=? where name=?',
+            (pcc, ModifiedClass.classname))
+        # Re-resolve the class and all of its subclasses
+        if ModifiedClass.superclass:
+            resolved = _merge_classes(_decode(pcc), scc)
+        else:
+            resolved = _decode(pcc)
+        _materialize_classes(conn, oldcid, resolved)
+        # The resolved form of every subclass includes this class
+        stale = [x for x, in cursor.execute('select name from Classes '
+                'where cid in (select subcid from SuperClasses where '
+                'supercid=?);', (oldcid,))]
+        stale.append(ModifiedClass.classname)
+        _log_changes(conn, [(CHANGE_CLASS, CHANGE_MODIFY, cname, None, None)
+            for cname in stale])
+        cursor.execute('COMMIT')
+        conn.close(True)
+        _invalidate_classes(namespace, stale)
+    except:
+        conn.close(True)
+        raise
+    
+##############################################################################
+def _get_bare_class(conn, thename=None, thecid=None):
+    cc = None
+    try:
+        cursor = conn.cursor()
+        if thename is not None:
+            cursor.execute('select cid,data from Classes where name=?',
+                (thename,))
+        else:
+            cursor.execute('select cid,data from Classes where cid=?',
+                (thecid,))
+        try:
+            cid,data = cursor.next()
+            theclass = _decode(data)
+            cursor.close(True)
+            cc = (cid,theclass)
+        except StopIteration:
+            pass
+    except:
+        pass
+    return cc
+
+##############################################################################
+def _merge_classes(child_class, parent_class):
+    for k, v in parent_class.qualifiers.items():
+        if v.tosubclass is False:
+            del parent_class.qualifiers[k]
+    parent_class.qualifiers.update(child_class.qualifiers)
+    parent_class.properties.update(child_class.properties)
+    parent_class.methods.update(child_class.methods)
+    parent_class.superclass = parent_class.classname
+    parent_class.classname = child_class.classname
+    return parent_class
 
-    # Make sure 
-    if 'association' in child_class.qualifiers and \
-            'association' not in parent_class.qualifiers:
-        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
-            'Association class %s is derived from not Association class %s' % \
-                (child_class.classname, parent_class.classname))
-    is_association = 'association' in parent_class.qualifiers
+##############################################################################
+def _filter_class(cim_class, IncludeQualifiers, IncludeClassOrigin,
+    PropertyList):
+    if IncludeQualifiers and IncludeClassOrigin and PropertyList is None:
+        return cim_class
+    if not IncludeQualifiers:
+        cim_class.qualifiers = pywbem.NocaseDict()
+    data = cim_class.properties.data
+    if PropertyList is not None:
+        names = _property_set(PropertyList)
+        for lname in [x for x in data if x not in names]:
+            del data[lname]
+    if not (IncludeQualifiers and IncludeClassOrigin):
+        for name, prop in data.itervalues():
+            if not IncludeQualifiers:
+                prop.qualifiers = pywbem.NocaseDict()
+            if not IncludeClassOrigin:
+                prop.class_origin = None
 
-    for child_qual_name, child_qual in child_class.qualifiers.iteritems():
-        # Is the child qualifier in the parent class
-        if child_qual_name in parent_class.qualifiers:
-            parent_qual = parent_class.qualifiers[child_qual_name]
-            # If the value of the qual is not the same, we save it if the
-            # qual is overridable
-            if parent_qual.value != child_qual.value or \
-                    parent_qual.tosubclass is False:
-                if parent_qual.overridable is False: # None means True
-                    # Child can change this qualifier because it is not
-                    # overridable by subclasses
-                    raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
-                        'Parent class qualifier %s does not have OVERRIDABLE '
-                        'flavor. Child cannot override it' % child_qual_name)
-                quals[child_qual_name] = child_qual
-        else:
-            quals[child_qual_name] = child_qual
-    child_class.qualifiers = quals
+    for meth in cim_class.methods.itervalues():
+        if not IncludeQualifiers:
+            meth.qualifiers = pywbem.NocaseDict()
+        if not IncludeClassOrigin:
+            meth.class_origin = None
 
-    # Sync properties
-    parent_has_keys = None
-    props = pywbem.NocaseDict()
-    for child_prop_name, child_prop in child_class.properties.iteritems():
-        if child_prop_name not in parent_class.properties:
-            # This property was introduced by the child class.
+    return cim_class
+        
+##############################################################################
+def _resolve_class(conn, name, LocalOnly):
+    if LocalOnly:
+        t = _get_bare_class(conn, thename=name)
+    else:
+        t = None
+        cursor = conn.cursor()
+        for cid, data in cursor.execute('select c.cid,r.data from Classes c '
+                'join ResolvedClasses r on r.cid=c.cid where c.name=?',
+                (name,)):
+            t = (cid, _decode(data))
+    if t is None:
+        raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
+    return t
 
-            # If ref and this is not an association, raise and exception
-            if not is_association and child_prop.type == 'reference':
-                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
-                    'Reference property an only be defined in an Association '
-                    'class')
+##############################################################################
+def _materialize_classes(conn, thecid, thecc):
+    """Store the resolved form of class thecid, whose resolved class is
+    thecc, and of all of its subclasses in ResolvedClasses."""
+    cursor = conn.cursor()
+    rows = []
+    for cid, cc in _walk_class_tree(conn, thecid, thecc):
+        rows.append((cid, _encode(cc)))
+        _store_refinfo(conn, cid, cc)
+    cursor.executemany('insert or replace into ResolvedClasses values(?,?)',
+        rows)
 
-            # If it is a key property, make sure no keys have been defined
-            # in any superclass
-            if 'key' in child_prop.qualifiers:
-                if parent_has_keys is None:
-                    parent_has_keys = False
-                    for p in parent_class.properties.itervalues():
-                        if 'key' in p.qualifiers:
-                            parent_has_keys = True
-                            break
-                if parent_has_keys:
-                    raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
-                        'Parent class has keys. Child cannot define '
-                        'additional key properties. Child class: %s '
-                        'property name: %s' % \
-                        (child_class.classname, child_prop.name))
-            child_prop.class_origin = child_class.classname
-            child_prop.propagated = False
-            props[child_prop_name] = child_prop
+##############################################################################
+def _store_refinfo(conn, cid, resolved):
+    """Record the reference properties of resolved class cid in RefInfo,
+    with the cid of the class each one refers to."""
+    cursor = conn.cursor()
+    cursor.execute('delete from RefInfo where assoccid=?', (cid,))
+    for prop in resolved.properties.itervalues():
+        if prop.type != 'reference' or not prop.reference_class:
             continue
+        for refcid, in cursor.execute('select cid from Classes where '
+                'name=?', (prop.reference_class,)):
+            cursor.execute('insert or replace into RefInfo values(?,?,?)',
+                (cid, refcid, prop.name))
 
-        # This property is in the parent and child class
-        parent_prop = parent_class.properties[child_prop_name]
+##############################################################################
+def _get_class(conn, name, namespace, LocalOnly=False, IncludeQualifiers=True,
+        IncludeClassOrigin=True, PropertyList=None):
+    dbname = _makedbname(namespace)
+    key = (dbname, name.lower(), bool(LocalOnly))
+    t = _classcache.get(key)
+    if t is None:
+        generation = _classcache.generation(dbname)
+        t = _resolve_class(conn, name, LocalOnly)
+        _classcache.put(key, t[0], t[1], generation)
+    thecid,thecc = t
+    return (thecid, _filter_class(thecc, IncludeQualifiers, IncludeClassOrigin,
+                    PropertyList))
+
+##############################################################################
+def GetClass(ClassName, namespace, LocalOnly=True, IncludeQualifiers=True,
+        IncludeClassOrigin=False, PropertyList=None, Connection=None):
+    conn = Connection or _getdbconnection(namespace)
+    try:
+        tp = _get_class(conn, ClassName, namespace, LocalOnly, IncludeQualifiers,
+            IncludeClassOrigin, PropertyList)
+        Connection or conn.close(True)
+        return tp[1]
+    except:
+        Connection or conn.close(True)
+        raise
+
+##############################################################################
+def _walk_class_tree(conn, thecid, thecc):
+    """Yield (cid, resolved class) for thecc and all of its subclasses,
+    parents before their children.
+
+    thecc must already be resolved. Each subclass is resolved by merging
+    its local form into a copy of its resolved parent, so every class is
+    decoded and merged exactly once. Only the pickled resolved classes
+    along the current path, and the cids of their pending subclasses, are
+    held in memory. The yielded classes may be modified by the caller.
+    """
+    cursor = conn.cursor()
+    childsql = 'select subcid from SuperClasses where supercid=? and depth=1'
+    path = []
+    cid, cc = thecid, thecc
+    while True:
+        kids = [x for x, in cursor.execute(childsql, (cid,))]
+        if kids:
+            kids.reverse()
+            path.append((pickle.dumps(cc, pickle.HIGHEST_PROTOCOL), kids))
+        yield (cid, cc)
+        while path and not path[-1][1]:
+            path.pop()
+        if not path:
+            return
+        parent, kids = path[-1]
+        cid = kids.pop()
+        data, = cursor.execute('select data from Classes where cid=?',
+                (cid,)).next()
+        cc = _merge_classes(_decode(data), pickle.loads(parent))
+
+##############################################################################
+def EnumerateClasses(ClassName=None, namespace=None, DeepInheritance=False, LocalOnly=True,
+        IncludeQualifiers=True, IncludeClassOrigin=False):
+    conn = _get_generator_connection(namespace)
+    cursor = conn.cursor()
+    if not ClassName:
+        try:
+            if DeepInheritance and not LocalOnly:
+                # Super classes are always created before their subclasses
+                for data, in cursor.execute('select data from '
+                        'ResolvedClasses order by cid;'):
+                    yield _filter_class(_decode(data), IncludeQualifiers,
+                        IncludeClassOrigin, None)
+            elif DeepInheritance:
+                for cname, in cursor.execute('select name from Classes;'):
+                    tp = _get_class(conn, cname, namespace, LocalOnly,
+                            IncludeQualifiers, IncludeClassOrigin)
+                    yield tp[1]
+            else:
+                for cname, in cursor.execute('select name from Classes where cid '
+                        'not in (select subcid from SuperClasses where depth=1);'):
+                    tp = _get_class(conn, cname, namespace, LocalOnly,
+                            IncludeQualifiers, IncludeClassOrigin)
+                    yield tp[1]
+            conn.close()
+        except:
+            conn.close()
+            raise
+        return
+
+    # Class name specified
+    try:
+        try:
+            # Make sure the class exists
+            thecid,thecc = _get_bare_class(conn, thename=ClassName)
+        except TypeError:
+            raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND,
+                'class %s does not exist' % ClassName)
+
+        if DeepInheritance and not LocalOnly:
+            for data, in cursor.execute('select data from ResolvedClasses '
+                    'where cid in (select subcid from SuperClasses where '
+                    'supercid=?) order by cid;', (thecid,)):
+                yield _filter_class(_decode(data), IncludeQualifiers,
+                    IncludeClassOrigin, None)
+        elif DeepInheritance:
+            for cname, in cursor.execute('select name from Classes where '
+                    'cid in (select subcid from SuperClasses where '
+                    'supercid=?);', (thecid,)):
+                tp = _get_class(conn, cname, namespace, LocalOnly,
+                        IncludeQualifiers, IncludeClassOrigin)
+                yield tp[1]
+        else:
+            for cname, in cursor.execute('select name from Classes where '
+                    'cid in (select subcid from SuperClasses where '
+                    'supercid=? and depth=1);', (thecid,)):
+                tp = _get_class(conn, cname, namespace, LocalOnly,
+                        IncludeQualifiers, IncludeClassOrigin)
+                yield tp[1]
+        conn.close()
+    except:
+        conn.close()
+        raise
+
+##############################################################################
+def EnumerateClassNames(ClassName=None, namespace=None, DeepInheritance=False):
+    conn = _get_generator_connection(namespace)
+    cursor = conn.cursor()
+    if not ClassName:
+        try:
+            if DeepInheritance:
+                for cname, in cursor.execute('select name from Classes;'):
+                    yield cname
+            else:
+                for cname, in cursor.execute('select name from Classes where cid '
+                        'not in (select subcid from SuperClasses where depth=1);'):
+                    yield cname
+            conn.close()
+        except:
+            conn.close()
+            raise
+        return
+
+    # Class name specified
+    try:
+        try:
+            # Make sure the class exists
+            thecid,thecc = _get_bare_class(conn, thename=ClassName)
+        except TypeError:
+            raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND,
+                'class %s does not exist' % ClassName)
+        if DeepInheritance:
+            for cname, in cursor.execute('select name from Classes where '
+                    'cid in (select subcid from SuperClasses where '
+                    'supercid=?);', (thecid,)):
+                yield cname
+        else:
+            for cname, in cursor.execute('select name from Classes where '
+                    'cid in (select subcid from SuperClasses where '
+                    'supercid=? and depth=1);', (thecid,)):
+                yield cname
+        conn.close()
+    except:
+        conn.close()
+        raise
+
+##############################################################################
+def DeleteClass(ClassName, namespace):
+    conn = _getdbconnection(namespace, write=True)
+    try:
+        # Make sure the class exists
+        try:
+            thecid, thecc = _get_bare_class(conn, thename=ClassName)
+        except TypeError:
+            raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
+
+        cursor = conn.cursor()
+        # Get the names of all the classes that will be deleted.
+        # Given class + children
+        rmclasses = [x for x in cursor.execute('select name from Classes '
+                'where cid in (select subcid from SuperClasses where '
+                'supercid=?);', (thecid,))]
+        rmclasses.append((ClassName,))
+
+        _begin_write(conn)
+        try:
+            rmshards = [conn.shards[x.lower()] for x, in rmclasses
+                if x.lower() in conn.shards]
+            # Remove all instances of the classes that will be removed
+            for x, in rmclasses:
+                for db in _class_dbs(conn, x):
+                    cursor.execute('delete from %s.Instances where '
+                            'classname=?;' % db, (x,))
+                    cursor.execute('delete from %s.InstanceProperties '
+                            'where classname=?;' % db, (x,))
+            cursor.executemany('delete from ResolvedClasses where cid in '
+                    '(select cid from Classes where name=?);', rmclasses)
+            cursor.executemany('delete from RefInfo where assoccid in '
+                    '(select cid from Classes where name=?) or refpropcid in '
+                    '(select cid from Classes where name=?);',
+                    [(x, x) for x, in rmclasses])
+            cursor.executemany('delete from RefIndex where classname=?;',
+                    rmclasses)
+            cursor.executemany('delete from PropIndexData where classname=? '
+                    'or instclass=?;', [(x, x) for x, in rmclasses])
+            cursor.executemany('delete from PropIndexes where classname=?;',
+                    rmclasses)
+            cursor.executemany('delete from ClassStats where classname=?;',
+                    rmclasses)
+
+            # Delete all entries in the superclass table for class and children
+            cursor.execute('delete from SuperClasses where supercid=? or '
+                'subcid=?;', (thecid,thecid))
+
+            # Delete all entries from the Classes table
+            cursor.executemany('delete from Classes where name=?;', rmclasses)
+            cursor.executemany('delete from ClassDicts where classname=?;',
+                    rmclasses)
+            cursor.executemany('delete from ClassStorage where classname=?;',
+                    rmclasses)
+            _log_changes(conn, [(CHANGE_CLASS, CHANGE_DELETE, x, None, None)
+                for x, in rmclasses])
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        conn.close(True)
+        _layouts.pop(_makedbname(namespace), None)
+        _propindexes.pop(_makedbname(namespace), None)
+        if rmshards:
+            _reset_shards(_makedbname(namespace))
+            for cname, nshards in rmshards:
+                _remove_shard_files(_makedbname(namespace), cname, nshards)
+        _invalidate_classes(namespace, [x for x, in rmclasses])
+        _zdicts.invalidate(_makedbname(namespace), [x for x, in rmclasses])
+    except:
+        conn.close(True)
+        raise
+
+##############################################################################
+class SchemaLoader(object):
+    """Loads classes and qualifier declarations into a namespace in a single
+    transaction, for instance from a MOF compiler.
 
-        # If child did not override this property, then don't
-        # save it unless it has a different default value
-        if 'override' not in child_prop.qualifiers:
-            if child_prop.value:
-                if parent_prop.value and child_prop.value != parent_prop.value:
-                    child_prop.propagated = True
-                    child_prop.class_origin = parent_prop.class_origin
-                    props[child_prop_name] = parent_prop
-                    props[child_prop_name].value = child_prop.value
-            continue
+    It has the CreateClass, ModifyClass, GetClass, SetQualifier and
+    GetQualifier operations of this module, with an optional namespace.
+    Classes are resolved once and kept in memory for the rest of the load,
+    and the SuperClasses rows are written in bulk. Nothing is visible to
+    other connections until commit(); rollback() discards everything.
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.dbname = _makedbname(namespace)
+        self.conn = _getdbconnection(namespace, write=True)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute('BEGIN IMMEDIATE')
+        self.qualtypes = {}
+        for name, data in self.cursor.execute(
+                'select name,data from QualifierTypes'):
+            self.qualtypes[name.lower()] = _decode(data)
+        # {lower case class name: (cid, resolved class)}
+        self.classes = {}
+        # {cid: [(supercid, depth)]}
+        self.chains = {}
+        self.superrows = []
 
-        # Child as specified 'override' on this property
+    def _check_namespace(self, namespace):
+        if namespace and _canonical_namespace(namespace) != \
+                _canonical_namespace(self.namespace):
+            raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE,
+                'Schema loader is bound to namespace %s' % self.namespace)
 
-        # Turn off 'tosubclass' for the override qual so children of
-        # this class don't automatically get it (They have to
-        # explicitly specify 'override'
-        child_prop.qualifiers['override'].tosubclass = False
-        if not child_prop.class_origin:
-            child_prop.class_origin = child_class.classname
-            child_prop.propagated = False
-        else:
-            child_prop.class_origin = parent_class.classname
-            child_prop.propagated = True
+    def _flush(self):
+        if self.superrows:
+            self.cursor.executemany('insert into SuperClasses values(?,?,?)',
+                self.superrows)
+            self.superrows = []
 
-        # Make sure the quals are set on the overridden property
-        for parent_prop_qual_name, parent_prop_qual in \
-                parent_prop.qualifiers.iteritems():
-            if not parent_prop_qual.overridable:
-                if parent_prop_qual_name not in child_prop.qualifiers:
-                    child_prop.qualifiers[parent_prop_qual_name] = \
-                        parent_prop_qual
-                else:
-                    # Qual is not overridable but it is on the child
-                    # property. Probably need to tell the caller that
-                    # this condition exists, but we're going to
-                    # silently set it to the parent's qual
-                    child_prop.qualifiers[parent_prop_qual_name] = \
-                        parent_prop_qual
-            # Parent does allow override of qualifier.
-            # If the qual has tosubclass (not restricted), then only
-            # propagate it down if it's not overridden in the subclass
-            elif parent_prop_qual.tosubclass:
-                if parent_prop_qual_name not in child_prop.qualifiers:
-                    child_prop.qualifiers[parent_prop_qual_name] = \
-                        parent_prop_qual
+    def _resolve(self, name):
+        """Return the cid and the resolved class name. The class is shared
+        by the whole load and must not be modified."""
+        t = self.classes.get(name.lower())
+        if t is None:
+            t = _resolve_class(self.conn, name, False)
+            self.classes[name.lower()] = t
+        return t
 
-        props[child_prop_name] = child_prop
-    child_class.properties = props
+    def _merge(self, cc, parent):
+        # _merge_classes only changes the dictionaries of the parent, so
+        # a shallow copy of it is enough
+        merged = pywbem.CIMClass.__new__(pywbem.CIMClass)
+        merged.__dict__.update(parent.__dict__)
+        merged.qualifiers = parent.qualifiers.copy()
+        merged.properties = parent.properties.copy()
+        merged.methods = parent.methods.copy()
+        return _merge_classes(cc, merged)
 
-    # properties now sync'ed. Now sync methods
-    # TODO. Should do more validation here
-    meths = pywbem.NocaseDict()
-    for child_meth_name, child_method in child_class.methods.iteritems():
-        if child_meth_name not in parent_class.methods:
-            child_method.propagated = False
-            child_method.class_origin = child_class.classname
-            meths[child_meth_name] = child_method
-            continue
-        if child_method.qualifiers.has_key('override'):
-            child_method.propagated = True
-            child_method.class_origin = parent_class.classname
-    child_class.methods = meths
-    return child_class
+    def _chain(self, cid):
+        chain = self.chains.get(cid)
+        if chain is None:
+            chain = [x for x in self.cursor.execute('select supercid,depth '
+                'from SuperClasses where subcid=?', (cid,))]
+            self.chains[cid] = chain
+        return chain
 
-##############################################################################
-def CreateClass(NewClass, namespace):
-    conn = _getdbconnection(namespace)
-    try: 
-        cursor = conn.cursor()
-        # Make sure the class doesn't already exist
-        cursor.execute('select cid from Classes where name=?',
-            (NewClass.classname,))
+    def GetQualifier(self, QualifierName, namespace=None):
+        self._check_namespace(namespace)
         try:
-            cursor.next()
-            cursor.close(True)
-            conn.close(True)
-            raise pywbem.CIMError(pywbem.CIM_ERR_ALREADY_EXISTS)
-        except StopIteration:
-            pass
+            return self.qualtypes[QualifierName.lower()].copy()
+        except KeyError:
+            raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
 
-        # Validate all quals in class
-        _verify_qualifiers(conn, NewClass)
+    def SetQualifier(self, QualifierDeclaration, namespace=None):
+        self._check_namespace(namespace)
+        pargq = _encode(QualifierDeclaration)
+        if QualifierDeclaration.name.lower() in self.qualtypes:
+            self.cursor.execute('update QualifierTypes set data=? where '
+                'name=?', (pargq, QualifierDeclaration.name))
+            op = CHANGE_MODIFY
+        else:
+            self.cursor.execute('insert into QualifierTypes values(?,?)',
+                (QualifierDeclaration.name, pargq))
+            op = CHANGE_CREATE
+        _log_change(self.conn, CHANGE_QUALIFIER, op,
+            QualifierDeclaration.name)
+        self.qualtypes[QualifierDeclaration.name.lower()] = \
+            QualifierDeclaration.copy()
 
-        # If there is a super class then synchronize the class
-        # with the super class
+    def GetClass(self, ClassName, namespace=None, LocalOnly=True,
+            IncludeQualifiers=True, IncludeClassOrigin=False,
+            PropertyList=None):
+        self._check_namespace(namespace)
+        if LocalOnly:
+            t = _get_bare_class(self.conn, thename=ClassName)
+            if t is None:
+                raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
+            cc = t[1]
+        else:
+            cc = pickle.loads(pickle.dumps(self._resolve(ClassName)[1],
+                pickle.HIGHEST_PROTOCOL))
+        return _filter_class(cc, IncludeQualifiers, IncludeClassOrigin,
+            PropertyList)
+
+    def CreateClass(self, NewClass, namespace=None):
+        self._check_namespace(namespace)
+        lname = NewClass.classname.lower()
+        if lname in self.classes or \
+                _get_bare_class(self.conn, thename=NewClass.classname):
+            raise pywbem.CIMError(pywbem.CIM_ERR_ALREADY_EXISTS)
+        _verify_class_qualifiers(self.qualtypes, NewClass)
         if NewClass.superclass:
             try:
-                scid, scc = _get_class(conn, NewClass.superclass, namespace,
-                    LocalOnly=False, IncludeQualifiers=True,
-                    IncludeClassOrigin=True)
+                scid, scc = self._resolve(NewClass.superclass)
             except pywbem.CIMError, ce:
                 if ce.args[0] == pywbem.CIM_ERR_NOT_FOUND:
                     raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_SUPERCLASS,
@@ -413,331 +3042,707 @@ def CreateClass(NewClass, namespace):
                 raise
             NewClass = _adjust_child_class(NewClass, scc)
         else:
-            # There is no super class
             NewClass = _adjust_root_class(NewClass)
 
         pcc = _encode(NewClass)
-        cursor.execute('insert into Classes values(NULL,?,?)',
+        self.cursor.execute('insert into Classes values(NULL,?,?)',
                 (NewClass.classname, pcc))
-        cid = conn.last_insert_rowid()
+        cid = self.conn.last_insert_rowid()
         if NewClass.superclass:
-            # create a single SuperClasses row for this class and its immediate
-            # parent class
-            cursor.execute('insert into SuperClasses values(?,?,1);',
-                    (cid, scid))
-            # Now create all the SuperClasses rows for any super classes of the
-            # given class's super class
-            cursor.execute('insert into SuperClasses select ?,supercid,'
-                    'depth+1 from SuperClasses where subcid=?', (cid, scid))
-        conn.close(True)
-    except:
-        conn.close(True)
-        raise
+            chain = [(scid, 1)] + [(supercid, depth + 1)
+                for supercid, depth in self._chain(scid)]
+            self.superrows.extend([(cid, supercid, depth)
+                for supercid, depth in chain])
+            resolved = self._merge(_decode(pcc), scc)
+        else:
+            chain = []
+            resolved = _decode(pcc)
+        self.chains[cid] = chain
+        self.classes[lname] = (cid, resolved)
+        self.cursor.execute('insert into ResolvedClasses values(?,?)',
+            (cid, _encode(resolved)))
+        _store_refinfo(self.conn, cid, resolved)
+        _log_change(self.conn, CHANGE_CLASS, CHANGE_CREATE,
+            NewClass.classname)
 
-##############################################################################
-def ModifyClass(ModifiedClass, namespace):
-    conn = _getdbconnection(namespace)
-    try: 
-        # Ensure the class exists
+    def ModifyClass(self, ModifiedClass, namespace=None):
+        self._check_namespace(namespace)
         try:
-            oldcid, oldcc = _get_bare_class(conn, thename=ModifiedClass.classname)
+            oldcid, oldcc = _get_bare_class(self.conn,
+                thename=ModifiedClass.classname)
         except TypeError:
             raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
-
-        # Make sure all the quals are valid
-        _verify_qualifiers(conn, ModifiedClass)
-
+        _verify_class_qualifiers(self.qualtypes, ModifiedClass)
         if ModifiedClass.superclass:
             if ModifiedClass.superclass.lower() != oldcc.superclass.lower():
                 raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
                     'Cannot change superclass when modifying class %s' \
                     % (ModifiedClass.superclass))
-            try:
-                scid, scc = _get_class(conn, ModifiedClass.superclass, namespace,
-                    LocalOnly=False, IncludeQualifiers=True,
-                    IncludeClassOrigin=True)
-            except pywbem.CIMError:
-                # This shouldn't happen
-                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
-                    'Invalid super class %s' % (ModifiedClass.superclass))
+            scid, scc = self._resolve(ModifiedClass.superclass)
             ModifiedClass = _adjust_child_class(ModifiedClass, scc)
         else:
             ModifiedClass = _adjust_root_class(ModifiedClass)
-
-        cursor = conn.cursor()
         pcc = _encode(ModifiedClass)
-        cursor.execute('update Classes set data=? where name=?',
+        self.cursor.execute('update Classes set data=? where name=?',
             (pcc, ModifiedClass.classname))
-        conn.close(True)
-    except:
-        conn.close(True)
-        raise
-    
-##############################################################################
-def _get_bare_class(conn, thename=None, thecid=None):
-    cc = None
-    try:
-        cursor = conn.cursor()
-        if thename is not None:
-            cursor.execute('select cid,data from Classes where name=?',
-                (thename,))
+        self._flush()
+        if ModifiedClass.superclass:
+            resolved = self._merge(_decode(pcc), scc)
         else:
-            cursor.execute('select cid,data from Classes where cid=?',
-                (thecid,))
+            resolved = _decode(pcc)
+        _materialize_classes(self.conn, oldcid, resolved)
+        # Forget the resolved class and its subclasses
+        stale = [cname for cname, in self.cursor.execute('select name from '
+            'Classes where cid in (select subcid from SuperClasses where '
+            'supercid=?);', (oldcid,))]
+        stale.append(ModifiedClass.classname)
+        for cname in stale:
+            self.classes.pop(cname.lower(), None)
+        _log_changes(self.conn, [(CHANGE_CLASS, CHANGE_MODIFY, cname, None,
+            None) for cname in stale])
+
+    def _finish(self, sql):
         try:
-            cid,data = cursor.next()
-            theclass = _decode(data)
-            cursor.close(True)
-            cc = (cid,theclass)
-        except StopIteration:
-            pass
-    except:
-        pass
-    return cc
+            try:
+                if sql == 'COMMIT':
+                    self._flush()
+                self.cursor.execute(sql)
+            except:
+                if sql == 'COMMIT':
+                    self.cursor.execute('ROLLBACK')
+                raise
+        finally:
+            self.conn.close(True)
+            self.conn = None
+            _invalidate_classes(self.namespace)
+            _qualcache.invalidate(self.dbname)
+
+    def commit(self):
+        self._finish('COMMIT')
+
+    def rollback(self):
+        self._finish('ROLLBACK')
 
 ##############################################################################
-def _merge_classes(child_class, parent_class):
-    for k, v in parent_class.qualifiers.items():
-        if v.tosubclass is False:
-            del parent_class.qualifiers[k]
-    parent_class.qualifiers.update(child_class.qualifiers)
-    parent_class.properties.update(child_class.properties)
-    parent_class.methods.update(child_class.methods)
-    parent_class.superclass = parent_class.classname
-    parent_class.classname = child_class.classname
-    return parent_class
+def _property_set(PropertyList):
+    """Return the lower case names in PropertyList as a set, or None."""
+    if PropertyList is None:
+        return None
+    return set([x.lower() for x in PropertyList])
 
 ##############################################################################
-def _filter_class(cim_class, IncludeQualifiers, IncludeClassOrigin,
-    PropertyList):
-    if not IncludeQualifiers:
-        cim_class.qualifiers = pywbem.NocaseDict()
-    rmprops = []
-    for prop_name, prop in cim_class.properties.iteritems():
-        if PropertyList is not None and prop_name not in PropertyList:
-            rmprops.append(prop_name)
-            continue
-        if not IncludeQualifiers:
-            prop.qualifiers = pywbem.NocaseDict()
-        if not IncludeClassOrigin:
-            prop.class_origin = None
-    if rmprops:
-        for pname in rmprops:
-            del cim_class.properties[pname]
+class _ProjectionPlan(object):
+    """The work _filter_instance does for every instance of a class,
+    decided once per request.
 
-    for meth in cim_class.methods.itervalues():
-        if not IncludeQualifiers:
-            meth.qualifiers = pywbem.NocaseDict()
-        if not IncludeClassOrigin:
-            meth.class_origin = None
+    props maps the lower case name of every property of the class that is
+    to be returned to the qualifiers (None for a fresh empty set) and the
+    class origin to give it.
+    """
+    def __init__(self, cim_class, IncludeQualifiers, IncludeClassOrigin,
+            PropertyList):
+        self.IncludeQualifiers = IncludeQualifiers
+        names = _property_set(PropertyList)
+        self.props = {}
+        for lname, (name, prop) in cim_class.properties.data.iteritems():
+            if names is not None and lname not in names:
+                continue
+            if IncludeQualifiers:
+                quals = prop.qualifiers
+            else:
+                quals = None
+            if IncludeClassOrigin:
+                origin = prop.class_origin
+            else:
+                origin = None
+            self.props[lname] = (quals, origin)
+
+    def apply(self, instance):
+        if not self.IncludeQualifiers:
+            instance.qualifiers = _nocasedict(())
+        data = instance.properties.data
+        plan = self.props
+        kept = {}
+        if len(plan) < len(data):
+            pairs = [(lname, data.get(lname)) for lname in plan]
+        else:
+            pairs = data.iteritems()
+        for lname, item in pairs:
+            if item is None:
+                continue
+            try:
+                quals, origin = plan[lname]
+            except KeyError:
+                # Not requested, or not in the class
+                continue
+            prop = item[1]
+            if quals is None:
+                quals = _nocasedict(())
+            prop.qualifiers = quals
+            prop.class_origin = origin
+            kept[lname] = item
+        instance.properties.data = kept
+        return instance
 
-    return cim_class
-        
 ##############################################################################
-def _get_class(conn, name, namespace, LocalOnly=False, IncludeQualifiers=True,
-        IncludeClassOrigin=True, PropertyList=None):
-    t = _get_bare_class(conn, thename=name)
+def _filter_instance(instance, cim_class, IncludeQualifiers,
+    IncludeClassOrigin, PropertyList):
+    return _ProjectionPlan(cim_class, IncludeQualifiers, IncludeClassOrigin,
+        PropertyList).apply(instance)
+
+##############################################################################
+# Instance storage layouts.
+#
+# By default an instance is stored as a single blob in Instances.data.
+# SetInstanceLayout can switch a class to the split layout. The Instances
+# rows of such a class only hold the key properties, and every other
+# property is stored in a row of its own in InstanceProperties, so that
+# requests with a PropertyList only read and decode the properties they
+# ask for.
+
+LAYOUT_BLOB = 'blob'
+LAYOUT_SPLIT = 'split'
+
+# {lower case class name: layout} of the classes that do not use
+# LAYOUT_BLOB, by database
+_layouts = TableCache()
+
+##############################################################################
+def _class_layout(conn, classname):
+    layouts = _layouts.get(conn.dbname)
+    if layouts is None:
+        generation = _layouts.generation(conn.dbname)
+        cursor = conn.cursor()
+        layouts = dict([(cname.lower(), layout) for cname, layout in
+            cursor.execute('select classname,layout from ClassStorage')])
+        _layouts.put(conn.dbname, generation, layouts)
+    return layouts.get(classname.lower(), LAYOUT_BLOB)
+
+##############################################################################
+# Class shards.
+#
+# ShardClass moves the instances of a very large class out of the namespace
+# database into shard databases of its own: files next to it with the
+# Instances and InstanceProperties tables, among which the instances are
+# split by key hash. Pooled connections have the shard databases of their
+# namespace attached, and instance reads and writes go to the tables of
+# the class they work on. Everything else, including the change log,
+# the class statistics and the indexes, stays in the namespace database.
+
+##############################################################################
+def _shard_schema(classname, nshards, shard):
+    return 'shard_%s_%d_%d' % (classname.lower(), nshards, shard)
+
+##############################################################################
+def _shard_file(dbname, classname, nshards, shard):
+    # Never ends in .db, which would make it a namespace
+    return '%s@%s.%d.%d.shard' % (os.path.splitext(dbname)[0],
+        classname.lower(), nshards, shard)
+
+##############################################################################
+def _shard_names(dbname, shards):
+    """Return the (schema name, file name) of the shard databases of a
+    shard map, for the namespace database dbname."""
+    names = []
+    for cname, nshards in sorted(shards.itervalues()):
+        for i in xrange(nshards):
+            names.append((_shard_schema(cname, nshards, i),
+                _shard_file(dbname, cname, nshards, i)))
+    return names
+
+##############################################################################
+def _load_shards(conn):
+    """Return the shard map of a namespace: {lower case class name: (class
+    name, number of shards)} for its sharded classes."""
+    cursor = conn.cursor()
+    return dict([(cname.lower(), (cname, nshards)) for cname, nshards in
+        cursor.execute('select classname,shards from ClassStorage where '
+            'shards>0')])
+
+##############################################################################
+def _attach_shards(conn, attached, names):
+    """Attach the shard databases names, a list of (schema name, file name),
+    to an apsw connection in place of the schemas attached, and return
+    the schema names."""
+    cursor = conn.cursor()
+    for schema in attached:
+        cursor.execute('DETACH DATABASE %s' % schema)
+    for schema, fname in names:
+        cursor.execute('ATTACH DATABASE ? AS %s' % schema, (fname,))
+        cursor.execute('PRAGMA %s.synchronous=%s' % (schema, _SYNCHRONOUS))
+    cursor.close(True)
+    return tuple([schema for schema, fname in names])
+
+##############################################################################
+def _reset_shards(dbname):
+    # Makes the pooled connections attach the shard databases again
+    pool = _pools.get(dbname)
+    if pool is not None:
+        pool.reset_shards()
+
+##############################################################################
+def _class_dbs(conn, classname):
+    """Return the databases holding the instances of a class."""
+    t = conn.shards.get(classname.lower())
     if t is None:
-        raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
-    thecid,thecc = t
-    if not thecc.superclass or LocalOnly:
-        return (thecid, _filter_class(thecc, IncludeQualifiers, IncludeClassOrigin,
-                    PropertyList))
+        return ['main']
+    return [_shard_schema(t[0], t[1], i) for i in xrange(t[1])]
+
+##############################################################################
+def _instance_db(conn, classname, keyhash):
+    """Return the database holding the instance of a class with a key
+    hash."""
+    t = conn.shards.get(classname.lower())
+    if t is None:
+        return 'main'
+    return _shard_schema(t[0], t[1], keyhash % t[1])
+
+##############################################################################
+def _key_string_db(conn, classname, strkey):
+    if classname.lower() not in conn.shards:
+        return 'main'
+    return _instance_db(conn, classname, _key_hash(strkey))
+
+##############################################################################
+def _key_dbs(conn, keyhash):
+    """Return the databases that may hold the instance with a key hash,
+    whatever its class."""
+    return ['main'] + [_shard_schema(cname, nshards, keyhash % nshards)
+        for cname, nshards in conn.shards.itervalues()]
+
+##############################################################################
+def _all_dbs(conn):
+    return ['main'] + [_shard_schema(cname, nshards, i)
+        for cname, nshards in conn.shards.itervalues()
+        for i in xrange(nshards)]
+
+##############################################################################
+def _stored_shards(conn, classname):
+    cursor = conn.cursor()
+    rows = [x for x, in cursor.execute('select shards from ClassStorage '
+        'where classname=?', (classname,))]
+    return rows and rows[0] or 0
+
+##############################################################################
+def _merge_rows(rows):
+    """Merge iterables of rows that are each in key string order."""
+    if len(rows) == 1:
+        return rows[0]
+    return heapq.merge(*rows)
+
+##############################################################################
+def _locate_instance(conn, strkey, keyhash):
+    """Return the (database, class name) of the stored instance with a key
+    string, or None."""
+    cursor = conn.cursor()
+    for db in _key_dbs(conn, keyhash):
+        for cname, in [x for x in cursor.execute('select classname from '
+                '%s.Instances where keyhash=? and strkey=?' % db,
+                (keyhash, strkey))]:
+            return db, cname
+    return None
+
+##############################################################################
+def _remove_shard_files(dbname, classname, nshards):
+    for i in xrange(nshards):
+        fname = _shard_file(dbname, classname, nshards, i)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(fname + suffix):
+                os.remove(fname + suffix)
+
+##############################################################################
+def _encode_property(prop):
+    return CODECS['compact'].encode(prop)
+
+##############################################################################
+def _split_instance(instance):
+    """Return a copy of instance with only its key properties, and a list
+    of its other properties."""
+    keys = instance.path.keybindings
+    shell = pywbem.CIMInstance(instance.classname, path=instance.path)
+    shell.qualifiers = instance.qualifiers
+    props = []
+    for name, prop in instance.properties.iteritems():
+        if name in keys:
+            shell.properties[name] = prop
+        else:
+            props.append(prop)
+    return shell, props
+
+##############################################################################
+def _instance_rows(conn, classname, strkey, keyhash, instance):
+    """Return the Instances row and the InstanceProperties rows storing an
+    instance."""
+    props = None
+    if _class_layout(conn, classname) == LAYOUT_SPLIT:
+        instance, props = _split_instance(instance)
+    row = (classname, strkey, _encode_instance(conn, instance), keyhash,
+        _encode_path(instance.path))
+    if props is None:
+        return row, []
+    return row, [(classname, strkey, p.name, _encode_property(p))
+        for p in props]
+
+##############################################################################
+def _stored_row(conn, classname, strkey, keyhash):
+    """Return the size of the stored rows of an instance and its encoded
+    path."""
+    db = _instance_db(conn, classname, keyhash)
+    cursor = conn.cursor()
+    rows = [x for x in cursor.execute('select length(i.data) + (select '
+        'coalesce(sum(length(p.data)),0) from %s.InstanceProperties p where '
+        'p.classname=i.classname and p.strkey=i.strkey),i.path from '
+        '%s.Instances i where keyhash=? and strkey=?' % (db, db),
+        (keyhash, strkey))]
+    return rows and rows[0] or (0, None)
+
+##############################################################################
+def _count_instances(conn, classname, ninstances, nbytes, seq):
+    """Add to the statistics of a class, last changed by change seq."""
+    cursor = conn.cursor()
+    cursor.execute('update ClassStats set ninstances=ninstances+?, '
+        'nbytes=nbytes+?, lastseq=? where classname=?',
+        (ninstances, nbytes, seq, classname))
+    if not conn.changes():
+        cursor.execute('insert into ClassStats values(?,?,?,?)',
+            (classname, ninstances, nbytes, seq))
+
+##############################################################################
+def _row_bytes(row, proprows):
+    return len(row[2]) + sum([len(p[3]) for p in proprows])
+
+##############################################################################
+def _store_instance(conn, classname, strkey, keyhash, instance,
+        update=False, journal=True):
+    """Write the rows of an instance, replacing the existing ones if update
+    is True. The write is logged in the change log if journal is True."""
+    db = _instance_db(conn, classname, keyhash)
+    cursor = conn.cursor()
+    row, proprows = _instance_rows(conn, classname, strkey, keyhash,
+        instance)
+    if not journal:
+        seq = _next_change(conn)
+    elif update:
+        seq = _log_change(conn, CHANGE_INSTANCE, CHANGE_MODIFY, classname,
+            strkey, row[4])
+    else:
+        seq = _log_change(conn, CHANGE_INSTANCE, CHANGE_CREATE, classname,
+            strkey, row[4])
+    if update:
+        _count_instances(conn, classname, 0, _row_bytes(row, proprows) -
+            _stored_row(conn, classname, strkey, keyhash)[0], seq)
+    else:
+        _count_instances(conn, classname, 1, _row_bytes(row, proprows), seq)
+    if update:
+        cursor.execute('update %s.Instances set data=? where keyhash=? and '
+                'strkey=?' % db, (row[2], keyhash, strkey))
+        if _class_layout(conn, classname) == LAYOUT_SPLIT:
+            cursor.execute('delete from %s.InstanceProperties where '
+                    'classname=? and strkey=?' % db, (classname, strkey))
+    else:
+        cursor.execute('insert into %s.Instances(classname,strkey,data,'
+                'keyhash,path) values(?,?,?,?,?);' % db, row)
+    if proprows:
+        cursor.executemany('insert into %s.InstanceProperties '
+                'values(?,?,?,?)' % db, proprows)
+    refrows = _reference_rows(_dbnamespace(conn.dbname), classname, strkey,
+        instance)
+    idxrows = _index_rows(conn, classname, strkey, instance)
+    if update:
+        cursor.execute('delete from RefIndex where classname=? and '
+                'strkey=?', (classname, strkey))
+        cursor.execute('delete from PropIndexData where instclass=? and '
+                'strkey=?', (classname, strkey))
+    if refrows:
+        cursor.executemany('insert into RefIndex values(?,?,?,?,?)', refrows)
+    if idxrows:
+        cursor.executemany('insert or ignore into PropIndexData '
+                'values(?,?,?,?,?)', idxrows)
+    _instance_written(conn, classname)
 
+##############################################################################
+def _remove_instance(conn, classname, strkey, keyhash):
+    db = _instance_db(conn, classname, keyhash)
+    nbytes, path = _stored_row(conn, classname, strkey, keyhash)
+    seq = _log_change(conn, CHANGE_INSTANCE, CHANGE_DELETE, classname,
+        strkey, path)
+    _count_instances(conn, classname, -1, -nbytes, seq)
     cursor = conn.cursor()
-    # Get the cid values for all super classes. order descending by depth
-    # of inheritance
-    supercids = [x for x, in cursor.execute('select supercid from superclasses '
-            'where subcid=? order by depth DESC', (thecid,))]
-    if not supercids:
-        return (thecid, _filter_class(thecc, IncludeQualifiers, IncludeClassOrigin,
-                    PropertyList))
+    cursor.execute('delete from %s.Instances where keyhash=? and strkey=?'
+        % db, (keyhash, strkey))
+    cursor.execute('delete from RefIndex where classname=? and strkey=?',
+        (classname, strkey))
+    cursor.execute('delete from PropIndexData where instclass=? and '
+        'strkey=?', (classname, strkey))
+    if _class_layout(conn, classname) == LAYOUT_SPLIT:
+        cursor.execute('delete from %s.InstanceProperties where classname=? '
+            'and strkey=?' % db, (classname, strkey))
 
-    try:
-        scid,supercc = _get_bare_class(conn, thecid=supercids[0])
-    except TypeError:
-        raise pywbem.CIMError(pywbem.CIM_ERR_FAILED, 'Super class does '
-            'not exist for class %s. super class cid: %d',
-                (name, supercids[0]))
-    supercids = supercids[1:]
-    for scid in supercids:
-        tp = _get_bare_class(conn, thecid=scid)
-        if tp is None:
-            raise pywbem.CIMError(pywbem.CIM_ERR_FAILED, 'Super class does '
-                'not exist for class %s. super class cid: %d', (name, scid))
-        subcc = tp[1]
-        supercc = _merge_classes(subcc, supercc)
-    thecc = _merge_classes(thecc, supercc)
-    return (thecid, _filter_class(thecc, IncludeQualifiers, IncludeClassOrigin,
-                    PropertyList))
+##############################################################################
+def _property_filter(PropertyList):
+    """Return the SQL condition and arguments selecting the
+    InstanceProperties rows of the properties in PropertyList."""
+    if PropertyList is None or len(PropertyList) > 500:
+        return '', []
+    return (' and name in (%s)' % ','.join(['?'] * len(PropertyList)),
+        list(PropertyList))
 
 ##############################################################################
-def GetClass(ClassName, namespace, LocalOnly=True, IncludeQualifiers=True,
-        IncludeClassOrigin=False, PropertyList=None, Connection=None):
-    conn = Connection or _getdbconnection(namespace)
-    try:
-        tp = _get_class(conn, ClassName, namespace, LocalOnly, IncludeQualifiers,
-            IncludeClassOrigin, PropertyList)
-        Connection or conn.close(True)
-        return tp[1]
-    except:
-        Connection or conn.close(True)
-        raise
+def _load_properties(conn, instance, classname, strkey, PropertyList):
+    """Add the non-key properties of a split layout instance."""
+    if PropertyList is not None and not PropertyList:
+        return instance
+    cond, args = _property_filter(PropertyList)
+    cursor = conn.cursor()
+    for data, in cursor.execute('select data from %s.InstanceProperties '
+            'where classname=? and strkey=?' % _key_string_db(conn,
+            classname, strkey) + cond, [classname, strkey] + args):
+        prop = _decode(data)
+        instance.properties[prop.name] = prop
+    return instance
 
 ##############################################################################
-def EnumerateClasses(ClassName=None, namespace=None, DeepInheritance=False, LocalOnly=True,
-        IncludeQualifiers=True, IncludeClassOrigin=False):
-    conn = _get_generator_connection(namespace)
+def _scan_rows(conn, classname, PropertyList=None, after=None):
+    """Yield (key string, instance) for the stored instances of a class, not
+    including subclasses, in key string order, starting after the key
+    string after if it is given.
+
+    Split layout instances only get the properties in PropertyList (and
+    their keys); they are assembled by merging the Instances and
+    InstanceProperties rows of the class, which are both read in key
+    order. So are the instances of the shards of a sharded class.
+    """
+    return _merge_rows([_scan_db(conn, db, classname, PropertyList, after)
+        for db in _class_dbs(conn, classname)])
+
+##############################################################################
+def _scan_db(conn, db, classname, PropertyList, after):
+    # _scan_rows for the instances in one database
+    cond = ''
+    keyargs = []
+    if after is not None:
+        cond = ' and strkey>?'
+        keyargs = [after]
     cursor = conn.cursor()
-    if not ClassName:
-        try:
-            if DeepInheritance:
-                for cname, in cursor.execute('select name from Classes;'):
-                    tp = _get_class(conn, cname, namespace, LocalOnly,
-                            IncludeQualifiers, IncludeClassOrigin)
-                    yield tp[1]
-            else:
-                for cname, in cursor.execute('select name from Classes where cid '
-                        'not in (select subcid from SuperClasses where depth=1);'):
-                    tp = _get_class(conn, cname, namespace, LocalOnly,
-                            IncludeQualifiers, IncludeClassOrigin)
-                    yield tp[1]
-            conn.close()
-        except:
-            conn.close()
-            raise
+    if _class_layout(conn, classname) != LAYOUT_SPLIT:
+        for strkey, data in cursor.execute('select strkey,data from '
+                '%s.Instances where classname=?' % db + cond +
+                ' order by strkey', [classname] + keyargs):
+            yield strkey, _decode(data, conn)
         return
 
-    # Class name specified
-    try:
-        try:
-            # Make sure the class exists
-            thecid,thecc = _get_bare_class(conn, thename=ClassName)
-        except TypeError:
-            raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND,
-                'class %s does not exist' % ClassName)
+    props = iter(())
+    if PropertyList is None or PropertyList:
+        pcond, args = _property_filter(PropertyList)
+        props = conn.cursor().execute('select strkey,data from '
+            '%s.InstanceProperties where classname=?' % db + cond + pcond +
+            ' order by strkey', [classname] + keyargs + args)
+    pending = next(props, None)
+    for strkey, data in cursor.execute('select strkey,data from '
+            '%s.Instances where classname=?' % db + cond + ' order by strkey',
+            [classname] + keyargs):
+        ci = _decode(data, conn)
+        while pending is not None and pending[0] < strkey:
+            pending = next(props, None)
+        while pending is not None and pending[0] == strkey:
+            prop = _decode(pending[1])
+            ci.properties[prop.name] = prop
+            pending = next(props, None)
+        yield strkey, ci
 
-        if DeepInheritance:
-            for cname, in cursor.execute('select name from Classes where '
-                    'cid in (select subcid from SuperClasses where '
-                    'supercid=?);', (thecid,)):
-                tp = _get_class(conn, cname, namespace, LocalOnly,
-                        IncludeQualifiers, IncludeClassOrigin)
-                yield tp[1]
-        else:
-            for cname, in cursor.execute('select name from Classes where '
-                    'cid in (select subcid from SuperClasses where '
-                    'supercid=? and depth=1);', (thecid,)):
-                tp = _get_class(conn, cname, namespace, LocalOnly,
-                        IncludeQualifiers, IncludeClassOrigin)
-                yield tp[1]
-        conn.close()
-    except:
-        conn.close()
-        raise
+##############################################################################
+def _scan_instances(conn, classname, PropertyList=None):
+    """Yield the stored instances of a class, not including subclasses."""
+    for strkey, ci in _scan_rows(conn, classname, PropertyList):
+        yield ci
 
 ##############################################################################
-def EnumerateClassNames(ClassName=None, namespace=None, DeepInheritance=False):
-    conn = _get_generator_connection(namespace)
+def _set_class_storage(conn, classname, layout, nshards):
     cursor = conn.cursor()
-    if not ClassName:
-        try:
-            if DeepInheritance:
-                for cname, in cursor.execute('select name from Classes;'):
-                    yield cname
-            else:
-                for cname, in cursor.execute('select name from Classes where cid '
-                        'not in (select subcid from SuperClasses where depth=1);'):
-                    yield cname
-            conn.close()
-        except:
-            conn.close()
-            raise
-        return
+    if layout == LAYOUT_BLOB and not nshards:
+        cursor.execute('delete from ClassStorage where classname=?',
+            (classname,))
+    else:
+        cursor.execute('insert or replace into ClassStorage values(?,?,?)',
+            (classname, layout, nshards))
 
-    # Class name specified
+##############################################################################
+def SetInstanceLayout(ClassName, namespace, Layout):
+    """Choose how the instances of a class (not including its subclasses)
+    are stored: LAYOUT_BLOB or LAYOUT_SPLIT. Existing instances are
+    converted."""
+    if Layout not in (LAYOUT_BLOB, LAYOUT_SPLIT):
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+            'Unknown instance layout %s' % Layout)
+    conn = _getdbconnection(namespace, write=True)
     try:
-        try:
-            # Make sure the class exists
-            thecid,thecc = _get_bare_class(conn, thename=ClassName)
-        except TypeError:
+        if _get_bare_class(conn, thename=ClassName) is None:
             raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND,
                 'class %s does not exist' % ClassName)
-        if DeepInheritance:
-            for cname, in cursor.execute('select name from Classes where '
-                    'cid in (select subcid from SuperClasses where '
-                    'supercid=?);', (thecid,)):
-                yield cname
-        else:
-            for cname, in cursor.execute('select name from Classes where '
-                    'cid in (select subcid from SuperClasses where '
-                    'supercid=? and depth=1);', (thecid,)):
-                yield cname
-        conn.close()
+        cursor = conn.cursor()
+        _begin_write(conn)
+        try:
+            _layouts.pop(conn.dbname, None)
+            oldlayout = _class_layout(conn, ClassName)
+            if oldlayout != Layout:
+                keyhashes = {}
+                for db in _class_dbs(conn, ClassName):
+                    keyhashes.update(cursor.execute('select strkey,keyhash '
+                        'from %s.Instances where classname=?' % db,
+                        (ClassName,)))
+                insts = [x for x in _scan_rows(conn, ClassName)]
+                _set_class_storage(conn, ClassName, Layout,
+                    _stored_shards(conn, ClassName))
+                _layouts.pop(conn.dbname, None)
+                for strkey, ci in insts:
+                    _store_instance(conn, ClassName, strkey,
+                        keyhashes[strkey], ci, update=True, journal=False)
+                _log_change(conn, CHANGE_LAYOUT, CHANGE_MODIFY, ClassName)
+                if Layout == LAYOUT_BLOB:
+                    for db in _class_dbs(conn, ClassName):
+                        cursor.execute('delete from %s.InstanceProperties '
+                            'where classname=?' % db, (ClassName,))
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        finally:
+            _layouts.pop(conn.dbname, None)
+        conn.close(True)
     except:
-        conn.close()
+        conn.close(True)
         raise
 
 ##############################################################################
-def DeleteClass(ClassName, namespace):
-    conn = _getdbconnection(namespace)
+def _create_shard(fname):
+    for suffix in ('', '-wal', '-shm'):
+        # Left over from a move that failed
+        if os.path.exists(fname + suffix):
+            os.remove(fname + suffix)
+    conn = apsw.Connection(fname)
     try:
-        # Make sure the class exists
-        try:
-            thecid, thecc = _get_bare_class(conn, thename=ClassName)
-        except TypeError:
-            raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
-
         cursor = conn.cursor()
-        # Get the names of all the classes that will be deleted.
-        # Given class + children
-        rmclasses = [x for x in cursor.execute('select name from Classes '
-                'where cid in (select subcid from SuperClasses where '
-                'supercid=?);', (thecid,))]
-        rmclasses.append((ClassName,))
-
-        # Remove all instances of the classes that will be removed
-        cursor.executemany('delete from Instances where classname=?;',
-                rmclasses)
+        cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        cursor.execute(_SHARD_SCHEMA)
+        cursor.execute('PRAGMA journal_mode=%s' % _JOURNAL_MODE).next()
+    finally:
+        conn.close(True)
 
-        # Delete all entries in the superclass table for class and children
-        cursor.execute('delete from SuperClasses where supercid=? or '
-            'subcid=?;', (thecid,thecid))
+##############################################################################
+def _copy_instances(conn, classname, sources, targets):
+    """Copy the Instances and InstanceProperties rows of a class from the
+    databases sources to targets, splitting them by key hash if there
+    are several targets."""
+    cursor = conn.cursor()
+    n = len(targets)
+    cols = 'classname,strkey,data,keyhash,path'
+    for src in sources:
+        for i, dst in enumerate(targets):
+            # The shard of keyhash % n, as in _instance_db
+            cond = ''
+            if n > 1:
+                cond = ' and ((i.keyhash %% %d) + %d) %% %d=%d' % (n, n, n, i)
+            cursor.execute('insert into %s.InstanceProperties select p.* '
+                'from %s.InstanceProperties p join %s.Instances i on '
+                'i.classname=p.classname and i.strkey=p.strkey where '
+                'p.classname=?%s' % (dst, src, src, cond), (classname,))
+            cursor.execute('insert into %s.Instances(%s) select %s from '
+                '%s.Instances i where classname=?%s' % (dst, cols, cols, src,
+                cond), (classname,))
 
-        # Delete all entries from the Classes table
-        cursor.executemany('delete from Classes where name=?;', rmclasses)
-        conn.close(True)
-    except:
+##############################################################################
+def _fill_shards(source, classname, names):
+    """Copy the instances of a class in the database file source to the
+    new shard databases names, a list of (schema name, file name), and
+    commit them there."""
+    conn = apsw.Connection(source)
+    try:
+        _configure_connection(conn)
+        _attach_shards(conn, (), names)
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        try:
+            _copy_instances(conn, classname, ['main'],
+                [schema for schema, fname in names])
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+    finally:
         conn.close(True)
-        raise
 
 ##############################################################################
-def _filter_instance(instance, cim_class, IncludeQualifiers,
-    IncludeClassOrigin, PropertyList):
-    if not IncludeQualifiers:
-        instance.qualifiers = pywbem.NocaseDict()
-    rmprops = []
-    for prop_name, prop in instance.properties.iteritems():
-        if PropertyList is not None and prop_name not in PropertyList:
-            rmprops.append(prop_name)
-            continue
-        # Ensure the property is in the class
-        if prop_name not in cim_class.properties:
-            rmprops.append(prop_name)
-            continue
-        if IncludeQualifiers:
-            prop.qualifiers = cim_class.properties[prop_name].qualifiers
-        else:
-            prop.qualifiers = pywbem.NocaseDict()
-        if IncludeClassOrigin:
-            prop.class_origin = cim_class.properties[prop_name].class_origin
-        else:
-            prop.class_origin = None
-
-    if rmprops:
-        for pname in rmprops:
-            del instance.properties[pname]
-    return instance
+def ShardClass(ClassName, namespace, Shards):
+    """Store the instances of a class (not including its subclasses) in
+    Shards shard databases of their own, among which they are split by
+    key hash, or in the namespace database if Shards is 0. Existing
+    instances are moved. A namespace can have as many shard databases as
+    SQLite can attach to a connection, usually 10."""
+    if Shards < 0:
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+            'Invalid number of shards %s' % Shards)
+    dbname = _makedbname(namespace)
+    if dbname in _memory_namespaces:
+        raise pywbem.CIMError(pywbem.CIM_ERR_NOT_SUPPORTED,
+            'Classes of a namespace served from memory cannot be sharded')
+    conn = _getdbconnection(namespace, write=True)
+    created = False
+    try:
+        cursor = conn.cursor()
+        # Writers are held up from here on, so every instance is moved
+        _begin_write(conn)
+        try:
+            if _get_bare_class(conn, thename=ClassName) is None:
+                raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND,
+                    'class %s does not exist' % ClassName)
+            shards = dict(conn.shards)
+            old = shards.pop(ClassName.lower(), (ClassName, 0))[1]
+            if old == Shards:
+                cursor.execute('ROLLBACK')
+                return
+            limit = conn.limit(apsw.SQLITE_LIMIT_ATTACHED)
+            others = sum([nshards for cname, nshards in shards.itervalues()])
+            if others + Shards > limit:
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                    'Namespace %s can have at most %d shards' % (namespace,
+                    limit))
+            # A commit is only atomic within one database file. The
+            # instances are first copied to the new shard databases and
+            # committed there; the class is then switched over and its
+            # instances removed from the namespace database in a
+            # transaction that writes to that database alone. A crash in
+            # between leaves them where they were, and the old shard
+            # databases are removed once they are no longer used.
+            if Shards:
+                names = _shard_names(dbname, {'new': (ClassName, Shards)})
+                created = True
+                for schema, fname in names:
+                    _create_shard(fname)
+                for fname in [fname for schema, fname in _shard_names(dbname,
+                        {'old': (ClassName, old)})] or [dbname]:
+                    _fill_shards(fname, ClassName, names)
+            else:
+                _copy_instances(conn, ClassName,
+                    _class_dbs(conn, ClassName), ['main'])
+            if not old:
+                cursor.execute('delete from InstanceProperties where '
+                    'classname=?', (ClassName,))
+                cursor.execute('delete from Instances where classname=?',
+                    (ClassName,))
+            _set_class_storage(conn, ClassName,
+                _class_layout(conn, ClassName), Shards)
+            _log_change(conn, CHANGE_LAYOUT, CHANGE_MODIFY, ClassName)
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            conn.close(True)
+            if created:
+                _remove_shard_files(dbname, ClassName, Shards)
+            raise
+    finally:
+        conn.close(True)
+    _reset_shards(dbname)
+    _remove_shard_files(dbname, ClassName, old)
 
 ##############################################################################
 def GetInstance(InstanceName, LocalOnly=True,
@@ -755,18 +3760,25 @@ def GetInstance(InstanceName, LocalOnly=True,
     try:
         # Convert instance name to string
         strkey = _make_key_string(InstanceName)
+        keyhash = _key_hash(strkey)
         cursor = conn.cursor()
-        cursor.execute('select data from Instances where strkey=?',
-                (strkey,))
-        try:
-            data, = cursor.next()
-            cursor.close(True)
-            Connection or conn.close(True)
-            ci = _decode(data)
-            return _filter_instance(ci, theclass, IncludeQualifiers,
-                IncludeClassOrigin, PropertyList)
-        except StopIteration:
+        for db in _key_dbs(conn, keyhash):
+            cursor.execute('select classname,data from %s.Instances where '
+                    'keyhash=? and strkey=?' % db, (keyhash, strkey))
+            try:
+                cname, data = cursor.next()
+                cursor.close(True)
+                break
+            except StopIteration:
+                pass
+        else:
             raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
+        ci = _decode(data, conn)
+        if _class_layout(conn, cname) == LAYOUT_SPLIT:
+            _load_properties(conn, ci, cname, strkey, PropertyList)
+        Connection or conn.close(True)
+        return _filter_instance(ci, theclass, IncludeQualifiers,
+            IncludeClassOrigin, PropertyList)
     except:
         Connection or conn.close(True)
         raise
@@ -806,11 +3818,10 @@ def EnumerateInstances(ClassName, namespace, LocalOnly=True,
                 # Log Error. Ignore?
                 continue
 
-            for data, in cursor.execute('select data from Instances where '
-                    'classname=?', (cname,)):
-                ci = _decode(data)
-                yield _filter_instance(ci, theclass, IncludeQualifiers,
-                    IncludeClassOrigin, PropertyList)
+            plan = _ProjectionPlan(theclass, IncludeQualifiers,
+                IncludeClassOrigin, PropertyList)
+            for ci in _scan_instances(conn, cname, PropertyList):
+                yield plan.apply(ci)
         conn.close()
     except:
         conn.close()
@@ -833,41 +3844,367 @@ def EnumerateInstanceNames(ClassName, namespace):
                 'supercid=?);', (thecid,)):
             classnames.append(cname)
 
+        # Only the path column is read, which is covered by InstPathNDX,
+        # so the instance data is never touched
         for cname in classnames:
-            for data, in cursor.execute('select data from Instances where '
-                    'classname=?', (cname,)):
-                ci = _decode(data)
-                yield ci.path
+            for db in _class_dbs(conn, cname):
+                for path, in cursor.execute('select path from %s.Instances '
+                        'where classname=?' % db, (cname,)):
+                    yield _decode(path)
+
+        conn.close()
+    except:
+        conn.close()
+        raise
+
+##############################################################################
+# Keyset paging.
+#
+# A position in an enumeration is the (cid, key string) of the last
+# instance returned. The classes of an enumeration are walked in cid order
+# and the instances of each class in key string order, so a page is read
+# with a range scan of the primary key and no state is kept between pages.
+
+# The position before the first instance
+START_POSITION = (0, u'')
+
+##############################################################################
+def _class_tree_cids(conn, ClassName, DeepInheritance):
+    """Return the (cid, name) of ClassName and of its subclasses (only the
+    direct ones unless DeepInheritance), in cid order. ClassName may also
+    be a list of class names, which are taken without their subclasses."""
+    if not isinstance(ClassName, basestring):
+        classes = []
+        for name in ClassName:
+            t = _get_bare_class(conn, thename=name)
+            if t is None:
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_CLASS, name)
+            classes.append((t[0], name))
+        classes.sort()
+        return classes
+    t = _get_bare_class(conn, thename=ClassName)
+    if t is None:
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_CLASS)
+    sql = 'select cid,name from Classes where cid in (select subcid from ' \
+        'SuperClasses where supercid=?'
+    if not DeepInheritance:
+        sql += ' and depth=1'
+    cursor = conn.cursor()
+    classes = [x for x in cursor.execute(sql + ')', (t[0],))]
+    classes.append((t[0], ClassName))
+    classes.sort()
+    return classes
+
+##############################################################################
+def _keyset_scan(conn, classes, Position, PropertyList, NamesOnly):
+    """Yield (cid, class name, key string, instance or path) for the
+    instances of classes that follow Position."""
+    for cid, cname in classes:
+        after = None
+        if Position is not None:
+            if cid < Position[0]:
+                continue
+            if cid == Position[0]:
+                after = Position[1]
+        if not NamesOnly:
+            for strkey, ci in _scan_rows(conn, cname, PropertyList, after):
+                yield cid, cname, strkey, ci
+            continue
+        sql = 'select strkey,path from %s.Instances where classname=?'
+        args = [cname]
+        if after is not None:
+            sql += ' and strkey>?'
+            args.append(after)
+        for strkey, path in _merge_rows([conn.cursor().execute(
+                sql % db + ' order by strkey', args)
+                for db in _class_dbs(conn, cname)]):
+            yield cid, cname, strkey, _decode(path)
+
+##############################################################################
+def _instance_page(ClassName, namespace, Position, MaxObjectCount,
+        DeepInheritance, NamesOnly, LocalOnly=True, IncludeQualifiers=False,
+        IncludeClassOrigin=False, PropertyList=None):
+    conn = _get_generator_connection(namespace)
+    try:
+        classes = _class_tree_cids(conn, ClassName, DeepInheritance)
+        plans = {}
+        page = []
+        last = None
+        for cid, cname, strkey, obj in _keyset_scan(conn, classes, Position,
+                PropertyList, NamesOnly):
+            if len(page) >= MaxObjectCount:
+                # There is at least one more
+                return page, last or Position or START_POSITION
+            if not NamesOnly:
+                plan = plans.get(cid)
+                if plan is None:
+                    theclass = GetClass(cname, namespace, LocalOnly,
+                        IncludeQualifiers=True, IncludeClassOrigin=True,
+                        Connection=conn)
+                    plan = _ProjectionPlan(theclass, IncludeQualifiers,
+                        IncludeClassOrigin, PropertyList)
+                    plans[cid] = plan
+                obj = plan.apply(obj)
+            page.append(obj)
+            last = (cid, strkey)
+        return page, None
+    finally:
+        conn.close()
+
+##############################################################################
+def EnumerateInstancesPage(ClassName, namespace, Position=None,
+        MaxObjectCount=100, LocalOnly=True, DeepInheritance=True,
+        IncludeQualifiers=False, IncludeClassOrigin=False,
+        PropertyList=None):
+    """Return up to MaxObjectCount instances of a class and its subclasses
+    that follow Position, and the position of the next page, or None if
+    there are no more instances. Position None starts at the beginning.
+    ClassName may be a list of class names, to enumerate just those
+    classes."""
+    return _instance_page(ClassName, namespace, Position, MaxObjectCount,
+        DeepInheritance, False, LocalOnly, IncludeQualifiers,
+        IncludeClassOrigin, PropertyList)
+
+##############################################################################
+def EnumerateInstanceNamesPage(ClassName, namespace, Position=None,
+        MaxObjectCount=100):
+    """Like EnumerateInstancesPage, for instance names."""
+    return _instance_page(ClassName, namespace, Position, MaxObjectCount,
+        True, True)
+
+##############################################################################
+def _class_stats(conn, classes):
+    """Return the ClassStats rows of classes, a list of (cid, name), by
+    lower cased class name."""
+    cursor = conn.cursor()
+    stats = {}
+    for i in xrange(0, len(classes), 500):
+        chunk = [cname for cid, cname in classes[i:i + 500]]
+        for row in cursor.execute('select classname,ninstances,nbytes,'
+                'lastseq from ClassStats where classname in (%s)' %
+                ','.join(['?'] * len(chunk)), chunk):
+            stats[row[0].lower()] = row
+    return stats
+
+##############################################################################
+def CountInstances(ClassName, namespace, DeepInheritance=True,
+        Position=None):
+    """Return the number of instances of a class and its subclasses,
+    following Position if it is given."""
+    conn = _getdbconnection(namespace)
+    try:
+        classes = _class_tree_cids(conn, ClassName, DeepInheritance)
+        stats = _class_stats(conn, classes)
+        count = 0
+        cursor = conn.cursor()
+        for cid, cname in classes:
+            if Position is not None and cid < Position[0]:
+                continue
+            if Position is not None and cid == Position[0]:
+                n = 0
+                for db in _class_dbs(conn, cname):
+                    n += cursor.execute('select count(*) from %s.Instances '
+                        'where classname=? and strkey>?' % db,
+                        (cname, Position[1])).next()[0]
+            else:
+                n = stats.get(cname.lower(), (cname, 0))[1]
+            count += n
+        return count
+    finally:
+        conn.close(True)
+
+##############################################################################
+def _class_statistics(ninstances, nbytes, lastseq):
+    average = 0
+    if ninstances:
+        average = nbytes // ninstances
+    return {'InstanceCount': ninstances, 'TotalBytes': nbytes,
+        'AverageBytes': average, 'LastModified': lastseq}
+
+##############################################################################
+def GetClassStatistics(ClassName, namespace, DeepInheritance=False):
+    """Return the statistics of the stored instances of a class, and of its
+    subclasses if DeepInheritance: a dictionary with their InstanceCount,
+    TotalBytes and AverageBytes, and LastModified, the change sequence
+    number of the last write to any of them (0 if there was none).
+    ClassName may also be a list of class names, which are taken without
+    their subclasses."""
+    conn = _getdbconnection(namespace)
+    try:
+        if not DeepInheritance and isinstance(ClassName, basestring):
+            ClassName = [ClassName]
+        classes = _class_tree_cids(conn, ClassName, True)
+        ninstances = nbytes = lastseq = 0
+        for cname, n, b, seq in _class_stats(conn, classes).itervalues():
+            ninstances += n
+            nbytes += b
+            lastseq = max(lastseq, seq)
+        return _class_statistics(ninstances, nbytes, lastseq)
+    finally:
+        conn.close(True)
 
+##############################################################################
+def EnumerateClassStatistics(namespace, ClassNames=None):
+    """Return the (class name, statistics) of the classes ClassNames, not
+    including their subclasses, or of every class of the namespace that
+    has had instances, in class name order. The statistics are those
+    returned by GetClassStatistics."""
+    conn = _getdbconnection(namespace)
+    try:
+        if ClassNames is None:
+            cursor = conn.cursor()
+            rows = [x for x in cursor.execute('select classname,ninstances,'
+                'nbytes,lastseq from ClassStats')]
+        else:
+            classes = _class_tree_cids(conn, ClassNames, False)
+            stats = _class_stats(conn, classes)
+            rows = [stats.get(cname.lower(), (cname, 0, 0, 0))
+                for cid, cname in classes]
+        rows.sort(key=lambda x: x[0].lower())
+        return [(cname, _class_statistics(n, b, seq))
+            for cname, n, b, seq in rows]
+    finally:
+        conn.close(True)
+
+##############################################################################
+def SelectInstances(ClassNames, namespace, InstanceNames=None,
+        PropertyList=None, Probes=None):
+    """Yield the stored instances of the classes ClassNames, not including
+    their subclasses, with all their properties (or those in PropertyList)
+    and no qualifiers. With InstanceNames only the instances with those
+    names are read, by key, instead of every instance of the classes.
+    Likewise with Probes, a list of (index class, property name, operator,
+    value) lookups in property indexes (see IndexedProperties), only the
+    instances found by at least one of them are read."""
+    conn = _get_generator_connection(namespace)
+    try:
+        classes = _class_tree_cids(conn, ClassNames, False)
+        plans = {}
+        def plan(cname):
+            p = plans.get(cname.lower())
+            if p is None:
+                theclass = GetClass(cname, namespace, LocalOnly=False,
+                    IncludeQualifiers=True, IncludeClassOrigin=True,
+                    Connection=conn)
+                p = _ProjectionPlan(theclass, False, False, PropertyList)
+                plans[cname.lower()] = p
+            return p
+        if InstanceNames is None and Probes is not None:
+            wanted = set([cname.lower() for cid, cname in classes])
+            found = set()
+            for iclass, pname, op, value in Probes:
+                found.update([(cname, strkey) for cname, strkey in
+                    _probe_index(conn, iclass, pname, op, value)
+                    if cname.lower() in wanted])
+            cursor = conn.cursor()
+            for cname, strkey in sorted(found):
+                for data, in [x for x in cursor.execute('select data from '
+                        '%s.Instances where classname=? and strkey=?' %
+                        _key_string_db(conn, cname, strkey),
+                        (cname, strkey))]:
+                    ci = _decode(data, conn)
+                    if _class_layout(conn, cname) == LAYOUT_SPLIT:
+                        _load_properties(conn, ci, cname, strkey,
+                            PropertyList)
+                    yield plan(cname).apply(ci)
+        elif InstanceNames is None:
+            for cid, cname in classes:
+                for ci in _scan_instances(conn, cname, PropertyList):
+                    yield plan(cname).apply(ci)
+        else:
+            wanted = set([cname.lower() for cid, cname in classes])
+            cursor = conn.cursor()
+            for iname in InstanceNames:
+                strkey = _make_key_string(iname, namespace)
+                keyhash = _key_hash(strkey)
+                for cname, data in [x for db in _key_dbs(conn, keyhash)
+                        for x in cursor.execute('select classname,data from '
+                        '%s.Instances where keyhash=? and strkey=?' % db,
+                        (keyhash, strkey))]:
+                    if cname.lower() not in wanted:
+                        continue
+                    ci = _decode(data, conn)
+                    if _class_layout(conn, cname) == LAYOUT_SPLIT:
+                        _load_properties(conn, ci, cname, strkey,
+                            PropertyList)
+                    yield plan(cname).apply(ci)
         conn.close()
     except:
         conn.close()
         raise
 
 ##############################################################################
-def _make_key_string(iname):
+def _canonical_namespace(namespace):
+    return '/'.join([x for x in (namespace or '').split('/') if x]).lower()
+
+##############################################################################
+def _key_escape(s):
+    return s.replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=')
+
+##############################################################################
+def _key_value_string(value, namespace):
+    # Each value is tagged with its kind, so that e.g. the string 'true'
+    # and the boolean true do not encode the same way
+    if isinstance(value, pywbem.CIMInstanceName):
+        return u'r' + _make_key_string(value, namespace, True)
+    if isinstance(value, bool):
+        return value and u'btrue' or u'bfalse'
+    if isinstance(value, (int, long, float)):
+        return u'n' + unicode(value)
+    if isinstance(value, pywbem.CIMDateTime):
+        return u'd' + unicode(value)
+    if isinstance(value, str):
+        return u's' + value.decode('utf-8')
+    return u's' + unicode(value)
+
+##############################################################################
+def _make_key_string(iname, namespace=None, qualified=False):
+    """Return the canonical key string of an instance name.
+
+    Key names are lower cased and sorted, values are tagged with their
+    kind and escaped. References are encoded recursively and include their
+    class name and namespace, which defaults to the namespace of the
+    referencing instance. The instance's own class name and namespace are
+    only included when qualified is True, since every namespace is a
+    database of its own.
+    """
+    namespace = _canonical_namespace(iname.namespace or namespace)
     kl = []
-    # convert all values in keybindings to string
     for k,v in iname.keybindings.iteritems():
-        try:
-            # If this is a reference type, convert it
-            # to a string using this function
-            if isinstance(v, pywbem.CIMInstanceName):
-                tv = make_key_string(v)
-            else:
-                tv = str(v)
-        except TypeError:
-            tv = str(v)
-        kl.append([k.lower(),tv])
+        kl.append((k.lower(), _key_escape(_key_value_string(v, namespace))))
+    kl.sort()
+    strkey = u','.join([u'%s=%s' % x for x in kl])
+    if qualified:
+        strkey = u'%s:%s.%s' % (namespace, iname.classname.lower(), strkey)
+    return strkey
+
+##############################################################################
+def _key_hash(strkey):
+    """Return the signed 64 bit hash of a key string stored in the indexed
+    keyhash column of the Instances table."""
+    return struct.unpack('<q',
+        hashlib.sha1(strkey.encode('utf-8')).digest()[:8])[0]
+
+##############################################################################
+def _target_key(iname, namespace):
+    """Return the string identifying the instance a reference refers to.
+    It leaves out the class name, since a reference may name a superclass
+    of the instance's class, and instance keys are unique in a
+    namespace."""
+    namespace = _canonical_namespace(iname.namespace or namespace)
+    return u'%s:%s' % (namespace, _make_key_string(iname, namespace))
 
-    # Sort the list by the key names
-    kl.sort(key=lambda x:x[0])
-    # Combine key/value, flatten
-    kl = [''.join(x) for x in kl]
-    # Insert the namespace at the beginning of the list
-    kl.insert(0, iname.namespace)
-    # Create 1 string out of the list
-    return ''.join(kl)
+##############################################################################
+def _reference_rows(namespace, classname, strkey, instance):
+    """Return the RefIndex rows of the references of an instance."""
+    rows = []
+    for prop in instance.properties.itervalues():
+        value = prop.value
+        if not isinstance(value, pywbem.CIMInstanceName):
+            continue
+        rows.append((_key_hash(_target_key(value, namespace)), classname,
+            strkey, prop.name, _encode_path(value)))
+    return rows
 
 ##############################################################################
 def CreateInstance(NewInstance):
@@ -877,81 +4214,216 @@ def CreateInstance(NewInstance):
             'No key values for instance')
     class_name = NewInstance.classname;
     namespace = ipath.namespace
-    conn = _getdbconnection(namespace)
-    try:
-        theclass = GetClass(NewInstance.classname, namespace, 
-                LocalOnly=False, IncludeQualifiers=True, 
-                IncludeClassOrigin=True, Connection=conn)
-    except pywbem.CIMError:
-        conn.close(True)
-        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_CLASS,
-            'Class %s does not exist in namespace %s' \
-            % (NewInstance.classname, namespace))
-
-    try:
-        # Convert instance name to string
-        strkey = _make_key_string(NewInstance.path)
-        cursor = conn.cursor()
-        cursor.execute('select classname from Instances where strkey=?',
-                (strkey,))
+    def create_instance(conn):
         try:
-            cursor.next()
-            cursor.close(True)
-            conn.close(True)
+            theclass = GetClass(NewInstance.classname, namespace,
+                    LocalOnly=False, IncludeQualifiers=True,
+                    IncludeClassOrigin=True, Connection=conn)
+        except pywbem.CIMError:
+            raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_CLASS,
+                'Class %s does not exist in namespace %s' \
+                % (NewInstance.classname, namespace))
+
+        # Convert instance name to string
+        strkey = _make_key_string(NewInstance.path)
+        keyhash = _key_hash(strkey)
+        if _locate_instance(conn, strkey, keyhash) is not None:
             raise pywbem.CIMError(pywbem.CIM_ERR_ALREADY_EXISTS)
-        except StopIteration:
-            pass
 
         NewInstance.qualifiers = pywbem.NocaseDict()
         for prop in NewInstance.properties.itervalues():
             prop.qualifiers = pywbem.NocaseDict()
             prop.class_origin = None
 
-        pd = _encode(NewInstance)
-        cursor.execute('insert into Instances values(?,?,?);',
-                (class_name, strkey, pd))
+        _store_instance(conn, class_name, strkey, keyhash, NewInstance)
+    _run_write(namespace, create_instance)
+    return ipath
+
+##############################################################################
+def _existing_keys(conn, rows):
+    """Return the set of the key strings of rows, a list of (strkey,
+    keyhash), that are already stored."""
+    bydb = {}
+    for strkey, keyhash in rows:
+        for db in _key_dbs(conn, keyhash):
+            bydb.setdefault(db, []).append(keyhash)
+    cursor = conn.cursor()
+    found = set()
+    for db, keyhashes in bydb.iteritems():
+        for i in xrange(0, len(keyhashes), 500):
+            chunk = keyhashes[i:i + 500]
+            for strkey, in cursor.execute('select strkey from %s.Instances '
+                    'where keyhash in (%s)' % (db,
+                    ','.join(['?'] * len(chunk))), chunk):
+                found.add(strkey)
+    return found
+
+##############################################################################
+def _import_batch(namespace, batch, classes):
+    """Store a batch of (index, instance) in one transaction and return
+    the (index, CIMError) of the instances that were rejected."""
+    conn = _getdbconnection(namespace, write=True)
+    try:
+        return _store_batch(conn, namespace, batch, classes)
+    finally:
         conn.close(True)
-        return ipath
+
+##############################################################################
+def _store_batch(conn, namespace, batch, classes):
+    errors = []
+    rows = []
+    seen = set()
+    for index, inst in batch:
+        try:
+            ipath = inst.path
+            if not ipath or not ipath.keybindings:
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                    'No key values for instance')
+            if ipath.namespace and \
+                    _canonical_namespace(ipath.namespace) != \
+                    _canonical_namespace(namespace):
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                    'Instance is not in namespace %s' % namespace)
+            lname = inst.classname.lower()
+            if lname not in classes:
+                classes[lname] = _get_bare_class(conn,
+                    thename=inst.classname) is not None
+            if not classes[lname]:
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_CLASS,
+                    'Class %s does not exist in namespace %s' \
+                    % (inst.classname, namespace))
+            strkey = _make_key_string(ipath)
+            if strkey in seen:
+                raise pywbem.CIMError(pywbem.CIM_ERR_ALREADY_EXISTS)
+            seen.add(strkey)
+            rows.append((index, inst, strkey, _key_hash(strkey)))
+        except pywbem.CIMError, arg:
+            errors.append((index, arg))
+
+    cursor = conn.cursor()
+    _begin_write(conn)
+    try:
+        existing = _existing_keys(conn, [(r[2], r[3]) for r in rows])
+        # {database: (Instances rows, InstanceProperties rows)}
+        instrows = {}
+        refrows = []
+        idxrows = []
+        stored = []
+        sizes = {}
+        changes = []
+        for index, inst, strkey, keyhash in rows:
+            if strkey in existing:
+                errors.append((index,
+                    pywbem.CIMError(pywbem.CIM_ERR_ALREADY_EXISTS)))
+                continue
+            inst.qualifiers = pywbem.NocaseDict()
+            for prop in inst.properties.itervalues():
+                prop.qualifiers = pywbem.NocaseDict()
+                prop.class_origin = None
+            try:
+                row, props = _instance_rows(conn, inst.classname, strkey,
+                    keyhash, inst)
+            except Exception, arg:
+                errors.append((index,
+                    pywbem.CIMError(pywbem.CIM_ERR_FAILED, str(arg))))
+                continue
+            dbrows = instrows.setdefault(_instance_db(conn, inst.classname,
+                keyhash), ([], []))
+            dbrows[0].append(row)
+            dbrows[1].extend(props)
+            refrows.extend(_reference_rows(namespace, inst.classname, strkey,
+                inst))
+            idxrows.extend(_index_rows(conn, inst.classname, strkey, inst))
+            stored.append(inst.classname)
+            changes.append((CHANGE_INSTANCE, CHANGE_CREATE, inst.classname,
+                strkey, row[4]))
+            cname, ninstances, nbytes, last = sizes.get(
+                inst.classname.lower(), (inst.classname, 0, 0, 0))
+            sizes[cname.lower()] = (cname, ninstances + 1,
+                nbytes + _row_bytes(row, props), len(changes))
+        for db, (dbrows, proprows) in instrows.iteritems():
+            cursor.executemany('insert into %s.Instances(classname,strkey,'
+                    'data,keyhash,path) values(?,?,?,?,?);' % db, dbrows)
+            if proprows:
+                cursor.executemany('insert into %s.InstanceProperties '
+                    'values(?,?,?,?)' % db, proprows)
+        if refrows:
+            cursor.executemany('insert into RefIndex values(?,?,?,?,?)',
+                refrows)
+        if idxrows:
+            cursor.executemany('insert or ignore into PropIndexData '
+                'values(?,?,?,?,?)', idxrows)
+        if changes:
+            seq = _log_changes(conn, changes)
+            for cname, ninstances, nbytes, last in sizes.itervalues():
+                _count_instances(conn, cname, ninstances, nbytes,
+                    seq - len(changes) + last)
+        for cname in stored:
+            _instance_written(conn, cname)
+        cursor.execute('COMMIT')
     except:
-        conn.close(True)
+        cursor.execute('ROLLBACK')
+        # Training may have registered dictionaries that were rolled back
+        _zdicts.invalidate(conn.dbname)
         raise
+    errors.sort()
+    return errors
+
+##############################################################################
+def ImportInstances(instances, namespace, BatchSize=None):
+    """Store the instances of an iterable in namespace, BatchSize at a time
+    in a single transaction each, and yield the (index, CIMError) of every
+    instance that could not be created. The other instances are stored
+    regardless."""
+    if BatchSize is None:
+        BatchSize = _BULK_BATCHSIZE
+    if not _namespace_exists(namespace):
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE)
+    # Each batch checks out a connection of its own, so that none is held
+    # while the caller or the iterable has control
+    classes = {}
+    batch = []
+    for index, inst in enumerate(instances):
+        batch.append((index, inst))
+        if len(batch) >= BatchSize:
+            for error in _import_batch(namespace, batch, classes):
+                yield error
+            batch = []
+    if batch:
+        for error in _import_batch(namespace, batch, classes):
+            yield error
+
+##############################################################################
+def CreateInstances(instances, namespace, BatchSize=None):
+    """Create many instances in namespace. Returns the list of (index,
+    CIMError) of the instances that could not be created."""
+    return list(ImportInstances(instances, namespace, BatchSize))
 
 ##############################################################################
 def DeleteInstance(InstanceName):
-    conn = _getdbconnection(InstanceName.namespace)
-    # Ensure the class exists
-    try:
-        oldcid, oldcc = _get_bare_class(conn, thename=ModifiedClass.classname)
-    except TypeError:
-        conn.close(True)
-        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_CLASS)
+    def delete_instance(conn):
+        # Ensure the class exists
+        try:
+            oldcid, oldcc = _get_bare_class(conn,
+                thename=InstanceName.classname)
+        except TypeError:
+            raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_CLASS)
 
-    try:
         # Convert instance name to string
         strkey = _make_key_string(InstanceName)
-        cursor = conn.cursor()
-        cursor.execute('select classname from Instances where strkey=?',
-                (strkey,))
-        try:
-            cursor.next()
-            cursor.close(True)
-        except StopIteration:
+        keyhash = _key_hash(strkey)
+        found = _locate_instance(conn, strkey, keyhash)
+        if found is None:
             raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
+        cname = found[1]
         
-        cursor = conn.cursor()
-        # TODO deal with associations
-        cursor.execute(
-            'delete from Instances where strkey=?', (strkey,))
-        conn.close(True)
-    except: 
-        conn.close(True)
-        raise
+        _remove_instance(conn, cname, strkey, keyhash)
+    _run_write(InstanceName.namespace, delete_instance)
 
 ##############################################################################
 def ModifyInstance(ModifiedInstance, PropertyList=None):
-    conn = _getdbconnection(ModifiedInstance.path.namespace)
     ipath = ModifiedInstance.path
-    try:
+    def modify_instance(conn):
         oldci = GetInstance(ipath, LocalOnly=False,
                     IncludeQualifiers=True, IncludeClassOrigin=False,
                     PropertyList=None, Connection=conn)
@@ -974,15 +4446,804 @@ def ModifyInstance(ModifiedInstance, PropertyList=None):
                     oldci[propname] = prop
 
         strkey = _make_key_string(ipath)
-        pci = _encode(oldci)
+        _store_instance(conn, oldci.classname, strkey, _key_hash(strkey),
+            oldci, update=True)
+    _run_write(ipath.namespace, modify_instance)
+
+##############################################################################
+# Property indexes.
+#
+# A property index is declared on a class and covers the instances of the
+# class and of its subclasses. Every write maintains the PropIndexData
+# rows of the indexes covering the instance's class, including indexes
+# that are still being built; lookups only use indexes that are ready.
+# Indexes on reference properties have no rows of their own: they are
+# served by RefIndex.
+
+# Instances indexed per transaction by an index build
+_INDEX_BUILD_CHUNK = 500
+
+# {lower case class name: [(index class, property name)]} of the indexes
+# covering each class, by database
+_propindexes = TableCache()
+
+##############################################################################
+def _indexed_properties(conn, classname):
+    byclass = _propindexes.get(conn.dbname)
+    if byclass is None:
+        byclass = {}
+        _propindexes.put(conn.dbname, _propindexes.generation(conn.dbname),
+            byclass)
+    lname = classname.lower()
+    indexes = byclass.get(lname)
+    if indexes is None:
         cursor = conn.cursor()
-        cursor.execute('update Instances set data=? where strkey=?',
-                (pci, strkey))
-        conn.close(True)
+        names = set([lname])
+        for name, in cursor.execute('select name from Classes where cid in '
+                '(select supercid from SuperClasses where subcid in '
+                '(select cid from Classes where name=?))', (classname,)):
+            names.add(name.lower())
+        indexes = [(cname, pname) for cname, pname in cursor.execute(
+            'select classname,propname from PropIndexes')
+            if cname.lower() in names]
+        byclass[lname] = indexes
+    return indexes
+
+##############################################################################
+def _index_value(value):
+    """Return the value stored in PropIndexData for a property value, or
+    None if it is not indexed."""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, long, float)):
+        return value
+    if isinstance(value, basestring):
+        return unicode(value)
+    if isinstance(value, pywbem.CIMDateTime):
+        return unicode(value)
+    return None
+
+##############################################################################
+def _property_index_rows(iclass, pname, classname, strkey, instance):
+    """Return the rows of an instance in the index of iclass.pname."""
+    prop = instance.properties.get(pname)
+    if prop is None or prop.value is None:
+        return []
+    values = prop.value
+    if not isinstance(values, list):
+        # Arrays have a row for each element
+        values = [values]
+    rows = []
+    for v in values:
+        v = _index_value(v)
+        if v is not None:
+            rows.append((iclass, pname, v, classname, strkey))
+    return rows
+
+##############################################################################
+def _index_rows(conn, classname, strkey, instance):
+    """Return the PropIndexData rows of an instance."""
+    rows = []
+    for iclass, pname in _indexed_properties(conn, classname):
+        rows.extend(_property_index_rows(iclass, pname, classname, strkey,
+            instance))
+    return rows
+
+##############################################################################
+def _build_index(namespace, ClassName, PropertyName):
+    """Index the existing instances. If that fails the index is left in
+    the 'failed' state, still maintained by writers, and CreatePropertyIndex
+    builds it again."""
+    try:
+        _fill_index(namespace, ClassName, PropertyName)
     except:
+        exc_info = sys.exc_info()
+        conn = _getdbconnection(namespace, write=True)
+        try:
+            cursor = conn.cursor()
+            _begin_write(conn)
+            try:
+                cursor.execute('update PropIndexes set state=? where '
+                    'classname=? and propname=? and state=?',
+                    ('failed', ClassName, PropertyName, 'building'))
+                if conn.changes():
+                    _log_change(conn, CHANGE_INDEX, CHANGE_MODIFY,
+                        ClassName)
+                cursor.execute('COMMIT')
+            except:
+                cursor.execute('ROLLBACK')
+        finally:
+            conn.close(True)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+##############################################################################
+def _fill_index(namespace, ClassName, PropertyName):
+    """Index the existing instances, a chunk per transaction, so readers
+    and other writers are only held up for one chunk at a time."""
+    position = None
+    while True:
+        conn = _getdbconnection(namespace, write=True)
+        try:
+            cursor = conn.cursor()
+            _begin_write(conn)
+            try:
+                state = [x for x, in cursor.execute('select state from '
+                    'PropIndexes where classname=? and propname=?',
+                    (ClassName, PropertyName))]
+                if not state:
+                    # Dropped in the meantime
+                    cursor.execute('COMMIT')
+                    return
+                classes = _class_tree_cids(conn, ClassName, True)
+                rows = []
+                n = 0
+                last = None
+                for cid, cname, strkey, ci in _keyset_scan(conn, classes,
+                        position, [PropertyName], False):
+                    if n == _INDEX_BUILD_CHUNK:
+                        break
+                    rows.extend(_property_index_rows(ClassName,
+                        PropertyName, cname, strkey, ci))
+                    n += 1
+                    last = (cid, strkey)
+                else:
+                    last = None
+                cursor.executemany('insert or ignore into PropIndexData '
+                    'values(?,?,?,?,?)', rows)
+                if last is None:
+                    cursor.execute('update PropIndexes set state=? where '
+                        'classname=? and propname=?',
+                        ('ready', ClassName, PropertyName))
+                    _log_change(conn, CHANGE_INDEX, CHANGE_MODIFY,
+                        ClassName)
+                cursor.execute('COMMIT')
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close(True)
+        if last is None:
+            _propindexes.pop(_makedbname(namespace), None)
+            return
+        position = last
+
+##############################################################################
+def CreatePropertyIndex(ClassName, PropertyName, namespace,
+        Background=False):
+    """Declare an index on a property of a class and its subclasses, and
+    index the existing instances. The index is used once that is done.
+    Writes to the class may go on while it is built; with Background the
+    build runs in a thread of its own and this returns at once. An index
+    whose build failed or was cut short ('failed' or 'building' in
+    EnumeratePropertyIndexes) is built again."""
+    conn = _getdbconnection(namespace, write=True)
+    try:
+        try:
+            cc = _get_class(conn, ClassName, namespace, LocalOnly=False)[1]
+        except pywbem.CIMError:
+            raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_CLASS, ClassName)
+        prop = cc.properties.get(PropertyName)
+        if prop is None:
+            raise pywbem.CIMError(pywbem.CIM_ERR_NO_SUCH_PROPERTY,
+                PropertyName)
+        ClassName = cc.classname
+        PropertyName = prop.name
+        cursor = conn.cursor()
+        _begin_write(conn)
+        try:
+            old = [x for x, in cursor.execute('select state from '
+                'PropIndexes where classname=? and propname=?',
+                (ClassName, PropertyName))]
+            if old == ['ready']:
+                raise pywbem.CIMError(pywbem.CIM_ERR_ALREADY_EXISTS)
+            if prop.type == 'reference':
+                state = 'ready'
+            else:
+                state = 'building'
+            if old:
+                # Writers have kept the index up to date all along, so the
+                # existing instances can be indexed again on top of it
+                cursor.execute('update PropIndexes set state=? where '
+                    'classname=? and propname=?',
+                    (state, ClassName, PropertyName))
+                _log_change(conn, CHANGE_INDEX, CHANGE_MODIFY, ClassName)
+            else:
+                cursor.execute('insert into PropIndexes values(?,?,?)',
+                    (ClassName, PropertyName, state))
+                _log_change(conn, CHANGE_INDEX, CHANGE_CREATE, ClassName)
+            # Writers look the indexes up inside their transaction, so
+            # none can miss this one once it is committed
+            _propindexes.pop(conn.dbname, None)
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close(True)
+    _propindexes.pop(_makedbname(namespace), None)
+    if state == 'ready':
+        return
+    if Background:
+        t = threading.Thread(target=_build_index,
+            args=(namespace, ClassName, PropertyName),
+            name='cimdb index %s.%s' % (ClassName, PropertyName))
+        t.setDaemon(True)
+        t.start()
+    else:
+        _build_index(namespace, ClassName, PropertyName)
+
+##############################################################################
+def DropPropertyIndex(ClassName, PropertyName, namespace):
+    conn = _getdbconnection(namespace, write=True)
+    try:
+        cursor = conn.cursor()
+        _begin_write(conn)
+        try:
+            if not [x for x in cursor.execute('select state from '
+                    'PropIndexes where classname=? and propname=?',
+                    (ClassName, PropertyName))]:
+                raise pywbem.CIMError(pywbem.CIM_ERR_NOT_FOUND)
+            cursor.execute('delete from PropIndexes where classname=? and '
+                'propname=?', (ClassName, PropertyName))
+            cursor.execute('delete from PropIndexData where classname=? and '
+                'propname=?', (ClassName, PropertyName))
+            _log_change(conn, CHANGE_INDEX, CHANGE_DELETE, ClassName)
+            _propindexes.pop(conn.dbname, None)
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close(True)
+    _propindexes.pop(_makedbname(namespace), None)
+
+##############################################################################
+def EnumeratePropertyIndexes(namespace):
+    """Return the (class name, property name, state) of the property
+    indexes of a namespace. state is 'building', 'ready' or 'failed'."""
+    conn = _getdbconnection(namespace)
+    try:
+        cursor = conn.cursor()
+        return [x for x in cursor.execute('select classname,propname,state '
+            'from PropIndexes order by classname,propname')]
+    finally:
+        conn.close(True)
+
+##############################################################################
+def IndexedProperties(ClassName, namespace):
+    """Return a dictionary from the lower cased names of the properties of
+    ClassName with a ready index that covers it to the class the index is
+    declared on."""
+    conn = _getdbconnection(namespace)
+    try:
+        cursor = conn.cursor()
+        names = set([ClassName.lower()])
+        for name, in cursor.execute('select name from Classes where cid in '
+                '(select supercid from SuperClasses where subcid in '
+                '(select cid from Classes where name=?))', (ClassName,)):
+            names.add(name.lower())
+        indexed = {}
+        for cname, pname in cursor.execute('select classname,propname from '
+                'PropIndexes where state=?', ('ready',)):
+            if cname.lower() in names:
+                indexed[pname.lower()] = cname
+        return indexed
+    finally:
         conn.close(True)
+
+##############################################################################
+_INDEX_OPS = ['=', '<', '<=', '>', '>=']
+
+##############################################################################
+def _probe_index(conn, IndexClass, PropertyName, Operator, Value):
+    """Return the (class name, key string) of the instances in a property
+    index whose value compares with Value as Operator says."""
+    if Operator not in _INDEX_OPS:
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+            'Unsupported operator %s' % Operator)
+    cursor = conn.cursor()
+    if isinstance(Value, pywbem.CIMInstanceName):
+        if Operator != '=':
+            raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                'References can only be compared with =')
+        namespace = _dbnamespace(conn.dbname)
+        key = _target_key(Value, namespace)
+        found = []
+        for cname, strkey, target in cursor.execute('select classname,'
+                'strkey,target from RefIndex where targethash=? and role=?',
+                (_key_hash(key), PropertyName)):
+            if _target_key(_decode(target), namespace) == key:
+                found.append((cname, strkey))
+        return found
+    value = _index_value(Value)
+    if value is None:
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+            'Unsupported value %r' % (Value,))
+    return [x for x in cursor.execute('select instclass,strkey from '
+        'PropIndexData where classname=? and propname=? and value%s?'
+        % Operator, (IndexClass, PropertyName, value))]
+
+##############################################################################
+def FindInstanceNames(ClassName, namespace, PropertyName, Value,
+        Operator='='):
+    """Yield the names of the instances of ClassName and its subclasses
+    whose property PropertyName compares with Value as Operator says (one
+    of =, <, <=, >, >=), or for an array property, has an element that
+    does. A property index covering the class is used when there is one,
+    and the instances are scanned otherwise. A reference Value, a
+    CIMInstanceName, is looked up in RefIndex."""
+    indexed = IndexedProperties(ClassName, namespace)
+    conn = _get_generator_connection(namespace)
+    try:
+        classes = _class_tree_cids(conn, ClassName, True)
+        wanted = set([cname.lower() for cid, cname in classes])
+        cursor = conn.cursor()
+        iclass = indexed.get(PropertyName.lower())
+        if iclass is not None or isinstance(Value, pywbem.CIMInstanceName):
+            # An array property has an index row for each matching element
+            seen = set()
+            for cname, strkey in _probe_index(conn, iclass, PropertyName,
+                    Operator, Value):
+                if cname.lower() not in wanted or \
+                        (cname.lower(), strkey) in seen:
+                    continue
+                seen.add((cname.lower(), strkey))
+                for path, in cursor.execute('select path from %s.Instances '
+                        'where classname=? and strkey=?' % _key_string_db(conn,
+                        cname, strkey), (cname, strkey)):
+                    iname = _decode(path)
+                    iname.namespace = namespace
+                    yield iname
+        else:
+            # Compared as the index would, element by element for arrays
+            compare = {'=': operator.eq, '<': operator.lt, '<=': operator.le,
+                '>': operator.gt, '>=': operator.ge}.get(Operator)
+            if compare is None:
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                    'Unsupported operator %s' % Operator)
+            value = _index_value(Value)
+            if value is None:
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+                    'Unsupported value %r' % (Value,))
+            for cid, cname in classes:
+                for ci in _scan_instances(conn, cname, [PropertyName]):
+                    prop = ci.properties.get(PropertyName)
+                    if prop is None or prop.value is None:
+                        continue
+                    values = prop.value
+                    if not isinstance(values, list):
+                        values = [values]
+                    if [v for v in values if _index_value(v) is not None
+                            and compare(_index_value(v), value)]:
+                        iname = ci.path.copy()
+                        iname.namespace = namespace
+                        yield iname
+        conn.close()
+    except:
+        conn.close()
         raise
 
+##############################################################################
+# Association traversal.
+#
+# Instance traversals start from the RefIndex rows of the association
+# instances that refer to the source instance, found through the
+# targethash index, and read the other references of each association from
+# the same table. Association instances are only read by References.
+# Class traversals use RefInfo, which holds the reference properties of
+# every resolved class.
+
+##############################################################################
+def _class_names(conn, ClassName):
+    """Return the lower cased names of ClassName and of its subclasses, or
+    None if ClassName is None."""
+    if ClassName is None:
+        return None
+    t = _get_bare_class(conn, thename=ClassName)
+    if t is None:
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+            'Class %s does not exist' % ClassName)
+    names = set([ClassName.lower()])
+    cursor = conn.cursor()
+    for name, in cursor.execute('select name from Classes where cid in '
+            '(select subcid from SuperClasses where supercid=?)', (t[0],)):
+        names.add(name.lower())
+    return names
+
+##############################################################################
+def _traversal_connection(ObjectName):
+    if ObjectName.namespace is None:
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_NAMESPACE)
+    return _get_generator_connection(ObjectName.namespace)
+
+##############################################################################
+def _reference_hits(conn, ObjectName, AssocClass, Role):
+    """Return the (association class name, key string, role) of the
+    association instances that refer to ObjectName."""
+    namespace = ObjectName.namespace
+    key = _target_key(ObjectName, namespace)
+    assocs = _class_names(conn, AssocClass)
+    sql = 'select classname,strkey,role,target from RefIndex where ' \
+        'targethash=?'
+    args = [_key_hash(key)]
+    if Role is not None:
+        sql += ' and role=?'
+        args.append(Role)
+    hits = []
+    cursor = conn.cursor()
+    for cname, strkey, role, target in cursor.execute(sql, args):
+        if assocs is not None and cname.lower() not in assocs:
+            continue
+        # Rule out targethash collisions
+        if _target_key(_decode(target), namespace) != key:
+            continue
+        hits.append((cname, strkey, role))
+    return hits
+
+##############################################################################
+def _associator_names(conn, ObjectName, AssocClass, ResultClass, Role,
+        ResultRole):
+    namespace = ObjectName.namespace
+    results = _class_names(conn, ResultClass)
+    seen = set()
+    cursor = conn.cursor()
+    for cname, strkey, role in _reference_hits(conn, ObjectName, AssocClass,
+            Role):
+        for farrole, target in cursor.execute('select role,target from '
+                'RefIndex where classname=? and strkey=?', (cname, strkey)):
+            if farrole.lower() == role.lower():
+                continue
+            if ResultRole is not None and \
+                    farrole.lower() != ResultRole.lower():
+                continue
+            iname = _decode(target)
+            if results is not None and \
+                    iname.classname.lower() not in results:
+                continue
+            if iname.namespace is None:
+                iname.namespace = namespace
+            key = _target_key(iname, namespace)
+            if key not in seen:
+                seen.add(key)
+                yield iname
+
+##############################################################################
+def _reference_names(conn, ObjectName, ResultClass, Role):
+    cursor = conn.cursor()
+    for cname, strkey, role in _reference_hits(conn, ObjectName,
+            ResultClass, Role):
+        for path, in cursor.execute('select path from %s.Instances where '
+                'classname=? and strkey=?' % _key_string_db(conn, cname,
+                strkey), (cname, strkey)):
+            iname = _decode(path)
+            iname.namespace = ObjectName.namespace
+            yield iname
+
+##############################################################################
+def _class_refinfo(conn, ClassName):
+    """Return the (association cid, role) of the reference properties that
+    refer to ClassName or to one of its superclasses."""
+    t = _get_bare_class(conn, thename=ClassName)
+    if t is None:
+        raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER,
+            'Class %s does not exist' % ClassName)
+    cursor = conn.cursor()
+    return [x for x in cursor.execute('select assoccid,refpropname from '
+        'RefInfo where refpropcid=? or refpropcid in (select supercid from '
+        'SuperClasses where subcid=?)', (t[0], t[0]))]
+
+##############################################################################
+def _class_reference_names(conn, ClassName, ResultClass, Role):
+    assocs = _class_names(conn, ResultClass)
+    cursor = conn.cursor()
+    seen = set()
+    for cid, role in _class_refinfo(conn, ClassName):
+        if Role is not None and role.lower() != Role.lower():
+            continue
+        name, = cursor.execute('select name from Classes where cid=?',
+            (cid,)).next()
+        if assocs is not None and name.lower() not in assocs:
+            continue
+        if name.lower() not in seen:
+            seen.add(name.lower())
+            yield name
+
+##############################################################################
+def _class_associator_names(conn, ClassName, AssocClass, ResultClass, Role,
+        ResultRole):
+    assocs = _class_names(conn, AssocClass)
+    results = _class_names(conn, ResultClass)
+    cursor = conn.cursor()
+    seen = set()
+    for cid, role in _class_refinfo(conn, ClassName):
+        if Role is not None and role.lower() != Role.lower():
+            continue
+        if assocs is not None:
+            name, = cursor.execute('select name from Classes where cid=?',
+                (cid,)).next()
+            if name.lower() not in assocs:
+                continue
+        for farrole, name in [x for x in cursor.execute('select '
+                'r.refpropname,c.name from RefInfo r join Classes c on '
+                'c.cid=r.refpropcid where r.assoccid=?', (cid,))]:
+            if farrole.lower() == role.lower():
+                continue
+            if ResultRole is not None and \
+                    farrole.lower() != ResultRole.lower():
+                continue
+            if results is not None and name.lower() not in results:
+                continue
+            if name.lower() not in seen:
+                seen.add(name.lower())
+                yield name
+
+##############################################################################
+def _class_path(name, namespace):
+    return pywbem.CIMClassName(name, namespace=namespace)
+
+##############################################################################
+def AssociatorNames(ObjectName, AssocClass=None, ResultClass=None,
+        Role=None, ResultRole=None):
+    """Yield the names of the instances associated with the instance
+    ObjectName, or the class names of the classes associated with the
+    class ObjectName, a CIMClassName."""
+    conn = _traversal_connection(ObjectName)
+    try:
+        if isinstance(ObjectName, pywbem.CIMClassName):
+            for name in _class_associator_names(conn, ObjectName.classname,
+                    AssocClass, ResultClass, Role, ResultRole):
+                yield _class_path(name, ObjectName.namespace)
+        else:
+            for iname in _associator_names(conn, ObjectName, AssocClass,
+                    ResultClass, Role, ResultRole):
+                yield iname
+        conn.close()
+    except:
+        conn.close()
+        raise
+
+##############################################################################
+def Associators(ObjectName, AssocClass=None, ResultClass=None, Role=None,
+        ResultRole=None, IncludeQualifiers=False, IncludeClassOrigin=False,
+        PropertyList=None):
+    """Like AssociatorNames, for the instances or classes themselves.
+    Instances that are referred to but do not exist are left out."""
+    conn = _traversal_connection(ObjectName)
+    namespace = ObjectName.namespace
+    try:
+        if isinstance(ObjectName, pywbem.CIMClassName):
+            for name in _class_associator_names(conn, ObjectName.classname,
+                    AssocClass, ResultClass, Role, ResultRole):
+                yield GetClass(name, namespace, LocalOnly=False,
+                    IncludeQualifiers=IncludeQualifiers,
+                    IncludeClassOrigin=IncludeClassOrigin,
+                    PropertyList=PropertyList, Connection=conn)
+        else:
+            local = _canonical_namespace(namespace)
+            for iname in _associator_names(conn, ObjectName, AssocClass,
+                    ResultClass, Role, ResultRole):
+                if _canonical_namespace(iname.namespace) == local:
+                    iconn = conn
+                else:
+                    iconn = None
+                try:
+                    yield GetInstance(iname, LocalOnly=False,
+                        IncludeQualifiers=IncludeQualifiers,
+                        IncludeClassOrigin=IncludeClassOrigin,
+                        PropertyList=PropertyList, Connection=iconn)
+                except pywbem.CIMError, arg:
+                    if arg.args[0] not in (pywbem.CIM_ERR_NOT_FOUND,
+                            pywbem.CIM_ERR_INVALID_NAMESPACE):
+                        raise
+        conn.close()
+    except:
+        conn.close()
+        raise
+
+##############################################################################
+def ReferenceNames(ObjectName, ResultClass=None, Role=None):
+    """Yield the names of the association instances that refer to the
+    instance ObjectName, or the class names of the association classes
+    that refer to the class ObjectName, a CIMClassName."""
+    conn = _traversal_connection(ObjectName)
+    try:
+        if isinstance(ObjectName, pywbem.CIMClassName):
+            for name in _class_reference_names(conn, ObjectName.classname,
+                    ResultClass, Role):
+                yield _class_path(name, ObjectName.namespace)
+        else:
+            for iname in _reference_names(conn, ObjectName, ResultClass,
+                    Role):
+                yield iname
+        conn.close()
+    except:
+        conn.close()
+        raise
+
+##############################################################################
+def References(ObjectName, ResultClass=None, Role=None,
+        IncludeQualifiers=False, IncludeClassOrigin=False,
+        PropertyList=None):
+    """Like ReferenceNames, for the instances or classes themselves."""
+    conn = _traversal_connection(ObjectName)
+    namespace = ObjectName.namespace
+    try:
+        if isinstance(ObjectName, pywbem.CIMClassName):
+            for name in _class_reference_names(conn, ObjectName.classname,
+                    ResultClass, Role):
+                yield GetClass(name, namespace, LocalOnly=False,
+                    IncludeQualifiers=IncludeQualifiers,
+                    IncludeClassOrigin=IncludeClassOrigin,
+                    PropertyList=PropertyList, Connection=conn)
+        else:
+            for iname in _reference_names(conn, ObjectName, ResultClass,
+                    Role):
+                yield GetInstance(iname, LocalOnly=False,
+                    IncludeQualifiers=IncludeQualifiers,
+                    IncludeClassOrigin=IncludeClassOrigin,
+                    PropertyList=PropertyList, Connection=conn)
+        conn.close()
+    except:
+        conn.close()
+        raise
+
+##############################################################################
+def _upgrade_keyhash(conn):
+    # Version 1: canonical key strings and the indexed keyhash column
+    cursor = conn.cursor()
+    cursor.execute('ALTER TABLE Instances ADD COLUMN '
+        'keyhash INTEGER NOT NULL DEFAULT 0')
+    rows = []
+    for rowid, data in cursor.execute('select rowid,data from Instances'):
+        strkey = _make_key_string(_decode(data).path)
+        rows.append((strkey, _key_hash(strkey), rowid))
+    cursor.executemany('update Instances set strkey=?, keyhash=? '
+        'where rowid=?', rows)
+    cursor.execute('CREATE INDEX InstKeyHashNDX on Instances(keyhash)')
+
+##############################################################################
+def _upgrade_zdicts(conn):
+    # Version 2: compression dictionaries
+    cursor = conn.cursor()
+    cursor.execute('CREATE TABLE ClassDicts('
+            'dictid INTEGER PRIMARY KEY AUTOINCREMENT,'
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'data BLOB NOT NULL,'
+            'ninstances INTEGER NOT NULL);'
+        'CREATE INDEX ClassDictsNDX on ClassDicts(classname);')
+
+##############################################################################
+def _upgrade_paths(conn):
+    # Version 3: instance paths stored in their own column
+    cursor = conn.cursor()
+    cursor.execute('ALTER TABLE Instances ADD COLUMN path BLOB')
+    rows = []
+    for rowid, data in cursor.execute('select rowid,data from Instances'):
+        rows.append((_encode_path(_decode(data).path), rowid))
+    cursor.executemany('update Instances set path=? where rowid=?', rows)
+    cursor.execute('CREATE INDEX InstPathNDX on '
+        'Instances(classname COLLATE NOCASE, path)')
+
+##############################################################################
+def _upgrade_layouts(conn):
+    # Version 4: per class storage layouts
+    cursor = conn.cursor()
+    cursor.execute('CREATE TABLE ClassStorage('
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'layout TEXT NOT NULL,'
+            'PRIMARY KEY(classname COLLATE NOCASE));'
+        'CREATE TABLE InstanceProperties('
+            'classname TEXT NOT NULL COLLATE NOCASE,'
+            'strkey TEXT NOT NULL,'
+            'name TEXT NOT NULL COLLATE NOCASE,'
+            'data BLOB NOT NULL,'
+            'PRIMARY KEY(classname COLLATE NOCASE, strkey, '
+                'name COLLATE NOCASE));')
+
+##############################################################################
+def _upgrade_resolved(conn):
+    # Version 5: materialized resolved classes
+    cursor = conn.cursor()
+    cursor.execute('CREATE TABLE ResolvedClasses('
+            'cid INTEGER PRIMARY KEY,'
+            'data BLOB NOT NULL);')
+    roots = [x for x in cursor.execute('select cid,data from Classes where '
+        'cid not in (select subcid from SuperClasses where depth=1);')]
+    for cid, data in roots:
+        _materialize_classes(conn, cid, _decode(data))
+
+##############################################################################
+class _UpgradeConnection(object):
+    """A bare connection, with the dbname that the caches of decoded blobs
+    are keyed on. Upgrades run before any class is sharded."""
+    shards = {}
+    def __init__(self, conn):
+        self.conn = conn
+        self.dbname = conn.filename
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+##############################################################################
+def _upgrade_refindex(conn):
+    # Version 6: RefInfo and the RefIndex of association references
+    cursor = conn.cursor()
+    cursor.execute(_REFINDEX_SCHEMA)
+    for cid, data in [x for x in cursor.execute('select cid,data from '
+            'ResolvedClasses')]:
+        _store_refinfo(conn, cid, _decode(data))
+    conn = _UpgradeConnection(conn)
+    namespace = _dbnamespace(conn.dbname)
+    assocs = [x for x, in cursor.execute('select distinct c.name from '
+        'Classes c join RefInfo r on r.assoccid=c.cid')]
+    for cname in assocs:
+        rows = []
+        for strkey, ci in _scan_rows(conn, cname):
+            rows.extend(_reference_rows(namespace, cname, strkey, ci))
+        cursor.executemany('insert into RefIndex values(?,?,?,?,?)', rows)
+    _layouts.pop(conn.dbname, None)
+
+##############################################################################
+def _upgrade_propindexes(conn):
+    # Version 7: property indexes
+    cursor = conn.cursor()
+    cursor.execute(_PROPINDEX_SCHEMA)
+
+##############################################################################
+def _upgrade_classstats(conn):
+    # Version 8: class statistics
+    cursor = conn.cursor()
+    cursor.execute(_STATS_SCHEMA)
+    cursor.execute('insert into ClassStats select classname,count(*),'
+        'sum(length(data)),0 from Instances group by classname')
+    rows = [(n, cname) for cname, n in cursor.execute('select classname,'
+        'sum(length(data)) from InstanceProperties group by classname')]
+    cursor.executemany('update ClassStats set nbytes=nbytes+? where '
+        'classname=?', rows)
+
+##############################################################################
+def _upgrade_changelog(conn):
+    # Version 9: the change log. It has none of the earlier changes, which
+    # count as one that was trimmed.
+    cursor = conn.cursor()
+    cursor.execute(_CHANGELOG_SCHEMA)
+    cursor.execute('update ChangeSequence set seq=seq+1')
+    cursor.execute('update ChangeLogHorizon set seq=(select seq from '
+        'ChangeSequence)')
+
+##############################################################################
+def _upgrade_shards(conn):
+    # Version 10: class shards
+    cursor = conn.cursor()
+    cursor.execute('ALTER TABLE ClassStorage ADD COLUMN '
+        'shards INTEGER NOT NULL DEFAULT 0')
+
+##############################################################################
+def _upgrade_changelog_meta(conn):
+    # Version 11: index of the changes that are not to instances
+    cursor = conn.cursor()
+    cursor.execute(_CHANGELOG_META_SCHEMA)
+
+##############################################################################
+def _upgrade_zdict_ids(conn):
+    # Version 12: dictids are never reused, since other processes may
+    # still have the dictionary of a deleted class cached under its id
+    cursor = conn.cursor()
+    (sql,), = cursor.execute("select sql from sqlite_master "
+        "where name='ClassDicts'").fetchall()
+    if 'AUTOINCREMENT' in sql:
+        return
+    cursor.execute('ALTER TABLE ClassDicts RENAME TO OldClassDicts;'
+        'DROP INDEX ClassDictsNDX;')
+    _upgrade_zdicts(conn)
+    cursor.execute('insert into ClassDicts select * from OldClassDicts;'
+        'DROP TABLE OldClassDicts;')
+
+# _UPGRADES[n] upgrades a database from version n to n + 1
+_UPGRADES = [_upgrade_keyhash, _upgrade_zdicts, _upgrade_paths,
+    _upgrade_layouts, _upgrade_resolved, _upgrade_refindex,
+    _upgrade_propindexes, _upgrade_classstats, _upgrade_changelog,
+    _upgrade_shards, _upgrade_changelog_meta, _upgrade_zdict_ids]
+
 #if __name__ == '__main__':
 #   Testing
 
@@ -0,0 +1,576 @@
+#
+# (C) Copyright 2007 Novell, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+"""Instance queries in a subset of WQL and CQL.
+
+    SELECT * | prop [, prop]... FROM class [[AS] alias] [WHERE condition]
+
+A condition combines comparisons of properties with literals (=, <>, !=,
+<, <=, >, >=), IS [NOT] NULL tests and ISA tests with AND, OR, NOT and
+parentheses. "class ISA subclass", where class is the FROM class or its
+alias, selects the instances of subclass; "prop ISA class" tests the class
+of the instance a reference property refers to.
+
+Queries on classes stored in the repository only read the classes left
+after ISA pruning, and only the properties the query uses. When the
+query gives every key of the class only the instances it names are read;
+otherwise, when its condition can be answered from property indexes (see
+cimdb.CreatePropertyIndex), only the instances found in them. Instances
+from providers are filtered one at a time as they are produced.
+"""
+
+import re
+import pywbem
+import cimdb
+
+QUERY_LANGUAGES = ['WQL', 'DMTF:CQL', 'CQL']
+
+# Most instances looked up by key for a single query. Queries with more
+# key combinations scan their classes instead.
+_MAX_KEY_LOOKUPS = 1000
+
+# Classes with fewer instances in all are scanned rather than looked up in
+# property indexes
+_MIN_PROBED_INSTANCES = 100
+
+_KEYWORDS = ['select', 'from', 'where', 'and', 'or', 'not', 'isa', 'is',
+    'null', 'true', 'false', 'as']
+
+_TOKEN = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*') |
+    (?P<number>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?) |
+    (?P<ident>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)?) |
+    (?P<op><=|>=|<>|!=|=|<|>|,|\(|\)|\*)
+    )""", re.VERBOSE)
+
+_CMP = {
+    '=': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+# The operator to use when the operands of a comparison are swapped
+_SWAPPED = {'=': '=', '<>': '<>', '!=': '!=', '<': '>', '<=': '>=',
+    '>': '<', '>=': '<='}
+
+##############################################################################
+def _invalid(msg):
+    return pywbem.CIMError(pywbem.CIM_ERR_INVALID_QUERY, msg)
+
+##############################################################################
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if m is None:
+            raise _invalid('Syntax error at: %s' % text[pos:])
+        pos = m.end()
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'string':
+            value = value[1:-1].replace("''", "'")
+            if not isinstance(value, unicode):
+                value = value.decode('utf-8')
+        elif kind == 'number':
+            if '.' in value or 'e' in value or 'E' in value:
+                value = float(value)
+            else:
+                value = long(value)
+        elif kind == 'op':
+            kind = value
+        elif kind == 'ident' and value.lower() in _KEYWORDS:
+            kind = value.lower()
+        tokens.append((kind, value))
+    tokens.append(('end', None))
+    return tokens
+
+##############################################################################
+class _Parser(object):
+    """Recursive descent parser building the condition tree of a query.
+
+    The nodes are tuples: ('or', a, b), ('and', a, b), ('not', a),
+    ('cmp', op, propname, literal), ('null', propname),
+    ('isa', propname or None for the instance itself, classname).
+    """
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0]
+
+    def next(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def expect(self, kind):
+        tok = self.next()
+        if tok[0] != kind:
+            raise _invalid('Expected %s, found %s' % (kind,
+                tok[1] or tok[0]))
+        return tok[1]
+
+    def parse(self):
+        self.expect('select')
+        if self.peek() == '*':
+            self.next()
+            self.properties = None
+        else:
+            self.properties = [self.expect('ident')]
+            while self.peek() == ',':
+                self.next()
+                self.properties.append(self.expect('ident'))
+        self.expect('from')
+        self.classname = self.expect('ident')
+        self.alias = None
+        if self.peek() == 'as':
+            self.next()
+            self.alias = self.expect('ident')
+        elif self.peek() == 'ident':
+            self.alias = self.expect('ident')
+        self.where = None
+        if self.peek() == 'where':
+            self.next()
+            self.where = self.condition()
+        self.expect('end')
+        self.properties = self.properties and \
+            [self.propname(x) for x in self.properties]
+
+    def propname(self, name):
+        """Strip the class name or alias from a property name."""
+        if '.' not in name:
+            return name
+        prefix, name = name.split('.')
+        if prefix.lower() not in [x.lower() for x in
+                (self.classname, self.alias) if x]:
+            raise _invalid('Unknown class or alias %s' % prefix)
+        return name
+
+    def condition(self):
+        node = self.term()
+        while self.peek() == 'or':
+            self.next()
+            node = ('or', node, self.term())
+        return node
+
+    def term(self):
+        node = self.factor()
+        while self.peek() == 'and':
+            self.next()
+            node = ('and', node, self.factor())
+        return node
+
+    def literal(self):
+        kind, value = self.next()
+        if kind in ('string', 'number'):
+            return value
+        if kind == 'true':
+            return True
+        if kind == 'false':
+            return False
+        if kind == 'null':
+            return None
+        raise _invalid('Expected a literal, found %s' % (value or kind))
+
+    def factor(self):
+        kind = self.peek()
+        if kind == 'not':
+            self.next()
+            return ('not', self.factor())
+        if kind == '(':
+            self.next()
+            node = self.condition()
+            self.expect(')')
+            return node
+        if kind != 'ident':
+            # literal op property
+            value = self.literal()
+            op = self.next()[0]
+            if op not in _CMP:
+                raise _invalid('Expected a comparison operator')
+            name = self.propname(self.expect('ident'))
+            return ('cmp', _SWAPPED[op], name, value)
+        name = self.expect('ident')
+        kind = self.next()[0]
+        if kind == 'isa':
+            if name.lower() in [x.lower() for x in
+                    (self.classname, self.alias) if x]:
+                return ('isa', None, self.expect('ident'))
+            return ('isa', self.propname(name), self.expect('ident'))
+        name = self.propname(name)
+        if kind == 'is':
+            if self.peek() == 'not':
+                self.next()
+                self.expect('null')
+                return ('not', ('null', name))
+            self.expect('null')
+            return ('null', name)
+        if kind not in _CMP:
+            raise _invalid('Expected a comparison operator after %s' % name)
+        # A comparison with NULL is never true, as in SQL
+        return ('cmp', kind, name, self.literal())
+
+##############################################################################
+def _coerce(value, literal):
+    """Return literal converted to the type of a property value, or None
+    if they cannot be compared."""
+    if isinstance(value, bool):
+        if isinstance(literal, bool):
+            return literal
+        return None
+    if isinstance(value, (int, long, float)):
+        if isinstance(literal, (int, long, float)) and \
+                not isinstance(literal, bool):
+            return literal
+        return None
+    if isinstance(value, basestring):
+        if isinstance(literal, basestring):
+            return literal
+        return None
+    if isinstance(value, pywbem.CIMDateTime):
+        if isinstance(literal, basestring):
+            try:
+                return pywbem.CIMDateTime(literal)
+            except ValueError:
+                return None
+    return None
+
+##############################################################################
+def _typed_literal(cimtype, literal):
+    """Return literal as a value of CIM type cimtype. Raises ValueError if
+    no value of that type compares with it."""
+    if cimtype == 'boolean':
+        if isinstance(literal, bool):
+            return literal
+    elif cimtype in ('string', 'char16'):
+        if isinstance(literal, basestring):
+            return literal
+    elif cimtype == 'datetime':
+        if isinstance(literal, basestring):
+            return pywbem.CIMDateTime(literal)
+    elif cimtype != 'reference':
+        if isinstance(literal, (int, long, float)) and \
+                not isinstance(literal, bool):
+            # Key strings spell integers and reals differently
+            if cimtype.startswith('real'):
+                return float(literal)
+            if literal == long(literal):
+                return long(literal)
+            return literal
+    raise ValueError('%r is not a %s' % (literal, cimtype))
+
+##############################################################################
+class InstanceQuery(object):
+    """A parsed query, bound to a namespace."""
+    def __init__(self, Query, QueryLanguage, namespace):
+        if QueryLanguage.upper() not in QUERY_LANGUAGES:
+            raise pywbem.CIMError(pywbem.CIM_ERR_QUERY_LANGUAGE_NOT_SUPPORTED,
+                QueryLanguage)
+        parser = _Parser(Query)
+        parser.parse()
+        self.namespace = namespace
+        self.classname = parser.classname
+        self.properties = parser.properties
+        self.where = parser.where
+        try:
+            self.theclass = cimdb.GetClass(self.classname, namespace,
+                LocalOnly=False, IncludeQualifiers=True)
+        except pywbem.CIMError, arg:
+            if arg.args[0] != pywbem.CIM_ERR_NOT_FOUND:
+                raise
+            raise _invalid('Class %s does not exist' % self.classname)
+        self.classes = self._subclasses(self.classname)
+        # The classes named by ISA tests, with their subclasses
+        self.isa = {}
+        self._bind(self.where)
+        self.classnames = self._prune(self.where)
+        if self.classnames is None:
+            self.classnames = self.classes
+        else:
+            self.classnames = self.classnames & self.classes
+
+    def _subclasses(self, classname):
+        names = set([classname.lower()])
+        for name in cimdb.EnumerateClassNames(classname, self.namespace,
+                DeepInheritance=True):
+            names.add(name.lower())
+        return names
+
+    def _bind(self, node):
+        if node is None:
+            return
+        if node[0] in ('and', 'or'):
+            self._bind(node[1])
+            self._bind(node[2])
+        elif node[0] == 'not':
+            self._bind(node[1])
+        elif node[0] == 'isa':
+            lname = node[2].lower()
+            if lname not in self.isa:
+                try:
+                    self.isa[lname] = self._subclasses(node[2])
+                except pywbem.CIMError:
+                    raise _invalid('Class %s does not exist' % node[2])
+
+    def _prune(self, node):
+        """Return the lower cased names of the classes whose instances may
+        match node, or None if it does not restrict them."""
+        if node is None:
+            return None
+        if node[0] == 'isa' and node[1] is None:
+            return self.isa[node[2].lower()]
+        if node[0] in ('and', 'or'):
+            a = self._prune(node[1])
+            b = self._prune(node[2])
+            if node[0] == 'and':
+                if a is None or b is None:
+                    return a or b
+                return a & b
+            if a is None or b is None:
+                return None
+            return a | b
+        return None
+
+    def _key_bindings(self, node, keys):
+        """Return a list of key bindings, as dictionaries from lower cased
+        key name to value, that every instance matching node has one of,
+        or None if there is no such list."""
+        if node is None:
+            return None
+        if node[0] == 'cmp' and node[1] == '=' and node[3] is not None:
+            lname = node[2].lower()
+            if lname in keys:
+                return [{lname: node[3]}]
+            return None
+        if node[0] == 'or':
+            a = self._key_bindings(node[1], keys)
+            b = self._key_bindings(node[2], keys)
+            if a is None or b is None:
+                return None
+            return a + b
+        if node[0] == 'and':
+            a = self._key_bindings(node[1], keys)
+            b = self._key_bindings(node[2], keys)
+            if a is None or b is None:
+                return a or b
+            bindings = []
+            for x in a:
+                for y in b:
+                    if [k for k in x if k in y and x[k] != y[k]]:
+                        # A key cannot have two values
+                        continue
+                    z = dict(x)
+                    z.update(y)
+                    bindings.append(z)
+            if len(bindings) > _MAX_KEY_LOOKUPS:
+                return None
+            return bindings
+        return None
+
+    def instance_names(self):
+        """Return the names of the instances the query can match, if it
+        gives every key of the class, otherwise None."""
+        keys = {}
+        for prop in self.theclass.properties.itervalues():
+            if 'key' in prop.qualifiers:
+                keys[prop.name.lower()] = prop
+        if not keys:
+            return None
+        bindings = self._key_bindings(self.where, keys)
+        if bindings is None or len(bindings) > _MAX_KEY_LOOKUPS:
+            return None
+        names = []
+        for binding in bindings:
+            if len(binding) != len(keys):
+                return None
+            kbs = {}
+            for lname, value in binding.items():
+                prop = keys[lname]
+                if prop.type == 'reference':
+                    return None
+                try:
+                    kbs[prop.name] = _typed_literal(prop.type, value)
+                except ValueError:
+                    # No instance has this key
+                    kbs = None
+                    break
+            if kbs is not None:
+                names.append(pywbem.CIMInstanceName(self.classname, kbs,
+                    namespace=self.namespace))
+        return names
+
+    def _index_probes(self, node, indexed):
+        """Return a list of (index class, property name, operator, value)
+        index lookups that find every instance matching node, or None if
+        there is no such list."""
+        if node is None:
+            return None
+        if node[0] == 'cmp' and node[1] in cimdb._INDEX_OPS:
+            lname = node[2].lower()
+            if lname not in indexed:
+                return None
+            prop = self.theclass.properties.get(lname)
+            if prop is None or prop.is_array:
+                return None
+            if prop.type == 'datetime' and node[1] != '=':
+                # Date times are indexed as strings, which only sort
+                # like the date times they stand for in some cases
+                return None
+            try:
+                literal = _typed_literal(prop.type, node[3])
+            except ValueError:
+                # No value of the property compares with the literal
+                return []
+            return [(indexed[lname], prop.name, node[1], literal)]
+        if node[0] == 'or':
+            a = self._index_probes(node[1], indexed)
+            b = self._index_probes(node[2], indexed)
+            if a is None or b is None:
+                return None
+            return a + b
+        if node[0] == 'and':
+            a = self._index_probes(node[1], indexed)
+            b = self._index_probes(node[2], indexed)
+            if a is None or b is None:
+                return a or b
+            # Either side will do; the fewer lookups the better
+            if len(b) < len(a):
+                return b
+            return a
+        return None
+
+    def index_probes(self):
+        """Return the property index lookups that find every instance the
+        query can match, or None if it must scan its classes."""
+        if self.where is None:
+            return None
+        indexed = cimdb.IndexedProperties(self.classname, self.namespace)
+        if not indexed:
+            return None
+        return self._index_probes(self.where, indexed)
+
+    def property_list(self):
+        """Return the properties the query reads, or None for all."""
+        if self.properties is None:
+            return None
+        names = list(self.properties)
+        def walk(node):
+            if node is None:
+                return
+            if node[0] in ('and', 'or'):
+                walk(node[1])
+                walk(node[2])
+            elif node[0] == 'not':
+                walk(node[1])
+            elif node[0] == 'cmp':
+                names.append(node[2])
+            elif node[0] == 'null':
+                names.append(node[1])
+            elif node[0] == 'isa' and node[1] is not None:
+                names.append(node[1])
+        walk(self.where)
+        return names
+
+    def _eval(self, node, instance):
+        kind = node[0]
+        if kind == 'and':
+            return self._eval(node[1], instance) and \
+                self._eval(node[2], instance)
+        if kind == 'or':
+            return self._eval(node[1], instance) or \
+                self._eval(node[2], instance)
+        if kind == 'not':
+            return not self._eval(node[1], instance)
+        if kind == 'null':
+            prop = instance.properties.get(node[1])
+            return prop is None or prop.value is None
+        if kind == 'isa':
+            if node[1] is None:
+                cname = instance.classname
+            else:
+                prop = instance.properties.get(node[1])
+                if prop is None or \
+                        not isinstance(prop.value, pywbem.CIMInstanceName):
+                    return False
+                cname = prop.value.classname
+            return cname.lower() in self.isa[node[2].lower()]
+        prop = instance.properties.get(node[2])
+        if prop is None or prop.value is None:
+            return False
+        literal = _coerce(prop.value, node[3])
+        if literal is None:
+            return False
+        return _CMP[node[1]](prop.value, literal)
+
+    def matches(self, instance):
+        if instance.classname.lower() not in self.classnames:
+            return False
+        return self.where is None or self._eval(self.where, instance)
+
+    def project(self, instance):
+        """Return instance with only the selected properties."""
+        if self.properties is None:
+            return instance
+        ci = pywbem.CIMInstance(instance.classname, path=instance.path)
+        for name in self.properties:
+            prop = instance.properties.get(name)
+            if prop is not None:
+                ci.properties[prop.name] = prop
+        return ci
+
+    def filter(self, instances):
+        """Yield the projections of the instances that match."""
+        for ci in instances:
+            if self.matches(ci):
+                yield self.project(ci)
+
+    def select(self, classnames):
+        """Yield the matching instances of classnames, which may only be
+        classes of the query, stored in the repository."""
+        classnames = [x for x in classnames if x.lower() in self.classnames]
+        if not classnames:
+            return iter(())
+        stats = cimdb.EnumerateClassStatistics(self.namespace, classnames)
+        classnames = [x for x, st in stats if st['InstanceCount']]
+        if not classnames:
+            return iter(())
+        ninstances = sum([st['InstanceCount'] for x, st in stats])
+        names = self.instance_names()
+        if names is not None and len(names) >= ninstances:
+            # Reading every instance is no more work than the lookups
+            names = None
+        probes = None
+        if names is None and ninstances >= _MIN_PROBED_INSTANCES:
+            probes = self.index_probes()
+        return self.filter(cimdb.SelectInstances(classnames, self.namespace,
+            names, self.property_list(), probes))
+
+##############################################################################
+def ExecQuery(namespace, QueryLanguage, Query):
+    """Yield the instances stored in the repository that match a query."""
+    q = InstanceQuery(Query, QueryLanguage, namespace)
+    for ci in q.select([x for x in cimdb.EnumerateClassNames(q.classname,
+            namespace, DeepInheritance=True)] + [q.classname]):
+        yield ci
@@ -20,11 +20,31 @@
 
 import pywbem
 import sys
+import threading
+import time
+import uuid
 from pywbem import tupleparse
+from pywbem import cim_xml
 import cimdb
+import cimquery
 from socket import getfqdn
 import internal_providers
 
+# Error codes added by DSP0200 1.3 for the pull operations
+CIM_ERR_INVALID_ENUMERATION_CONTEXT = 21
+CIM_ERR_INVALID_OPERATION_TIMEOUT = 22
+CIM_ERR_FILTERED_ENUMERATION_NOT_SUPPORTED = 25
+CIM_ERR_CONTINUATION_ON_ERROR_NOT_SUPPORTED = 26
+CIM_ERR_SERVER_LIMITS_EXCEEDED = 27
+
+# Seconds an idle enumeration context is kept when the client does not
+# give an OperationTimeout, and the longest a client may ask for
+DEFAULT_OPERATION_TIMEOUT = 60
+MAX_OPERATION_TIMEOUT = 600
+
+# The most enumeration contexts open at once
+MAX_ENUMERATION_CONTEXTS = 64
+
 class Logger(object):
     def __init__(self, fobj):
         self.file = fobj
@@ -51,6 +71,35 @@ class ProviderEnvironment(object):
         # TODO
         return 'root'
 
+class EnumerationContext(object):
+    """The state of an open pull enumeration between two operations.
+
+    Classes served by a provider are enumerated first, one at a time, from
+    the provider's generator. The instances of the other classes are then
+    read from the repository a page at a time, by position, so only the
+    generator of the current provider class is held between operations.
+    """
+    def __init__(self, namespace, classes, repclasses, names, timeout, 
+                 args):
+        self.id = str(uuid.uuid4())
+        self.namespace = namespace
+        self.classes = classes
+        self.repclasses = repclasses
+        self.names = names
+        self.timeout = timeout
+        self.args = args
+        self.gen = None
+        self.position = cimdb.START_POSITION
+        # Set while an operation uses the context
+        self.busy = False
+        self.touch()
+
+    def touch(self):
+        self.expires = time.time() + self.timeout
+
+    def finished(self):
+        return not self.classes and self.position is None
+
 class CIMServer(object):
     PROVIDERTYPE_INSTANCE = 1
     PROVIDERTYPE_ASSOCIATION = 3
@@ -82,6 +131,8 @@ class CIMServer(object):
             self.provregs[cname] = (internal_providers, 
                                     [self.PROVIDERTYPE_INSTANCE], [])
         print 'provregs: ', `self.provregs`
+        self.enumctxs = {}
+        self.enumlock = threading.Lock()
 
     def _get_provider(self, ns, class_name, type, method_name=None):
         lcname = class_name.lower()
@@ -99,12 +150,50 @@ class CIMServer(object):
             return None
         return pywbem.cim_provider.ProviderProxy(self.env, provreg[0])
 
-    def AssociatorNames(self, *args, **kwargs):
-        # TODO
-        return None
-    def Associators(self, *args, **kwargs):
-        # TODO
-        return None
+    def _assoc_providers(self, namespace, ObjectName, AssocClass):
+        """Yield the association classes that refer to the class of 
+        ObjectName and are served by a provider, with the provider."""
+        if not isinstance(ObjectName, pywbem.CIMInstanceName):
+            return
+        cn = pywbem.CIMClassName(ObjectName.classname, namespace=namespace)
+        for acn in cimdb.ReferenceNames(cn, ResultClass=AssocClass):
+            provider = self._get_provider(namespace, acn.classname, 
+                                          self.PROVIDERTYPE_ASSOCIATION)
+            if provider is not None:
+                yield acn.classname, provider
+
+    def AssociatorNames(self, namespace, ObjectName, AssocClass=None, 
+            ResultClass=None, Role=None, ResultRole=None):
+        ObjectName = ObjectName.copy()
+        ObjectName.namespace = namespace
+        for iname in cimdb.AssociatorNames(ObjectName, AssocClass=AssocClass,
+                ResultClass=ResultClass, Role=Role, ResultRole=ResultRole):
+            yield iname
+        for acname, provider in self._assoc_providers(namespace, ObjectName,
+                                                      AssocClass):
+            gen = provider.MI_associatorNames(self.env, ObjectName, acname,
+                    ResultClass, Role, ResultRole)
+            for iname in gen:
+                yield iname
+
+    def Associators(self, namespace, ObjectName, AssocClass=None, 
+            ResultClass=None, Role=None, ResultRole=None, 
+            IncludeQualifiers=False, IncludeClassOrigin=False, 
+            PropertyList=None):
+        ObjectName = ObjectName.copy()
+        ObjectName.namespace = namespace
+        for obj in cimdb.Associators(ObjectName, AssocClass=AssocClass,
+                ResultClass=ResultClass, Role=Role, ResultRole=ResultRole,
+                IncludeQualifiers=IncludeQualifiers, 
+                IncludeClassOrigin=IncludeClassOrigin, 
+                PropertyList=PropertyList):
+            yield obj
+        for acname, provider in self._assoc_providers(namespace, ObjectName,
+                                                      AssocClass):
+            gen = provider.MI_associators(self.env, ObjectName, acname,
+                    ResultClass, Role, ResultRole, PropertyList)
+            for inst in gen:
+                yield inst
     def CreateClass(self, *args, **kwargs):
         del kwargs['namespace']
         cimdb.CreateClass(*args, **kwargs)
@@ -183,12 +272,213 @@ class CIMServer(object):
                 for i in gen:
                     yield i
         
+    def _open_enumeration(self, namespace, ClassName, names, 
+            OperationTimeout, ContinueOnError, MaxObjectCount, 
+            FilterQueryLanguage, FilterQuery, args):
+        if FilterQueryLanguage is not None or FilterQuery is not None:
+            raise pywbem.CIMError(CIM_ERR_FILTERED_ENUMERATION_NOT_SUPPORTED)
+        if ContinueOnError:
+            raise pywbem.CIMError(CIM_ERR_CONTINUATION_ON_ERROR_NOT_SUPPORTED)
+        if OperationTimeout is None:
+            OperationTimeout = DEFAULT_OPERATION_TIMEOUT
+        if OperationTimeout <= 0 or OperationTimeout > MAX_OPERATION_TIMEOUT:
+            raise pywbem.CIMError(CIM_ERR_INVALID_OPERATION_TIMEOUT,
+                'OperationTimeout must be between 1 and %d' % 
+                MAX_OPERATION_TIMEOUT)
+        classes = []
+        repclasses = []
+        for cc in self._classtree(ClassName, namespace):
+            provider = self._get_provider(namespace, cc.classname, 
+                                          self.PROVIDERTYPE_INSTANCE)
+            if provider is not None:
+                classes.append((cc, provider))
+            else:
+                repclasses.append(cc.classname)
+        if repclasses:
+            # Classes without instances need not be visited by every pull
+            repclasses = [cname for cname, st in 
+                    cimdb.EnumerateClassStatistics(namespace, repclasses) 
+                    if st['InstanceCount']]
+        ctx = EnumerationContext(namespace, classes, repclasses, names,
+                                 OperationTimeout, args)
+        if not repclasses:
+            ctx.position = None
+        self.enumlock.acquire()
+        try:
+            now = time.time()
+            for key, other in self.enumctxs.items():
+                if not other.busy and other.expires < now:
+                    del self.enumctxs[key]
+            if len(self.enumctxs) >= MAX_ENUMERATION_CONTEXTS:
+                raise pywbem.CIMError(CIM_ERR_SERVER_LIMITS_EXCEEDED,
+                    'Too many open enumeration contexts')
+            # The context holds its slot from now on, also while an
+            # operation uses it
+            ctx.busy = True
+            self.enumctxs[ctx.id] = ctx
+        finally:
+            self.enumlock.release()
+        return self._pull(ctx, MaxObjectCount)
+
+    def _take_context(self, namespace, EnumerationContext, names):
+        """Mark an open context busy while an operation uses it, so a
+        concurrent operation on the same context fails. A request that
+        does not match the context leaves it as it is."""
+        self.enumlock.acquire()
+        try:
+            ctx = self.enumctxs.get(EnumerationContext)
+            if ctx is not None and not ctx.busy and \
+                    ctx.expires < time.time():
+                del self.enumctxs[ctx.id]
+                ctx = None
+            if ctx is None or ctx.busy or ctx.namespace != namespace or \
+                    (names is not None and ctx.names != names):
+                raise pywbem.CIMError(CIM_ERR_INVALID_ENUMERATION_CONTEXT)
+            ctx.busy = True
+        finally:
+            self.enumlock.release()
+        return ctx
+
+    def _release_context(self, ctx, keep=True):
+        """Return a context taken by an operation to the table, or free
+        its slot if the enumeration is over."""
+        self.enumlock.acquire()
+        try:
+            if keep:
+                ctx.busy = False
+                ctx.touch()
+            else:
+                self.enumctxs.pop(ctx.id, None)
+        finally:
+            self.enumlock.release()
+
+    def _pull(self, ctx, MaxObjectCount):
+        """Return the next MaxObjectCount objects of an enumeration, the 
+        context id and whether the enumeration is finished."""
+        try:
+            result = self._pull_objects(ctx, MaxObjectCount)
+        except:
+            self._release_context(ctx, False)
+            raise
+        finished = ctx.finished()
+        self._release_context(ctx, not finished)
+        return result, ctx.id, finished
+
+    def _pull_objects(self, ctx, MaxObjectCount):
+        result = []
+        while ctx.classes and len(result) < MaxObjectCount:
+            cc, provider = ctx.classes[0]
+            if ctx.gen is None:
+                if ctx.names:
+                    ctx.gen = provider.MI_enumInstanceNames(self.env, 
+                            ctx.namespace, cc)
+                else:
+                    ctx.gen = provider.MI_enumInstances(self.env, 
+                            ctx.namespace, 
+                            propertyList=ctx.args.get('PropertyList'),
+                            requestedCimClass=None, 
+                            cimClass=cc)
+            for obj in ctx.gen:
+                result.append(obj)
+                if len(result) >= MaxObjectCount:
+                    break
+            else:
+                ctx.gen = None
+                del ctx.classes[0]
+        if ctx.position is not None and not ctx.classes and \
+                len(result) < MaxObjectCount:
+            count = MaxObjectCount - len(result)
+            if ctx.names:
+                page, ctx.position = cimdb.EnumerateInstanceNamesPage(
+                        ctx.repclasses, ctx.namespace, ctx.position, count)
+            else:
+                page, ctx.position = cimdb.EnumerateInstancesPage(
+                        ctx.repclasses, ctx.namespace, ctx.position, count,
+                        **ctx.args)
+            result.extend(page)
+        return result
+
+    def OpenEnumerateInstances(self, namespace, ClassName, 
+            DeepInheritance=True, IncludeClassOrigin=False, 
+            PropertyList=None, FilterQueryLanguage=None, FilterQuery=None,
+            OperationTimeout=None, ContinueOnError=False, MaxObjectCount=0):
+        """Open an enumeration of the instances of a class. Returns the 
+        first MaxObjectCount instances, the enumeration context and 
+        whether the enumeration is finished."""
+        if not DeepInheritance:
+            # Instances of subclasses are returned with just the 
+            # properties of the requested class
+            cc = cimdb.GetClass(ClassName, namespace=namespace, 
+                    LocalOnly=False, IncludeQualifiers=False)
+            if PropertyList is None:
+                PropertyList = cc.properties.keys()
+            else:
+                PropertyList = [p for p in PropertyList 
+                                if p in cc.properties]
+        args = {'LocalOnly': False, 'IncludeClassOrigin': IncludeClassOrigin,
+                'PropertyList': PropertyList}
+        return self._open_enumeration(namespace, ClassName, False, 
+                OperationTimeout, ContinueOnError, MaxObjectCount, 
+                FilterQueryLanguage, FilterQuery, args)
+
+    def OpenEnumerateInstancePaths(self, namespace, ClassName, 
+            FilterQueryLanguage=None, FilterQuery=None,
+            OperationTimeout=None, ContinueOnError=False, MaxObjectCount=0):
+        """Like OpenEnumerateInstances, for instance paths."""
+        return self._open_enumeration(namespace, ClassName, True, 
+                OperationTimeout, ContinueOnError, MaxObjectCount, 
+                FilterQueryLanguage, FilterQuery, {})
+
+    def PullInstancesWithPath(self, namespace, EnumerationContext, 
+            MaxObjectCount):
+        ctx = self._take_context(namespace, EnumerationContext, False)
+        return self._pull(ctx, MaxObjectCount)
+
+    def PullInstancePaths(self, namespace, EnumerationContext, 
+            MaxObjectCount):
+        ctx = self._take_context(namespace, EnumerationContext, True)
+        return self._pull(ctx, MaxObjectCount)
+
+    def CloseEnumeration(self, namespace, EnumerationContext):
+        ctx = self._take_context(namespace, EnumerationContext, None)
+        self._release_context(ctx, False)
+
+    def EnumerationCount(self, namespace, EnumerationContext):
+        """Return the number of objects left in an enumeration, or None 
+        if providers are still to be asked for theirs."""
+        ctx = self._take_context(namespace, EnumerationContext, None)
+        try:
+            if ctx.classes:
+                return None
+            if ctx.position is None:
+                return 0
+            return cimdb.CountInstances(ctx.repclasses, ctx.namespace, 
+                                        Position=ctx.position)
+        finally:
+            self._release_context(ctx)
+
     def EnumerateQualifiers(self, *args, **kwargs):
         for qual in cimdb.EnumerateQualifiers(*args, **kwargs):
             yield qual
-    def ExecQuery(self, *args, **kwargs):
-        # TODO
-        return None
+    def ExecQuery(self, namespace, QueryLanguage, Query):
+        query = cimquery.InstanceQuery(Query, QueryLanguage, namespace)
+        repclasses = []
+        for cc in self._classtree(query.classname, namespace):
+            if cc.classname.lower() not in query.classnames:
+                continue
+            provider = self._get_provider(namespace, cc.classname, 
+                                          self.PROVIDERTYPE_INSTANCE)
+            if provider is not None:
+                gen = provider.MI_enumInstances(self.env, namespace, 
+                        propertyList=query.property_list(), 
+                        requestedCimClass=None, 
+                        cimClass=cc)
+                for inst in query.filter(gen):
+                    yield inst
+            else:
+                repclasses.append(cc.classname)
+        for inst in query.select(repclasses):
+            yield inst
     def GetInstance(self, namespace, InstanceName, 
                     LocalOnly=True, IncludeQualifiers=False, 
                     IncludeClassOrigin=False, PropertyList=None):
@@ -216,18 +506,188 @@ class CIMServer(object):
     def ModifyInstance(self, *args, **kwargs):
         # TODO providers...
         return cimdb.ModifyInstance(*args, **kwargs)
-    def ReferenceNames(self, *args, **kwargs):
-        # TODO
-        return None
-    def References(self, *args, **kwargs):
-        # TODO
-        return None
+    def ReferenceNames(self, namespace, ObjectName, ResultClass=None, 
+            Role=None):
+        ObjectName = ObjectName.copy()
+        ObjectName.namespace = namespace
+        for iname in cimdb.ReferenceNames(ObjectName, 
+                ResultClass=ResultClass, Role=Role):
+            yield iname
+        for acname, provider in self._assoc_providers(namespace, ObjectName,
+                                                      ResultClass):
+            gen = provider.MI_referenceNames(self.env, ObjectName, acname, 
+                    Role)
+            for iname in gen:
+                yield iname
+
+    def References(self, namespace, ObjectName, ResultClass=None, 
+            Role=None, IncludeQualifiers=False, IncludeClassOrigin=False, 
+            PropertyList=None):
+        ObjectName = ObjectName.copy()
+        ObjectName.namespace = namespace
+        for obj in cimdb.References(ObjectName, ResultClass=ResultClass, 
+                Role=Role, IncludeQualifiers=IncludeQualifiers, 
+                IncludeClassOrigin=IncludeClassOrigin, 
+                PropertyList=PropertyList):
+            yield obj
+        for acname, provider in self._assoc_providers(namespace, ObjectName,
+                                                      ResultClass):
+            gen = provider.MI_references(self.env, ObjectName, acname, 
+                    Role, PropertyList)
+            for inst in gen:
+                yield inst
     def SetQualifier(self, *args, **kwargs):
         return cimdb.SetQualifier(*args, **kwargs)
 
 cs = CIMServer()
 
+class VALUE_INSTANCEWITHPATH(cim_xml.CIMElement):
+    """
+    <!ELEMENT VALUE.INSTANCEWITHPATH (INSTANCEPATH, INSTANCE)>
+    """
+    def __init__(self, instancepath, instance):
+        cim_xml.Element.__init__(self, 'VALUE.INSTANCEWITHPATH')
+        self.appendChild(instancepath)
+        self.appendChild(instance)
+
+def _pull_params(ipvs):
+    """Convert the pull operation parameters that tupleparse leaves as 
+    strings."""
+    for name in ['MaxObjectCount', 'OperationTimeout']:
+        if ipvs.get(name) is not None:
+            try:
+                ipvs[name] = int(ipvs[name])
+            except ValueError:
+                raise pywbem.CIMError(pywbem.CIM_ERR_INVALID_PARAMETER, 
+                        'Invalid %s: %s' % (name, ipvs[name]))
+    if 'ContinueOnError' in ipvs:
+        ipvs['ContinueOnError'] = str(ipvs['ContinueOnError']).lower() == \
+                'true'
+    if 'ClassName' in ipvs:
+        ipvs['ClassName'] = ipvs['ClassName'].classname
+    return ipvs
+
+def _pull_response(ns, result, output):
+    """Write the objects of a pull operation response, and return the 
+    EnumerationContext and EndOfSequence output parameters, which follow
+    the IRETURNVALUE."""
+    objs, ctxid, eos = result
+    host = getfqdn()
+    for obj in objs:
+        if isinstance(obj, pywbem.CIMInstance):
+            path = obj.path.copy()
+            path.host = host
+            path.namespace = ns
+            obj = obj.copy()
+            obj.path = None
+            xml = VALUE_INSTANCEWITHPATH(path.tocimxml(), obj.tocimxml())
+        else:
+            obj = obj.copy()
+            obj.host = host
+            obj.namespace = ns
+            xml = obj.tocimxml()
+        output.write(xml.toxml().encode('utf8'))
+    if eos:
+        ctxparam = cim_xml.PARAMVALUE('EnumerationContext')
+    else:
+        ctxparam = cim_xml.PARAMVALUE('EnumerationContext', 
+                cim_xml.VALUE(ctxid), 'string')
+    eosparam = cim_xml.PARAMVALUE('EndOfSequence', 
+            cim_xml.VALUE(eos and 'TRUE' or 'FALSE'), 'boolean')
+    return ctxparam.toxml() + eosparam.toxml()
+
+def _assoc_params(ipvs):
+    for name in ['AssocClass', 'ResultClass']:
+        if ipvs.get(name) is not None:
+            ipvs[name] = ipvs[name].classname
+    for name in ['Role', 'ResultRole']:
+        if ipvs.get(name) == '':
+            ipvs[name] = None
+    return ipvs
+
+def _object_path(obj, ns):
+    """Return the full path of an instance name or class name."""
+    obj = obj.copy()
+    obj.host = getfqdn()
+    if obj.namespace is None:
+        obj.namespace = ns
+    return obj
+
+def _object_with_path(obj, ns):
+    """Return the VALUE.OBJECTWITHPATH of an instance or class."""
+    if isinstance(obj, pywbem.CIMInstance):
+        path = _object_path(obj.path, ns)
+        obj = obj.copy()
+        obj.path = None
+    else:
+        path = _object_path(pywbem.CIMClassName(obj.classname), ns)
+    return cim_xml.VALUE_OBJECTWITHPATH(path.tocimxml(), obj.tocimxml())
+
 class CIMXMLDispatch(object):
+    def associatornames(self, tt, output):
+        ns = tt[2]
+        ipvs = _assoc_params(dict([(str(k), v) for k, v in tt[3]]))
+        for name in cs.AssociatorNames(namespace=ns, **ipvs):
+            output.write(cim_xml.OBJECTPATH(
+                _object_path(name, ns).tocimxml()).toxml().encode('utf8'))
+
+    def associators(self, tt, output):
+        ns = tt[2]
+        ipvs = _assoc_params(dict([(str(k), v) for k, v in tt[3]]))
+        for obj in cs.Associators(namespace=ns, **ipvs):
+            output.write(_object_with_path(obj, ns).toxml().encode('utf8'))
+
+    def referencenames(self, tt, output):
+        ns = tt[2]
+        ipvs = _assoc_params(dict([(str(k), v) for k, v in tt[3]]))
+        for name in cs.ReferenceNames(namespace=ns, **ipvs):
+            output.write(cim_xml.OBJECTPATH(
+                _object_path(name, ns).tocimxml()).toxml().encode('utf8'))
+
+    def references(self, tt, output):
+        ns = tt[2]
+        ipvs = _assoc_params(dict([(str(k), v) for k, v in tt[3]]))
+        for obj in cs.References(namespace=ns, **ipvs):
+            output.write(_object_with_path(obj, ns).toxml().encode('utf8'))
+
+    def openenumerateinstances(self, tt, output):
+        ns = tt[2]
+        ipvs = _pull_params(dict([(str(k), v) for k, v in tt[3]]))
+        # LocalOnly and IncludeQualifiers are not parameters of the pull
+        # operations
+        return _pull_response(ns, 
+                cs.OpenEnumerateInstances(namespace=ns, **ipvs), output)
+
+    def openenumerateinstancepaths(self, tt, output):
+        ns = tt[2]
+        ipvs = _pull_params(dict([(str(k), v) for k, v in tt[3]]))
+        return _pull_response(ns, 
+                cs.OpenEnumerateInstancePaths(namespace=ns, **ipvs), output)
+
+    def pullinstanceswithpath(self, tt, output):
+        ns = tt[2]
+        ipvs = _pull_params(dict([(str(k), v) for k, v in tt[3]]))
+        return _pull_response(ns, 
+                cs.PullInstancesWithPath(namespace=ns, **ipvs), output)
+
+    def pullinstancepaths(self, tt, output):
+        ns = tt[2]
+        ipvs = _pull_params(dict([(str(k), v) for k, v in tt[3]]))
+        return _pull_response(ns, 
+                cs.PullInstancePaths(namespace=ns, **ipvs), output)
+
+    def closeenumeration(self, tt, output):
+        ns = tt[2]
+        ipvs = dict([(str(k), v) for k, v in tt[3]])
+        cs.CloseEnumeration(namespace=ns, **ipvs)
+
+    def enumerationcount(self, tt, output):
+        ns = tt[2]
+        ipvs = dict([(str(k), v) for k, v in tt[3]])
+        count = cs.EnumerationCount(namespace=ns, **ipvs)
+        if count is not None:
+            output.write(cim_xml.VALUE(str(count)).toxml())
+
     def enumerateinstancenames(self, tt, output):
         print 'tt[0]', tt[0]
         ns = tt[2]
@@ -250,6 +710,12 @@ class CIMXMLDispatch(object):
             inst.path.namespace = None
             output.write(inst.tocimxml().toxml().encode('utf8'))
 
+    def execquery(self, tt, output):
+        ns = tt[2]
+        ipvs = dict([(str(k), v) for k, v in tt[3]])
+        for inst in cs.ExecQuery(namespace=ns, **ipvs):
+            output.write(_object_with_path(inst, ns).toxml().encode('utf8'))
+
     def enumeratequalifiers(self, tt, output):
         print 'tt[0]', tt[0]
         ns = tt[2]
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# (C) Copyright 2007 Novell, Inc. 
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#   
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#   
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+"""Compare the cimdb blob codecs on objects from a repository namespace.
+
+For every codec the encode and decode throughput and the total encoded
+size are reported for the instances of a class (and its subclasses) and
+for the resolved classes of the namespace.
+
+usage: codecbench.py [options] namespace classname
+"""
+
+import time
+from optparse import OptionParser
+import cimdb
+
+def _codecs():
+    codecs = [('pickle', cimdb.CODECS['pickle']),
+              ('compact', cimdb.CODECS['compact'])]
+    for level in (1, 6, 9):
+        codecs.append(('zlib-%d' % level, cimdb.Codec('pickle', level)))
+    codecs.append(('zlib-6>=512', cimdb.Codec('pickle', 6, threshold=512)))
+    for level in (1, 6):
+        codecs.append(('zcompact-%d' % level, cimdb.Codec('compact', level)))
+    codecs.append(('zdict-6', cimdb.Codec('compact', 6, zdict=True)))
+    return codecs
+
+class _BenchConnection(object):
+    # Stands in for a namespace connection when decoding dictionary
+    # compressed blobs
+    dbname = '<codecbench>'
+
+def _bench(objs, codec, rounds):
+    zd = None
+    conn = _BenchConnection()
+    if codec.zdict:
+        samples = [codec.serialize(x)[1] for x in objs[:cimdb._ZDICT_SAMPLES]]
+        zd = cimdb._ZDict(0, cimdb._train_zdict(samples))
+        cimdb._zdicts.byid[(conn.dbname, 0)] = zd
+    blobs = [codec.encode(x, zd) for x in objs]
+    start = time.time()
+    for i in xrange(rounds):
+        for x in objs:
+            codec.encode(x, zd)
+    enctime = (time.time() - start) / rounds
+    start = time.time()
+    for i in xrange(rounds):
+        for b in blobs:
+            cimdb._decode(b, conn)
+    dectime = (time.time() - start) / rounds
+    return enctime, dectime, sum([len(b) for b in blobs])
+
+def _report(title, objs, rounds):
+    print '%s: %d objects' % (title, len(objs))
+    if not objs:
+        return
+    print '  %-14s %12s %12s %12s %10s' % ('codec', 'encode/s', 'decode/s',
+            'bytes', 'bytes/obj')
+    for name, codec in _codecs():
+        enctime, dectime, size = _bench(objs, codec, rounds)
+        print '  %-14s %12.0f %12.0f %12d %10.1f' % (name,
+                len(objs) / max(enctime, 1e-9), len(objs) / max(dectime, 1e-9),
+                size, float(size) / len(objs))
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] namespace classname')
+    parser.add_option('-r', '--repository', dest='repdir',
+            help='Repository directory [default: %default]',
+            default=cimdb._REPDIR)
+    parser.add_option('-n', '--count', dest='count', type='int',
+            help='Maximum number of instances to use [default: %default]',
+            default=1000)
+    parser.add_option('-i', '--rounds', dest='rounds', type='int',
+            help='Number of rounds to time [default: %default]', default=5)
+    opts, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('namespace and classname are required')
+    namespace, classname = args
+    cimdb._REPDIR = opts.repdir
+
+    insts = []
+    for inst in cimdb.EnumerateInstances(classname, namespace,
+            LocalOnly=False):
+        insts.append(inst)
+        if len(insts) >= opts.count:
+            break
+    classes = list(cimdb.EnumerateClasses(namespace=namespace,
+            DeepInheritance=True, LocalOnly=False, IncludeQualifiers=True,
+            IncludeClassOrigin=True))
+    _report('Instances of %s' % classname, insts, opts.rounds)
+    _report('Classes', classes, opts.rounds)
@@ -0,0 +1,293 @@
+"""Tests of WQL and CQL queries: parsing, and the instances a query finds
+in a repository, with and without property indexes."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pywbem
+from pywbem import CIMClass, CIMDateTime, CIMInstance, CIMInstanceName, \
+    CIMProperty, CIMQualifier, CIMQualifierDeclaration
+import cimdb
+import cimquery
+
+NS = 'root/test'
+
+# Enough instances for queries to use property indexes
+N = 2 * cimquery._MIN_PROBED_INSTANCES
+
+##############################################################################
+def _class(name, superclass=None, **extra):
+    props = {}
+    if superclass is None:
+        props['Name'] = CIMProperty('Name', None, type='string',
+            qualifiers={'Key': CIMQualifier('Key', True)})
+    for pname, t in extra.items():
+        if isinstance(t, tuple):
+            props[pname] = CIMProperty(pname, None, type=t[0],
+                is_array=t[1] == '[]', reference_class=t[1])
+        else:
+            props[pname] = CIMProperty(pname, None, type=t)
+    return CIMClass(name, superclass=superclass, properties=props)
+
+##############################################################################
+def _base(i):
+    """Instance i: a Test_Sub if i is even, a Test_Other if it is not,
+    with no Num if i is a multiple of 10."""
+    cname = i % 2 and 'Test_Other' or 'Test_Sub'
+    props = {'Name': u'n%d' % i,
+        'Num': CIMProperty('Num', i % 10 and i or None, type='uint32'),
+        'Str': u"it's %d" % (i % 3),
+        'Flag': i % 4 == 0,
+        'When': CIMDateTime('2020%02d01000000.000000+000' % (i % 12 + 1)),
+        'Arr': CIMProperty('Arr', [i % 5, 7], type='uint32', is_array=True)}
+    if cname == 'Test_Sub':
+        props['Extra'] = u'x%d' % i
+    return CIMInstance(cname, properties=props,
+        path=CIMInstanceName(cname, {'Name': u'n%d' % i}, namespace=NS))
+
+##############################################################################
+def _link(i, target):
+    path = CIMInstanceName('Test_Link', {'Name': u'l%d' % i}, namespace=NS)
+    return CIMInstance('Test_Link', path=path, properties={
+        'Name': u'l%d' % i,
+        'Ref': CIMProperty('Ref', target, type='reference',
+            reference_class='Test_Base')})
+
+##############################################################################
+class ParserTest(unittest.TestCase):
+
+    def parse(self, text):
+        parser = cimquery._Parser(text)
+        parser.parse()
+        return parser
+
+    def test_select(self):
+        p = self.parse('SELECT * FROM Test_Base')
+        self.assertEqual((p.properties, p.classname, p.alias, p.where),
+            (None, 'Test_Base', None, None))
+        p = self.parse('select b.Name, Num from Test_Base as b')
+        self.assertEqual((p.properties, p.alias), (['Name', 'Num'], 'b'))
+        p = self.parse('select Test_Base.Name from Test_Base b')
+        self.assertEqual((p.properties, p.alias), (['Name'], 'b'))
+
+    def test_where(self):
+        p = self.parse("select * from Test_Base b where b.Num >= 5 and "
+            "(Str = 'it''s' or not Flag = true) or Num is not null")
+        self.assertEqual(p.where,
+            ('or',
+                ('and', ('cmp', '>=', 'Num', 5),
+                    ('or', ('cmp', '=', 'Str', u"it's"),
+                        ('not', ('cmp', '=', 'Flag', True)))),
+                ('not', ('null', 'Num'))))
+        # A literal first swaps the operator
+        p = self.parse('select * from Test_Base where 2.5 < Num')
+        self.assertEqual(p.where, ('cmp', '>', 'Num', 2.5))
+        p = self.parse('select * from Test_Base where -1e3 <> Num')
+        self.assertEqual(p.where, ('cmp', '<>', 'Num', -1000.0))
+        p = self.parse('select * from Test_Base b where b isa Test_Sub '
+            'and Ref isa Test_Other and Num = null')
+        self.assertEqual(p.where,
+            ('and', ('and', ('isa', None, 'Test_Sub'),
+                ('isa', 'Ref', 'Test_Other')),
+                ('cmp', '=', 'Num', None)))
+
+    def test_errors(self):
+        for text in ['select from Test_Base',
+                'select * Test_Base',
+                'select * from Test_Base where',
+                'select * from Test_Base where Num',
+                'select * from Test_Base where Num == 1',
+                'select * from Test_Base where 1 = 2',
+                "select * from Test_Base where Str = 'open",
+                'select * from Test_Base where x.Num = 1',
+                'select * from Test_Base where (Num = 1',
+                'select * from Test_Base extra words']:
+            try:
+                self.parse(text)
+            except pywbem.CIMError, e:
+                self.assertEqual(e.args[0], pywbem.CIM_ERR_INVALID_QUERY,
+                    text)
+            else:
+                self.fail(text)
+
+##############################################################################
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repdir = tempfile.mkdtemp()
+        self.olddir = cimdb._REPDIR
+        cimdb._REPDIR = self.repdir
+        cimdb.CreateNamespace(NS)
+        cimdb.SetQualifier(CIMQualifierDeclaration('Key', 'boolean',
+            scopes={'PROPERTY': True}, overridable=False), NS)
+        cimdb.CreateClass(_class('Test_Base', Num='uint32', Str='string',
+            Flag='boolean', When='datetime', Arr=('uint32', '[]')), NS)
+        cimdb.CreateClass(_class('Test_Sub', 'Test_Base', Extra='string'),
+            NS)
+        cimdb.CreateClass(_class('Test_Other', 'Test_Base'), NS)
+        cimdb.CreateClass(_class('Test_Link',
+            Ref=('reference', 'Test_Base')), NS)
+        self.instances = [_base(i) for i in range(N)]
+        cimdb.CreateInstances(self.instances, NS)
+        cimdb.CreateInstances([_link(i, self.instances[i].path)
+            for i in range(10)], NS)
+
+    def tearDown(self):
+        cimdb.DeleteNamespace(NS)
+        cimdb._REPDIR = self.olddir
+        shutil.rmtree(self.repdir)
+
+    def query(self, text, lang='WQL'):
+        return sorted([(ci.classname, ci['Name'])
+            for ci in cimquery.ExecQuery(NS, lang, text)])
+
+    def expected(self, test):
+        return sorted([(ci.classname, ci['Name'])
+            for ci in self.instances if test(ci)])
+
+    # (condition, test of the instances it matches)
+    conditions = [
+        ('Num = 5', lambda ci: ci['Num'] == 5),
+        ('Num <> 5', lambda ci: ci['Num'] is not None and ci['Num'] != 5),
+        ('Num > 150', lambda ci: ci['Num'] > 150),
+        ('150 > Num', lambda ci: ci['Num'] is not None and ci['Num'] < 150),
+        ('Num >= 21 and Num <= 25.5',
+            lambda ci: ci['Num'] in (21, 22, 23, 24, 25)),
+        ('Num = 3 or Num = 198 or Num = 1000',
+            lambda ci: ci['Num'] in (3, 198)),
+        ("Num = 'five'", lambda ci: False),
+        ('Num is null', lambda ci: ci['Num'] is None),
+        ('Num is not null', lambda ci: ci['Num'] is not None),
+        ('Num = null', lambda ci: False),
+        ("Str = 'it''s 1'", lambda ci: ci['Str'] == u"it's 1"),
+        ("Str > 'it''s 1' and Num < 20",
+            lambda ci: ci['Str'] == u"it's 2" and ci['Num'] is not None
+                and ci['Num'] < 20),
+        ('Flag = true', lambda ci: ci['Flag']),
+        ('Flag = 1', lambda ci: False),
+        ('not Flag = false', lambda ci: ci['Flag']),
+        ("When = '20200301000000.000000+000'",
+            lambda ci: ci['When'].datetime.month == 3),
+        ("When > '20201001000000.000000+000'",
+            lambda ci: ci['When'].datetime.month > 10),
+        ('Arr = 7', lambda ci: False),
+        ("Name = 'n4' or Name = 'n7' or Name = 'nothing'",
+            lambda ci: ci['Name'] in (u'n4', u'n7')),
+        ("Name = 'n4' and Num = 5", lambda ci: False),
+        ('Name = 4', lambda ci: False),
+        ('Test_Base isa Test_Sub', lambda ci: ci.classname == 'Test_Sub'),
+        ('Test_Base isa Test_Other and Num < 10',
+            lambda ci: ci.classname == 'Test_Other' and ci['Num'] is not None
+                and ci['Num'] < 10),
+        ("Test_Base isa Test_Sub or Name = 'n3'",
+            lambda ci: ci.classname == 'Test_Sub' or ci['Name'] == u'n3'),
+        ("Extra = 'x4'", lambda ci: ci['Name'] == u'n4'),
+    ]
+
+    def check_conditions(self):
+        for cond, test in self.conditions:
+            for lang in ('WQL', 'DMTF:CQL'):
+                self.assertEqual(self.query('select * from Test_Base '
+                    'where ' + cond, lang), self.expected(test), cond)
+
+    def test_scan(self):
+        self.check_conditions()
+
+    def test_index(self):
+        for pname in ('Num', 'Str', 'Flag', 'When', 'Arr'):
+            cimdb.CreatePropertyIndex('Test_Base', pname, NS)
+        self.check_conditions()
+
+    def probes(self, cond):
+        q = cimquery.InstanceQuery('select * from Test_Base where ' + cond,
+            'WQL', NS)
+        return q.index_probes()
+
+    def test_index_probes(self):
+        self.assertEqual(self.probes('Num = 5'), None)
+        for pname in ('Num', 'When', 'Arr'):
+            cimdb.CreatePropertyIndex('Test_Base', pname, NS)
+        self.assertEqual(self.probes('Num = 5'),
+            [('Test_Base', 'Num', '=', 5)])
+        self.assertEqual(self.probes('Num < 5 or 7 < Num'),
+            [('Test_Base', 'Num', '<', 5), ('Test_Base', 'Num', '>', 7)])
+        # Either side of an AND will do
+        self.assertEqual(self.probes("Num = 5 and Str = 'x'"),
+            [('Test_Base', 'Num', '=', 5)])
+        # Nothing compares with the literal, so nothing need be read
+        self.assertEqual(self.probes("Num = 'five'"), [])
+        self.assertEqual(self.probes("Num = 5 or Str = 'x'"), None)
+        self.assertEqual(self.probes('Num <> 5'), None)
+        self.assertEqual(self.probes('Num is null'), None)
+        self.assertEqual(self.probes('Arr = 7'), None)
+        self.assertEqual(self.probes(
+            "When = '20200301000000.000000+000'"),
+            [('Test_Base', 'When', '=',
+                CIMDateTime('20200301000000.000000+000'))])
+        self.assertEqual(self.probes(
+            "When > '20200301000000.000000+000'"), None)
+
+    def test_key_lookup(self):
+        q = cimquery.InstanceQuery("select * from Test_Base where "
+            "(Name = 'n1' or Name = 'n2') and Num > 0", 'WQL', NS)
+        self.assertEqual(sorted(str(n) for n in q.instance_names()),
+            sorted(str(CIMInstanceName('Test_Base', {'Name': name},
+                namespace=NS)) for name in (u'n1', u'n2')))
+        q = cimquery.InstanceQuery("select * from Test_Base where "
+            "Name = 'n1' or Num = 2", 'WQL', NS)
+        self.assertEqual(q.instance_names(), None)
+
+    def test_isa_pruning(self):
+        q = cimquery.InstanceQuery('select * from Test_Base b where '
+            'b isa Test_Sub and Num > 3', 'WQL', NS)
+        self.assertEqual(q.classnames, set(['test_sub']))
+        q = cimquery.InstanceQuery('select * from Test_Base where '
+            'Test_Base isa Test_Sub or Test_Base isa Test_Other', 'WQL', NS)
+        self.assertEqual(q.classnames, set(['test_sub', 'test_other']))
+        q = cimquery.InstanceQuery('select * from Test_Base where '
+            'Test_Base isa Test_Sub or Num = 1', 'WQL', NS)
+        self.assertEqual(q.classnames,
+            set(['test_base', 'test_sub', 'test_other']))
+        self.assertEqual(self.query('select * from Test_Sub where '
+            'Test_Sub isa Test_Other'), [])
+
+    def test_reference_isa(self):
+        self.assertEqual([ci['Name'] for ci in cimquery.ExecQuery(NS, 'WQL',
+            'select * from Test_Link where Ref isa Test_Link')], [])
+        names = sorted(ci['Name'] for ci in cimquery.ExecQuery(NS, 'WQL',
+            'select * from Test_Link where Ref isa Test_Sub'))
+        self.assertEqual(names, sorted(u'l%d' % i for i in range(0, 10, 2)))
+
+    def test_projection(self):
+        for text in ['select Name, Num from Test_Base where Num = 3',
+                'select b.Name, b.Num from Test_Base as b where b.Num = 3']:
+            result = list(cimquery.ExecQuery(NS, 'WQL', text))
+            self.assertEqual(len(result), 1)
+            self.assertEqual(sorted(result[0].properties.keys()),
+                ['Name', 'Num'])
+            self.assertEqual(result[0].path['Name'], u'n3')
+
+    def test_errors(self):
+        for lang, text, code in [
+                ('SQL', 'select * from Test_Base',
+                    pywbem.CIM_ERR_QUERY_LANGUAGE_NOT_SUPPORTED),
+                ('WQL', 'select * from Test_Nothing',
+                    pywbem.CIM_ERR_INVALID_QUERY),
+                ('WQL', 'select * from Test_Base where Ref isa Test_None',
+                    pywbem.CIM_ERR_INVALID_QUERY),
+                ('WQL', 'select * from', pywbem.CIM_ERR_INVALID_QUERY)]:
+            try:
+                list(cimquery.ExecQuery(NS, lang, text))
+            except pywbem.CIMError, e:
+                self.assertEqual(e.args[0], code, text)
+            else:
+                self.fail(text)
+
+if __name__ == '__main__':
+    unittest.main()
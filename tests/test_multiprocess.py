@@ -0,0 +1,234 @@
+"""Tests of a namespace used by two processes at once: this one, and
+another that makes changes in between. The caches of this process must
+never serve what the other one changed."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pywbem
+from pywbem import CIMClass, CIMInstance, CIMInstanceName, CIMProperty, \
+    CIMQualifier, CIMQualifierDeclaration
+import cimdb
+
+NS = 'root/test'
+
+##############################################################################
+def _item_class(classname='Test_Item', **extra):
+    props = {'Name': CIMProperty('Name', None, type='string',
+                qualifiers={'Key': CIMQualifier('Key', True)}),
+             'Value': CIMProperty('Value', None, type='string')}
+    for name, t in extra.items():
+        props[name] = CIMProperty(name, None, type=t)
+    return CIMClass(classname, properties=props)
+
+##############################################################################
+def _item(i, value=None, classname='Test_Item'):
+    path = CIMInstanceName(classname, {'Name': u'n%d' % i}, namespace=NS)
+    return CIMInstance(classname, path=path,
+        properties={'Name': u'n%d' % i, 'Value': value or u'v%d' % i})
+
+##############################################################################
+class MultiProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repdir = tempfile.mkdtemp()
+        self.olddir = cimdb._REPDIR
+        cimdb._REPDIR = self.repdir
+        cimdb.CreateNamespace(NS)
+        cimdb.SetQualifier(CIMQualifierDeclaration('Key', 'boolean',
+            scopes={'PROPERTY': True}, overridable=False), NS)
+        cimdb.SetQualifier(CIMQualifierDeclaration('Description', 'string',
+            scopes={'ANY': True}, overridable=True), NS)
+        cimdb.CreateClass(_item_class(), NS)
+
+    def tearDown(self):
+        cimdb.DeleteNamespace(NS)
+        cimdb._REPDIR = self.olddir
+        shutil.rmtree(self.repdir)
+
+    def other(self, code):
+        """Run code in another process using the same repository."""
+        code = textwrap.dedent('''\
+            import sys
+            sys.path.insert(0, %r)
+            sys.path.insert(0, %r)
+            import pywbem, cimdb
+            from test_multiprocess import NS, _item_class, _item
+            cimdb._REPDIR = %r
+            ''') % (ROOT, os.path.dirname(os.path.abspath(__file__)),
+                self.repdir) + textwrap.dedent(code)
+        self.assertEqual(subprocess.call([sys.executable, '-c', code]), 0)
+
+    def before_next_write(self, code):
+        """Run code in another process once the next write has checked out
+        its connection, just before it begins its transaction."""
+        write = cimdb._write_transaction
+        def _write_transaction(conn, fn):
+            cimdb._write_transaction = write
+            self.other(code)
+            return write(conn, fn)
+        cimdb._write_transaction = _write_transaction
+        self.addCleanup(setattr, cimdb, '_write_transaction', write)
+
+    def test_class_change(self):
+        cc = cimdb.GetClass('Test_Item', NS, LocalOnly=False)
+        self.assertFalse('Extra' in cc.properties)
+        self.other('''
+            cimdb.ModifyClass(_item_class(Extra='uint32'), NS)
+            ''')
+        cc = cimdb.GetClass('Test_Item', NS, LocalOnly=False)
+        self.assertEqual(cc.properties['Extra'].type, 'uint32')
+
+    def test_qualifier_change(self):
+        self.assertTrue(cimdb.GetQualifier('Description', NS).overridable)
+        self.other('''
+            cimdb.SetQualifier(pywbem.CIMQualifierDeclaration('Description',
+                'string', scopes={'ANY': True}, overridable=False), NS)
+            ''')
+        self.assertFalse(cimdb.GetQualifier('Description', NS).overridable)
+
+    def test_sync_skips_instances(self):
+        cimdb.SyncCaches(NS)
+        self.other('''
+            cimdb.CreateInstances([_item(i) for i in range(500)], NS)
+            ''')
+        decode = cimdb._decode
+        decoded = []
+        def _decode(*args):
+            decoded.append(args)
+            return decode(*args)
+        cimdb._decode = _decode
+        try:
+            seq = cimdb.SyncCaches(NS)
+        finally:
+            cimdb._decode = decode
+        self.assertEqual(decoded, [])
+        self.assertEqual(seq, cimdb.GetChangeSequence(NS))
+
+    def test_layout_change(self):
+        cimdb.CreateInstance(_item(1))
+        self.assertEqual(cimdb.GetInstance(_item(1).path)['Value'], u'v1')
+        self.other('''
+            cimdb.SetInstanceLayout('Test_Item', NS, cimdb.LAYOUT_SPLIT)
+            ''')
+        self.assertEqual(cimdb.GetInstance(_item(1).path)['Value'], u'v1')
+        self.before_next_write('''
+            cimdb.SetInstanceLayout('Test_Item', NS, cimdb.LAYOUT_BLOB)
+            ''')
+        cimdb.ModifyInstance(_item(1, u'changed'))
+        self.before_next_write('''
+            cimdb.SetInstanceLayout('Test_Item', NS, cimdb.LAYOUT_SPLIT)
+            ''')
+        cimdb.CreateInstance(_item(2))
+        self.other('''
+            assert cimdb.GetInstance(_item(1).path)['Value'] == u'changed'
+            assert cimdb.GetInstance(_item(2).path)['Value'] == u'v2'
+            ''')
+        self.assertEqual(cimdb.GetInstance(_item(1).path,
+            PropertyList=['Value'])['Value'], u'changed')
+        self.assertEqual(cimdb.GetInstance(_item(2).path)['Value'], u'v2')
+
+    def test_index_change(self):
+        cimdb.CreateInstance(_item(1))
+        self.before_next_write('''
+            cimdb.CreatePropertyIndex('Test_Item', 'Value', NS)
+            ''')
+        cimdb.CreateInstance(_item(2))
+        self.before_next_write('''
+            cimdb.DropPropertyIndex('Test_Item', 'Value', NS)
+            cimdb.CreatePropertyIndex('Test_Item', 'Name', NS)
+            ''')
+        cimdb.CreateInstance(_item(3))
+        conn = cimdb._getdbconnection(NS)
+        try:
+            rows = sorted(conn.cursor().execute('select propname,value '
+                'from PropIndexData'))
+        finally:
+            conn.close(True)
+        self.assertEqual(rows, [(u'Name', u'n1'), (u'Name', u'n2'),
+            (u'Name', u'n3')])
+
+    def test_shard_change(self):
+        cimdb.CreateInstances([_item(i) for i in range(10)], NS)
+        self.assertEqual(len(list(cimdb.EnumerateInstanceNames('Test_Item',
+            NS))), 10)
+        self.other('''
+            cimdb.ShardClass('Test_Item', NS, 2)
+            ''')
+        self.assertEqual(len(list(cimdb.EnumerateInstanceNames('Test_Item',
+            NS))), 10)
+        self.assertEqual(cimdb.GetInstance(_item(3).path)['Value'], u'v3')
+        self.before_next_write('''
+            cimdb.ShardClass('Test_Item', NS, 3)
+            ''')
+        cimdb.CreateInstance(_item(10))
+        self.before_next_write('''
+            cimdb.ShardClass('Test_Item', NS, 0)
+            ''')
+        cimdb.ModifyInstance(_item(4, u'changed'))
+        self.before_next_write('''
+            cimdb.ShardClass('Test_Item', NS, 2)
+            ''')
+        cimdb.DeleteInstance(_item(5).path)
+        self.other('''
+            names = cimdb.EnumerateInstanceNames('Test_Item', NS)
+            assert sorted(n['Name'] for n in names) == \\
+                sorted(u'n%d' % i for i in range(11) if i != 5)
+            assert cimdb.GetInstance(_item(4).path)['Value'] == u'changed'
+            ''')
+        self.assertEqual(cimdb.CountInstances('Test_Item', NS), 10)
+        self.assertEqual(cimdb.GetInstance(_item(10).path)['Value'], u'v10')
+
+    def test_zdict_reuse(self):
+        # A dictionary trained for a class deleted by the other process
+        # must not be used to decode instances of a class created since
+        self.addCleanup(cimdb.SetCodec, cimdb._codec)
+        cimdb.SetCodec('zdict')
+        cimdb.CreateClass(_item_class(classname='Test_Old'), NS)
+        cimdb.CreateInstances([_item(i, u'old value %d' % i, 'Test_Old')
+            for i in range(40)], NS)
+        self.assertEqual(cimdb.GetInstance(_item(39,
+            classname='Test_Old').path)['Value'], u'old value 39')
+        self.other('''
+            cimdb.SetCodec('zdict')
+            cimdb.DeleteClass('Test_Old', NS)
+            cimdb.CreateClass(_item_class(classname='Test_New'), NS)
+            for i in range(40):
+                cimdb.CreateInstance(_item(i, u'new %d' % i, 'Test_New'))
+            ''')
+        self.assertEqual(cimdb.GetInstance(_item(39,
+            classname='Test_New').path)['Value'], u'new 39')
+
+    def test_shard_crash(self):
+        cimdb.CreateInstances([_item(i) for i in range(20)], NS)
+        # The other process dies once the instances are copied, before
+        # the class is switched over to its new databases
+        crash = '''
+            def _set_class_storage(*args):
+                os._exit(3)
+            cimdb._set_class_storage = _set_class_storage
+            '''
+        for before, after in [(0, 2), (2, 3), (3, 0)]:
+            cimdb.ShardClass('Test_Item', NS, before)
+            code = 'import os\n' + textwrap.dedent(crash) + \
+                'cimdb.ShardClass(\'Test_Item\', NS, %d)\n' % after
+            self.assertRaises(AssertionError, self.other, code)
+            names = list(cimdb.EnumerateInstanceNames('Test_Item', NS))
+            self.assertEqual(len(names), 20)
+            self.assertEqual(cimdb.GetInstance(_item(7).path)['Value'],
+                u'v7')
+            cimdb.ShardClass('Test_Item', NS, after)
+            self.assertEqual(sorted(n['Name'] for n in
+                cimdb.EnumerateInstanceNames('Test_Item', NS)),
+                sorted(n['Name'] for n in names))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+"""Tests of property indexes: lookups must find the same instances with
+an index as without one."""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pywbem
+from pywbem import CIMClass, CIMInstance, CIMInstanceName, CIMProperty, \
+    CIMQualifier, CIMQualifierDeclaration
+import cimdb
+
+NS = 'root/test'
+
+##############################################################################
+def _thing(i, num, arr):
+    path = CIMInstanceName('Test_Thing', {'Name': u'n%d' % i}, namespace=NS)
+    return CIMInstance('Test_Thing', path=path,
+        properties={'Name': u'n%d' % i,
+                    'Num': CIMProperty('Num', num, type='uint32'),
+                    'Arr': CIMProperty('Arr', arr, type='uint32',
+                        is_array=True)})
+
+##############################################################################
+class PropertyIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repdir = tempfile.mkdtemp()
+        self.olddir = cimdb._REPDIR
+        cimdb._REPDIR = self.repdir
+        cimdb.CreateNamespace(NS)
+        cimdb.SetQualifier(CIMQualifierDeclaration('Key', 'boolean',
+            scopes={'PROPERTY': True}, overridable=False), NS)
+        cimdb.CreateClass(CIMClass('Test_Thing', properties={
+            'Name': CIMProperty('Name', None, type='string',
+                qualifiers={'Key': CIMQualifier('Key', True)}),
+            'Num': CIMProperty('Num', None, type='uint32'),
+            'Arr': CIMProperty('Arr', None, type='uint32', is_array=True)}),
+            NS)
+        cimdb.CreateInstances([_thing(0, 1, [5, 6]), _thing(1, 5, [5, 6]),
+            _thing(2, 7, [6, 5]), _thing(3, 9, [1]), _thing(4, None, None)],
+            NS)
+
+    def tearDown(self):
+        cimdb.DeleteNamespace(NS)
+        cimdb._REPDIR = self.olddir
+        shutil.rmtree(self.repdir)
+
+    def find(self, pname, op, value):
+        return sorted(n['Name'] for n in cimdb.FindInstanceNames(
+            'Test_Thing', NS, pname, value, op))
+
+    # (property, operator, value, names found)
+    lookups = [
+        ('Num', '=', 5, [u'n1']),
+        ('Num', '>', 1, [u'n1', u'n2', u'n3']),
+        ('Num', '<=', 7, [u'n0', u'n1', u'n2']),
+        ('Num', '=', 2, []),
+        ('Arr', '=', 5, [u'n0', u'n1', u'n2']),
+        ('Arr', '>', 1, [u'n0', u'n1', u'n2']),
+        ('Arr', '<', 5, [u'n3']),
+        ('Arr', '>=', 6, [u'n0', u'n1', u'n2']),
+        ('Arr', '=', 7, []),
+    ]
+
+    def test_scan(self):
+        self.assertEqual(cimdb.IndexedProperties('Test_Thing', NS), {})
+        for pname, op, value, names in self.lookups:
+            self.assertEqual(self.find(pname, op, value), names,
+                (pname, op, value))
+
+    def test_index(self):
+        cimdb.CreatePropertyIndex('Test_Thing', 'Num', NS)
+        cimdb.CreatePropertyIndex('Test_Thing', 'Arr', NS)
+        self.assertEqual(sorted(cimdb.IndexedProperties('Test_Thing', NS)),
+            ['arr', 'num'])
+        for pname, op, value, names in self.lookups:
+            self.assertEqual(self.find(pname, op, value), names,
+                (pname, op, value))
+
+    def test_bad_lookup(self):
+        for index in (False, True):
+            if index:
+                cimdb.CreatePropertyIndex('Test_Thing', 'Num', NS)
+            for op, value in [('!=', 1), ('=', [1])]:
+                try:
+                    self.find('Num', op, value)
+                except pywbem.CIMError, e:
+                    self.assertEqual(e.args[0],
+                        pywbem.CIM_ERR_INVALID_PARAMETER)
+                else:
+                    self.fail((index, op, value))
+
+    def break_build(self):
+        scan = cimdb._keyset_scan
+        def _keyset_scan(*args):
+            cimdb._keyset_scan = scan
+            raise ValueError('build failed')
+        cimdb._keyset_scan = _keyset_scan
+        self.addCleanup(setattr, cimdb, '_keyset_scan', scan)
+
+    def test_failed_build(self):
+        self.break_build()
+        self.assertRaises(ValueError, cimdb.CreatePropertyIndex,
+            'Test_Thing', 'Arr', NS)
+        self.assertEqual(cimdb.EnumeratePropertyIndexes(NS),
+            [(u'Test_Thing', u'Arr', u'failed')])
+        self.assertEqual(cimdb.IndexedProperties('Test_Thing', NS), {})
+        # Writers keep a failed index up to date
+        cimdb.CreateInstance(_thing(5, 3, [8]))
+        cimdb.CreatePropertyIndex('Test_Thing', 'Arr', NS)
+        self.assertEqual(cimdb.EnumeratePropertyIndexes(NS),
+            [(u'Test_Thing', u'Arr', u'ready')])
+        self.assertEqual(self.find('Arr', '=', 8), [u'n5'])
+        self.assertEqual(self.find('Arr', '=', 5), [u'n0', u'n1', u'n2'])
+        try:
+            cimdb.CreatePropertyIndex('Test_Thing', 'Arr', NS)
+        except pywbem.CIMError, e:
+            self.assertEqual(e.args[0], pywbem.CIM_ERR_ALREADY_EXISTS)
+        else:
+            self.fail('index created twice')
+
+    def test_failed_background_build(self):
+        self.break_build()
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            cimdb.CreatePropertyIndex('Test_Thing', 'Num', NS,
+                Background=True)
+            for t in threading.enumerate():
+                if t.getName() == 'cimdb index Test_Thing.Num':
+                    t.join()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(cimdb.EnumeratePropertyIndexes(NS),
+            [(u'Test_Thing', u'Num', u'failed')])
+        cimdb.CreatePropertyIndex('Test_Thing', 'Num', NS)
+        self.assertEqual(self.find('Num', '>', 1), [u'n1', u'n2', u'n3'])
+
+if __name__ == '__main__':
+    unittest.main()